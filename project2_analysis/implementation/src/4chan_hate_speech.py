@@ -1,21 +1,52 @@
 from pymongo import MongoClient
 import asyncio
-import aiohttp
 import time
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timezone
 import logging
 import os
 from logging.handlers import RotatingFileHandler
 from motor.motor_asyncio import AsyncIOMotorClient
-from config import MONGODB_URI, MODERATE_API_KEY
+from config import (
+    MONGODB_URI,
+    MONGODB_DB,
+    MODERATE_API_KEY,
+    CLASSIFICATION_CACHE_COLLECTION,
+    HATE_SPEECH_MAX_CONCURRENCY,
+    JOB_CHECKPOINTS_COLLECTION,
+    CIRCUIT_BREAKER_COLLECTION,
+    DEAD_LETTER_COLLECTION,
+    BREAKER_REFRESH_INTERVAL,
+)
+from pymongo import UpdateOne
+from analysis_state import OPEN_STATES, PARKED_STATE, claim_ids_async, result_state
+from async_detector import AsyncHateSpeechDetector
+from bulk_writer import AsyncBulkWriter
+from circuit_breaker import AsyncCircuitBreaker, CircuitOpenError
+from classification_cache import AsyncClassificationCache
+from dead_letters import dead_letter_operation
+from prefilter import load_prefilter
+from text_normalization import comment_text
+from toxicity_rollups import (
+    NOT_ROLLED_UP,
+    pending_rollup,
+    roll_up_pending_async,
+    sweep_rollups,
+)
 
 # Configuration
 DB = "crawler_4chan_v2"
 POSTS_COLLECTION = "posts"
-BATCH_SIZE = 20
-SKIP_SIZE = 1000
+WORKER_COUNT = HATE_SPEECH_MAX_CONCURRENCY  # The AIMD limiter gates API calls
+PAGE_SIZE = 1000  # Posts read per keyset page
+QUEUE_SIZE = PAGE_SIZE  # Lets the next page load while the current one drains
+PROGRESS_INTERVAL = 30  # Seconds between progress log lines
 LOG_DIR = "logs"
 EMPTY_MARKERS = ["", None, "[deleted]", "[removed]"]
+POST_PROJECTION = {
+    field: 1
+    for field in ("com", "com_text", "no", "time", "lease_token", "analysis_attempts")
+}
 
 # Time range configuration
 START_TIME = 1731128400  # 9 Nov 2024
@@ -45,70 +76,7 @@ file_handler.setFormatter(
 logger.addHandler(file_handler)
 
 
-class AsyncHateSpeechDetector:
-    def __init__(self, api_key):
-        self.api_key = api_key
-        self.api_url = "https://api.moderatehatespeech.com/api/v1/moderate/"
-        self.max_retries = 5
-        self.base_delay = 1
-        self.session = None
-
-    async def init_session(self):
-        if not self.session:
-            self.session = aiohttp.ClientSession()
-
-    async def close(self):
-        if self.session:
-            await self.session.close()
-
-    def clean_text(self, text):
-        """Clean and prepare text for API request"""
-        if not text:
-            return ""
-        text = text.replace("&#039;", "'").replace("&quot;", '"')
-        text = " ".join(text.split())
-        return text
-
-    async def detect(self, text):
-        """Detect hate speech in text with retry logic"""
-        if not text:
-            return None
-
-        cleaned_text = self.clean_text(text)
-        request_data = {"token": self.api_key, "text": cleaned_text}
-        headers = {"Content-Type": "application/json"}
-
-        for attempt in range(self.max_retries):
-            try:
-                async with self.session.post(
-                    self.api_url, json=request_data, headers=headers, timeout=30
-                ) as response:
-                    if response.status == 429:
-                        delay = (2**attempt) * self.base_delay
-                        logger.warning(
-                            f"Rate limit hit, backing off for {delay} seconds"
-                        )
-                        await asyncio.sleep(delay)
-                        continue
-
-                    response_data = await response.json()
-
-                    if response_data.get("response") == "Success":
-                        return {
-                            "class": response_data.get("class"),
-                            "confidence": float(response_data.get("confidence", 0)),
-                            "analyzed_at": datetime.utcnow().timestamp(),
-                        }
-
-            except Exception as e:
-                logger.error(f"API error on attempt {attempt + 1}: {str(e)}")
-                if attempt < self.max_retries - 1:
-                    await asyncio.sleep(self.base_delay)
-
-        return None
-
-
-async def process_post(detector, post, posts_collection, stats):
+async def process_post(detector, post, posts_collection, writer, dead_letters, stats):
     """Process a single post"""
     try:
         current_time = time.time()
@@ -118,7 +86,7 @@ async def process_post(detector, post, posts_collection, stats):
         }
 
         # Check if post has valid content to analyze
-        com = post.get("com", "")
+        com = comment_text(post)
         if not com or com in EMPTY_MARKERS:
             update_data.update(
                 {
@@ -128,8 +96,16 @@ async def process_post(detector, post, posts_collection, stats):
                 }
             )
             stats["skipped_empty"] += 1
+            update_data.update(result_state(post, succeeded=True))
         else:
-            result = await detector.detect(com)
+            try:
+                result = await detector.detect(com)
+                # API failures go back to pending so the enqueuers retry them
+                reason = "api_error"
+                state = result_state(post, succeeded=bool(result))
+            except CircuitOpenError:
+                # The API is down: park the post without spending an attempt
+                result, reason, state = None, "circuit_open", PARKED_STATE
             if result:
                 update_data.update(
                     {"hate_speech_result": result, "analysis_skipped": False}
@@ -140,13 +116,24 @@ async def process_post(detector, post, posts_collection, stats):
                 update_data.update(
                     {
                         "analysis_skipped": True,
-                        "analysis_skipped_reason": "api_error",
+                        "analysis_skipped_reason": reason,
                         "hate_speech_result": None,
                     }
                 )
                 stats["api_errors"] += 1
-
-        await posts_collection.update_one({"_id": post["_id"]}, {"$set": update_data})
+            update_data.update(state)
+
+        # Counted by the next rollup sweep, once this write has landed
+        update_data.update(pending_rollup(update_data))
+        # Only written while this run's lease is still the post's current one
+        query = {"_id": post["_id"], "lease_token": post["lease_token"]}
+        await writer.add(
+            posts_collection,
+            UpdateOne({**query, **NOT_ROLLED_UP}, {"$set": update_data}),
+        )
+        dead_letter = dead_letter_operation("4chan_post", post["_id"], update_data)
+        if dead_letter:
+            await writer.add(dead_letters, dead_letter)
 
         stats["total_processed"] += 1
 
@@ -154,10 +141,130 @@ async def process_post(detector, post, posts_collection, stats):
         logger.error(f"Error processing post {post.get('no')}: {str(e)}")
 
 
-async def process_batch(detector, posts, posts_collection, stats):
-    """Process a batch of posts concurrently"""
-    tasks = [process_post(detector, post, posts_collection, stats) for post in posts]
-    await asyncio.gather(*tasks)
+class KeysetProgress:
+    """Resume point of the (time, _id) scan, persisted so a restart skips
+    pages that were fully processed.
+
+    Posts finish out of order, so the checkpoint only advances past a page
+    once every post of it and of all earlier pages is done.
+    """
+
+    def __init__(self, collection, checkpoint_id, writer):
+        self.collection = collection
+        self.checkpoint_id = checkpoint_id
+        self.writer = writer
+        self.pages = deque()  # [last key, posts still outstanding]
+        self._lock = asyncio.Lock()
+
+    async def load(self):
+        doc = await self.collection.find_one({"_id": self.checkpoint_id})
+        if not doc:
+            return None
+        logger.info(f"Resuming after post time {doc['time']} ({doc['post_id']})")
+        return doc["time"], doc["post_id"]
+
+    def add_page(self, last_key, size):
+        page = [last_key, size]
+        self.pages.append(page)
+        return page
+
+    async def complete(self, page):
+        page[1] -= 1
+        async with self._lock:
+            resume_key = None
+            while self.pages and self.pages[0][1] == 0:
+                resume_key = self.pages.popleft()[0]
+            if resume_key:
+                # Results before the resume key must be stored before it is
+                await self.writer.flush()
+                await self.collection.update_one(
+                    {"_id": self.checkpoint_id},
+                    {
+                        "$set": {
+                            "time": resume_key[0],
+                            "post_id": resume_key[1],
+                            "updated_at": datetime.now(timezone.utc),
+                        }
+                    },
+                    upsert=True,
+                )
+
+    async def finish(self):
+        await self.collection.delete_one({"_id": self.checkpoint_id})
+
+
+async def produce_posts(posts_collection, query, queue, progress, after):
+    """Page through matching posts by (time, _id) and queue those this run
+    could lease; posts leased by the enqueuers or the detection service are
+    left to them"""
+    while True:
+        page_query = dict(query)
+        if after:
+            last_time, last_id = after
+            page_query["$or"] = [
+                {"time": {"$gt": last_time}},
+                {"time": last_time, "_id": {"$gt": last_id}},
+            ]
+
+        batch = (
+            await posts_collection.find(page_query, {"time": 1})
+            .sort([("time", 1), ("_id", 1)])
+            .limit(PAGE_SIZE)
+            .to_list(length=PAGE_SIZE)
+        )
+        if not batch:
+            return
+
+        after = (batch[-1]["time"], batch[-1]["_id"])
+        _, posts = await claim_ids_async(
+            posts_collection, "_id", [post["_id"] for post in batch], POST_PROJECTION
+        )
+        page = progress.add_page(after, len(posts))
+        for post in posts:
+            # Blocks while consumers are behind, bounding memory
+            await queue.put((post, page))
+
+
+async def consume_posts(
+    detector, queue, posts_collection, writer, dead_letters, progress, stats
+):
+    """Classify queued posts until a None sentinel arrives"""
+    while True:
+        item = await queue.get()
+        try:
+            if item is None:
+                return
+            post, page = item
+            # Wait out API outages instead of parking the rest of the range
+            while await detector.breaker.is_open():
+                await asyncio.sleep(BREAKER_REFRESH_INTERVAL)
+            await process_post(
+                detector, post, posts_collection, writer, dead_letters, stats
+            )
+            await progress.complete(page)
+        except Exception as e:
+            logger.error(f"Error in consumer: {str(e)}")
+        finally:
+            queue.task_done()
+
+
+async def report_progress(stats, total_posts, queue, reporters):
+    """Log progress every PROGRESS_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        elapsed = time.time() - stats["start_time"]
+        rate = stats["total_processed"] / elapsed
+        progress = stats["total_processed"] / total_posts * 100 if total_posts else 0
+        logger.info(
+            f"Progress: {progress:.1f}% "
+            f"({stats['total_processed']:,d}/{total_posts:,d} posts) | "
+            f"Rate: {rate:.2f} posts/sec | "
+            f"Queued: {queue.qsize():,d} | "
+            f"Hate speech: {stats['total_hate_speech']:,d} | "
+            f"Skipped: {stats['skipped_empty']:,d} | "
+            f"Errors: {stats['api_errors']:,d} | "
+            + " | ".join(reporter.summary() for reporter in reporters)
+        )
 
 
 async def process_posts_async():
@@ -170,7 +277,10 @@ async def process_posts_async():
         # Get total count of posts in time range
         query = {
             "time": {"$gte": START_TIME, "$lte": END_TIME},
-            "hate_speech_analyzed": None,
+            # Pending posts and expired leases; each page is leased before it
+            # is classified. Unsampled posts are only classified once
+            # toxicity_sampling draws them
+            "analysis_state": {"$in": OPEN_STATES},
             "com": {"$ne": ""},
         }
         total_posts = await posts_collection.count_documents(query)
@@ -180,9 +290,24 @@ async def process_posts_async():
             f"{datetime.fromtimestamp(START_TIME)} to {datetime.fromtimestamp(END_TIME)}"
         )
 
-        detector = AsyncHateSpeechDetector(MODERATE_API_KEY)
+        cache = AsyncClassificationCache(
+            client[MONGODB_DB][CLASSIFICATION_CACHE_COLLECTION]
+        )
+        prefilter = load_prefilter()
+        breaker = AsyncCircuitBreaker(client[MONGODB_DB][CIRCUIT_BREAKER_COLLECTION])
+        detector = AsyncHateSpeechDetector(
+            MODERATE_API_KEY, cache=cache, prefilter=prefilter, breaker=breaker
+        )
         await detector.init_session()
 
+        writer = AsyncBulkWriter()
+        progress = KeysetProgress(
+            client[MONGODB_DB][JOB_CHECKPOINTS_COLLECTION],
+            f"4chan_hate_speech:{START_TIME}:{END_TIME}",
+            writer,
+        )
+        after = await progress.load()
+
         stats = {
             "total_processed": 0,
             "total_hate_speech": 0,
@@ -193,42 +318,39 @@ async def process_posts_async():
 
         logger.info("Starting hate speech detection process...")
 
-        skip = 0
-        while skip < total_posts:
-            # Get a batch of posts using skip/limit
-            batch = (
-                await posts_collection.find(query)
-                .sort([("time", 1), ("_id", 1)])
-                .skip(skip)
-                .limit(SKIP_SIZE)
-                .to_list(length=SKIP_SIZE)
+        # Consumers pull posts one at a time, so a slow API call only holds
+        # up its own consumer instead of a whole batch
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        consumers = [
+            asyncio.create_task(
+                consume_posts(
+                    detector,
+                    queue,
+                    posts_collection,
+                    writer,
+                    client[MONGODB_DB][DEAD_LETTER_COLLECTION],
+                    progress,
+                    stats,
+                )
             )
-
-            if not batch:
-                break
-
-            # Process the batch in smaller chunks
-            for i in range(0, len(batch), BATCH_SIZE):
-                chunk = batch[i : i + BATCH_SIZE]
-                await process_batch(detector, chunk, posts_collection, stats)
-
-                # Log progress
-                elapsed = time.time() - stats["start_time"]
-                rate = stats["total_processed"] / elapsed
-                progress = (skip + i + len(chunk)) / total_posts * 100
-
-                if stats["total_processed"] % 100 == 0:
-                    logger.info(
-                        f"Progress: {progress:.1f}% "
-                        f"({stats['total_processed']:,d}/{total_posts:,d} posts) | "
-                        f"Rate: {rate:.2f} posts/sec | "
-                        f"Hate speech: {stats['total_hate_speech']:,d} | "
-                        f"Skipped: {stats['skipped_empty']:,d} | "
-                        f"Errors: {stats['api_errors']:,d}"
-                    )
-
-            skip += len(batch)  # Update skip based on actual batch size
-            await asyncio.sleep(0.1)  # Small delay between major batches
+            for _ in range(WORKER_COUNT)
+        ]
+        reporters = [cache] + ([prefilter] if prefilter else [])
+        reporters += [detector.limiter, breaker, writer]
+        reporter = asyncio.create_task(
+            report_progress(stats, total_posts, queue, reporters)
+        )
+        sweeper = asyncio.create_task(sweep_rollups(["4chan_post"]))
+
+        await produce_posts(posts_collection, query, queue, progress, after)
+        for _ in consumers:
+            await queue.put(None)
+        await asyncio.gather(*consumers)
+        reporter.cancel()
+        sweeper.cancel()
+        await writer.close()
+        await roll_up_pending_async(["4chan_post"])
+        await progress.finish()
 
         elapsed = time.time() - stats["start_time"]
         logger.info(
@@ -237,6 +359,7 @@ async def process_posts_async():
             f"Empty/skipped: {stats['skipped_empty']:,d}\n"
             f"API errors: {stats['api_errors']:,d}\n"
             f"Hate speech detected: {stats['total_hate_speech']:,d}\n"
+            f"{cache.summary()}\n"
             f"Average rate: {stats['total_processed']/elapsed:.2f} posts/second"
         )
 
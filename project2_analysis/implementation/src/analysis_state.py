@@ -0,0 +1,220 @@
+import sys
+import time
+import uuid
+from config import (
+    ANALYSIS_LEASE_SECONDS,
+    ANALYSIS_MAX_ATTEMPTS,
+    ANALYSIS_RETRY_DELAY,
+    HATE_SPEECH_CONTENT_SOURCES,
+    SAMPLED_COMMUNITIES,
+)
+from db import get_mongo_client
+from utils import setup_logger
+
+logger = setup_logger("analysis_state")
+
+# Lifecycle of a document's hate speech analysis
+PENDING = "pending"  # Waiting to be claimed once lease_expires_at has passed
+LEASED = "leased"  # Claimed by an enqueuer until lease_expires_at
+DONE = "done"
+FAILED = "failed"  # Parked in the dead-letter collection until re-driven
+UNSAMPLED = "unsampled"  # Sampled community, not drawn by toxicity_sampling.py
+
+# States the partial index covers; done and failed documents are never scanned
+OPEN_STATES = [PENDING, LEASED]
+
+# Fields new documents are inserted with ($setOnInsert in the crawlers)
+NEW_DOCUMENT_STATE = {"analysis_state": PENDING, "lease_expires_at": 0}
+UNSAMPLED_DOCUMENT_STATE = {"analysis_state": UNSAMPLED, "lease_expires_at": None}
+
+# Fields of a document parked after ANALYSIS_MAX_ATTEMPTS or an open breaker
+PARKED_STATE = {"analysis_state": FAILED, "lease_expires_at": None, "lease_token": None}
+
+
+def new_document_state(platform, community):
+    """Insert state for content crawled from a community.
+
+    Content of SAMPLED_COMMUNITIES is left unsampled; only the documents
+    toxicity_sampling.py draws are ever classified.
+    """
+    if f"{platform}:{community}".lower() in SAMPLED_COMMUNITIES:
+        return UNSAMPLED_DOCUMENT_STATE
+    return NEW_DOCUMENT_STATE
+
+
+def claimable_query(now):
+    """Pending documents and leases that expired without a result.
+
+    Always filters on analysis_state $in OPEN_STATES so the partial index
+    answers it.
+    """
+    return {
+        "analysis_state": {"$in": OPEN_STATES},
+        "lease_expires_at": {"$lte": now},
+    }
+
+
+def _lease_update(now, lease_seconds, token):
+    return {
+        "$set": {
+            "analysis_state": LEASED,
+            "lease_expires_at": now + lease_seconds,
+            "lease_token": token,
+        }
+    }
+
+
+def _lease(collection, key, query, now, lease_seconds):
+    """Lease every document matching query under a fresh token.
+
+    The claim predicate is part of the update filter, so when enqueuers race
+    for a document only one update matches it.
+    """
+    token = uuid.uuid4().hex
+    collection.update_many(query, _lease_update(now, lease_seconds, token))
+    claimed = collection.find(
+        {"analysis_state": LEASED, "lease_token": token}, {key: 1}
+    )
+    return token, [doc[key] for doc in claimed]
+
+
+def claim_batch(collection, key, limit, lease_seconds=ANALYSIS_LEASE_SECONDS):
+    """Lease up to limit claimable documents; returns (token, key values)"""
+    now = time.time()
+    query = claimable_query(now)
+    candidates = [doc[key] for doc in collection.find(query, {key: 1}).limit(limit)]
+    if not candidates:
+        return None, []
+    return _lease(
+        collection, key, {**query, key: {"$in": candidates}}, now, lease_seconds
+    )
+
+
+def claim_ids(collection, key, ids, lease_seconds=ANALYSIS_LEASE_SECONDS):
+    """Lease the given documents, skipping any another enqueuer holds"""
+    if not ids:
+        return None, []
+    now = time.time()
+    return _lease(
+        collection, key, {**claimable_query(now), key: {"$in": ids}}, now, lease_seconds
+    )
+
+
+async def claim_documents_async(
+    collection, key, limit, projection=None, lease_seconds=ANALYSIS_LEASE_SECONDS
+):
+    """claim_batch for motor collections, returning the leased documents"""
+    now = time.time()
+    query = claimable_query(now)
+    candidates = await collection.find(query, {key: 1}).limit(limit).to_list(limit)
+    if not candidates:
+        return None, []
+
+    token = uuid.uuid4().hex
+    await collection.update_many(
+        {**query, key: {"$in": [doc[key] for doc in candidates]}},
+        _lease_update(now, lease_seconds, token),
+    )
+    claimed = await collection.find(
+        {"analysis_state": LEASED, "lease_token": token}, projection
+    ).to_list(limit)
+    return token, claimed
+
+
+async def claim_ids_async(
+    collection, key, ids, projection=None, lease_seconds=ANALYSIS_LEASE_SECONDS
+):
+    """claim_ids for motor collections, returning the leased documents"""
+    if not ids:
+        return None, []
+    now = time.time()
+    token = uuid.uuid4().hex
+    await collection.update_many(
+        {**claimable_query(now), key: {"$in": ids}},
+        _lease_update(now, lease_seconds, token),
+    )
+    claimed = await collection.find(
+        {"analysis_state": LEASED, "lease_token": token}, projection
+    ).to_list(len(ids))
+    return token, claimed
+
+
+async def release_leases_async(collection, token):
+    """Hand back leased documents that were never processed"""
+    result = await collection.update_many(
+        {"analysis_state": LEASED, "lease_token": token},
+        {
+            "$set": {
+                "analysis_state": PENDING,
+                "lease_expires_at": 0,
+                "lease_token": None,
+            }
+        },
+    )
+    return result.modified_count
+
+
+def holds_lease(document, lease_token):
+    """Whether a job's lease on a document is still the current one.
+
+    Jobs from before leasing carry no token and are always allowed.
+    """
+    return lease_token is None or document.get("lease_token") == lease_token
+
+
+def result_state(document, succeeded):
+    """Fields recording the outcome of one analysis attempt.
+
+    Attempts are counted here, on an actual failure, rather than when a
+    document is leased, so leases that expire in a backed-up queue cost none.
+    document must carry its analysis_attempts.
+    """
+    if succeeded:
+        return {"analysis_state": DONE, "lease_expires_at": None, "lease_token": None}
+    attempts = document.get("analysis_attempts", 0) + 1
+    if attempts >= ANALYSIS_MAX_ATTEMPTS:
+        return {**PARKED_STATE, "analysis_attempts": attempts}
+    # Released for another attempt once the retry delay has passed
+    return {
+        "analysis_state": PENDING,
+        "lease_expires_at": time.time() + ANALYSIS_RETRY_DELAY,
+        "lease_token": None,
+        "analysis_attempts": attempts,
+    }
+
+
+def backfill_states():
+    """Give documents stored before analysis_state existed a state"""
+    client = get_mongo_client()
+    for content_type, (db_name, collection_name, _) in (
+        HATE_SPEECH_CONTENT_SOURCES.items()
+    ):
+        collection = client[db_name][collection_name]
+        missing = {"analysis_state": {"$exists": False}}
+        done = collection.update_many(
+            {**missing, "hate_speech_analyzed": True},
+            {"$set": {"analysis_state": DONE}},
+        )
+        pending = collection.update_many(
+            missing, {"$set": {"analysis_state": PENDING, "lease_expires_at": 0}}
+        )
+        logger.info(
+            f"{content_type}: {done.modified_count:,d} marked done, "
+            f"{pending.modified_count:,d} marked pending"
+        )
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else "backfill"
+    if command != "backfill":
+        logger.error(f"Unknown command {command}; use backfill")
+        return
+    try:
+        backfill_states()
+    except Exception as e:
+        logger.error(f"Analysis state backfill failed: {str(e)}")
+        raise
+
+
+if __name__ == "__main__":
+    main()
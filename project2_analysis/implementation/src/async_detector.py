@@ -0,0 +1,107 @@
+import asyncio
+import aiohttp
+import html
+from datetime import datetime
+from concurrency import AsyncConcurrencyLimiter
+from utils import setup_logger
+
+logger = setup_logger("async_hate_speech_detector")
+
+
+class AsyncHateSpeechDetector:
+    def __init__(
+        self, api_key, cache=None, prefilter=None, limiter=None, breaker=None
+    ):
+        self.api_key = api_key
+        self.cache = cache
+        self.prefilter = prefilter
+        self.limiter = limiter or AsyncConcurrencyLimiter()
+        self.breaker = breaker
+        self.api_url = "https://api.moderatehatespeech.com/api/v1/moderate/"
+        self.max_retries = 5
+        self.base_delay = 1
+        self.session = None
+
+    async def init_session(self):
+        if not self.session:
+            self.session = aiohttp.ClientSession()
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+
+    def clean_text(self, text):
+        """Clean and prepare text for API request"""
+        if not text:
+            return ""
+        return " ".join(html.unescape(text).split())
+
+    async def detect(self, text):
+        """Detect hate speech in text with retry logic"""
+        if not text:
+            return None
+
+        if self.cache:
+            cached = await self.cache.get(text)
+            if cached:
+                return cached
+
+        audit = None
+        if self.prefilter:
+            local_result, audit = self.prefilter.screen(text)
+            if local_result:
+                return local_result
+
+        cleaned_text = self.clean_text(text)
+        request_data = {"token": self.api_key, "text": cleaned_text}
+        headers = {"Content-Type": "application/json"}
+
+        for attempt in range(self.max_retries):
+            # Raises CircuitOpenError while the API is considered down
+            probing = await self.breaker.allow() if self.breaker else False
+            answered = False  # Whether the API was up; throttling counts
+            try:
+                async with self.limiter.slot() as slot:
+                    async with self.session.post(
+                        self.api_url, json=request_data, headers=headers, timeout=30
+                    ) as response:
+                        throttled = response.status == 429
+                        if throttled:
+                            slot.throttled()
+                        elif response.status >= 500:
+                            slot.server_error()
+                            response_data = {}
+                        else:
+                            response_data = await response.json()
+
+                # Back off outside the slot so waiting doesn't count as latency
+                if throttled:
+                    answered = True
+                    delay = (2**attempt) * self.base_delay
+                    logger.warning(f"Rate limit hit, backing off for {delay} seconds")
+                    await asyncio.sleep(delay)
+                    continue
+
+                if response_data.get("response") == "Success":
+                    answered = True
+                    result = {
+                        "class": response_data.get("class"),
+                        "confidence": float(response_data.get("confidence", 0)),
+                        "analyzed_at": datetime.utcnow().timestamp(),
+                        "source": "api",
+                    }
+                    if audit:
+                        result["prefilter"] = audit
+                    if self.cache:
+                        await self.cache.put(text, result)
+                    return result
+
+            except Exception as e:
+                logger.error(f"API error on attempt {attempt + 1}: {str(e)}")
+                if attempt < self.max_retries - 1:
+                    await asyncio.sleep(self.base_delay)
+            finally:
+                if self.breaker:
+                    await self.breaker.record(answered, probing)
+
+        return None
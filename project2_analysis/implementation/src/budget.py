@@ -0,0 +1,160 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from config import (
+    REQUESTS_PER_MINUTE,
+    REDDIT_BUDGET_FILE,
+    REDDIT_BUDGET_WEIGHTS,
+    REDDIT_LIVE_WINDOW,
+    REDDIT_LIVE_RESERVED_SLOTS,
+)
+from utils import file_lock
+
+
+def classify_reddit_job(job_data, now=None):
+    """Return the budget class (live/refresh/backfill) of a Reddit job"""
+    if job_data.get("job_class"):
+        return job_data["job_class"]
+    if "post_ids" in job_data:
+        return "refresh"
+
+    now = now or time.time()
+    if job_data.get("end_date", 0) >= now - REDDIT_LIVE_WINDOW:
+        return "live"
+    return "backfill"
+
+
+class RateBudgetAllocator:
+    """Splits the Reddit request budget between job classes by weight.
+
+    Every request is charged to the class of the job issuing it, in a per-minute
+    window shared by all worker processes on the host. Workers fetch next from
+    the class with the largest unused share, so fresh data keeps its budget
+    while backfill soaks up whatever the other classes leave unused. This
+    host's share of the budget is kept in the state file too.
+
+    Shares only order the queues, so long backfill jobs could still hold
+    every consumer slot while live jobs wait; RunningJobClasses keeps
+    REDDIT_LIVE_RESERVED_SLOTS of them for live jobs.
+    """
+
+    def __init__(
+        self,
+        weights=REDDIT_BUDGET_WEIGHTS,
+        capacity=REQUESTS_PER_MINUTE,
+        period=60,
+        state_file=REDDIT_BUDGET_FILE,
+    ):
+        self.weights = weights
+        self.capacity = capacity
+        self.period = period
+        self.state_file = state_file
+        self.lock_file = f"{state_file}.lock"
+        self._local = threading.local()
+
+    def set_share(self, share):
+        """Scale class budgets to this host's share of the API budget"""
+        with file_lock(self.lock_file):
+            state = self._load(time.time())
+            state["share"] = share
+            self._save(state)
+
+    def shares(self, share):
+        """Requests per window of each class for a host share"""
+        total = sum(self.weights.values())
+        return {
+            c: self.capacity * share * w / total for c, w in self.weights.items()
+        }
+
+    @contextmanager
+    def job_class(self, job_class):
+        """Charge requests made by this thread to job_class"""
+        previous = getattr(self._local, "job_class", None)
+        self._local.job_class = job_class
+        try:
+            yield
+        finally:
+            self._local.job_class = previous
+
+    def current_class(self):
+        return getattr(self._local, "job_class", None)
+
+    def _load(self, now):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {"window_start": now, "used": {}}
+
+        if now - state["window_start"] >= self.period:
+            state = {"window_start": now, "used": {}, "share": state.get("share")}
+        if state.get("share") is None:
+            state["share"] = 1.0
+        return state
+
+    def _save(self, state):
+        with open(self.state_file, "w") as f:
+            json.dump(state, f)
+
+    def record(self, job_class=None):
+        """Charge one request to job_class (default: the thread's class)"""
+        job_class = job_class or self.current_class()
+        if job_class not in self.weights:
+            return
+
+        now = time.time()
+        with file_lock(self.lock_file):
+            state = self._load(now)
+            state["used"][job_class] = state["used"].get(job_class, 0) + 1
+            self._save(state)
+
+    def remaining(self):
+        """Share and unused requests of each class in the current window"""
+        with file_lock(self.lock_file):
+            state = self._load(time.time())
+        shares = self.shares(state["share"])
+        return shares, {
+            c: share - state["used"].get(c, 0) for c, share in shares.items()
+        }
+
+    def class_order(self):
+        """Job classes ordered by the unused fraction of their share"""
+        shares, remaining = self.remaining()
+        return sorted(
+            shares,
+            key=lambda c: (remaining[c] / shares[c], shares[c]),
+            reverse=True,
+        )
+
+
+class RunningJobClasses:
+    """Budget classes of the jobs a consumer has dispatched and not finished.
+
+    Jobs run in the consumer's pool processes, so they are counted by the
+    consumer process itself, which is where the queues to fetch from are
+    picked.
+    """
+
+    def __init__(self):
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def started(self, job_class):
+        with self._lock:
+            self._running[job_class] = self._running.get(job_class, 0) + 1
+
+    def finished(self, job_class):
+        with self._lock:
+            self._running[job_class] -= 1
+
+    def live_slot_reserved(self, concurrency, reserved=REDDIT_LIVE_RESERVED_SLOTS):
+        """Whether the free consumer slots are held back for live jobs"""
+        if concurrency <= reserved:
+            return False
+        with self._lock:
+            other = sum(n for c, n in self._running.items() if c != "live")
+        return other >= concurrency - reserved
+
+
+reddit_budget_allocator = RateBudgetAllocator()
@@ -0,0 +1,148 @@
+import asyncio
+import threading
+from pymongo.errors import BulkWriteError
+from config import BULK_WRITE_BATCH_SIZE, BULK_WRITE_MAX_DELAY
+from utils import setup_logger
+
+logger = setup_logger("bulk_writer")
+
+
+class BufferedWrites:
+    """Pending write operations per collection, shared by both writers"""
+
+    def __init__(
+        self, max_batch=BULK_WRITE_BATCH_SIZE, max_delay=BULK_WRITE_MAX_DELAY
+    ):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._buffers = {}  # full collection name -> (collection, operations)
+        self.stats = {"operations": 0, "flushes": 0, "errors": 0}
+
+    def _append(self, collection, operation):
+        """Buffer an operation; return True once its collection is due a flush"""
+        _, operations = self._buffers.setdefault(
+            collection.full_name, (collection, [])
+        )
+        operations.append(operation)
+        return len(operations) >= self.max_batch
+
+    def _take(self):
+        buffers, self._buffers = self._buffers, {}
+        return [(coll, ops) for coll, ops in buffers.values() if ops]
+
+    def _record(self, collection, operations, error=None):
+        if error is None:
+            self.stats["operations"] += len(operations)
+            self.stats["flushes"] += 1
+        elif isinstance(error, BulkWriteError):
+            # Unordered: everything but the failed operations was applied
+            failed = len(error.details.get("writeErrors", []))
+            self.stats["operations"] += len(operations) - failed
+            self.stats["flushes"] += 1
+            self.stats["errors"] += failed
+            logger.error(
+                f"{failed} of {len(operations)} writes to "
+                f"{collection.full_name} failed: {str(error)}"
+            )
+        else:
+            self.stats["errors"] += len(operations)
+            logger.error(
+                f"Bulk write of {len(operations)} operations to "
+                f"{collection.full_name} failed: {str(error)}"
+            )
+
+    def summary(self):
+        return (
+            f"Bulk writes: {self.stats['operations']:,d} operations in "
+            f"{self.stats['flushes']:,d} flushes ({self.stats['errors']:,d} failed)"
+        )
+
+
+class BulkWriter(BufferedWrites):
+    """Write-behind buffer for worker threads.
+
+    Operations are applied with unordered bulk_write once a collection has
+    max_batch of them, and by a background thread at least every max_delay
+    seconds. close() flushes whatever is left.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, collection, operation):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            due = self._append(collection, operation)
+        if due:
+            self.flush()
+
+    def flush(self):
+        # One flush at a time keeps writes of a document in add() order
+        with self._flush_lock:
+            with self._lock:
+                pending = self._take()
+            for collection, operations in pending:
+                try:
+                    collection.bulk_write(operations, ordered=False)
+                    error = None
+                except Exception as e:
+                    error = e
+                with self._lock:
+                    self._record(collection, operations, error)
+
+    def _run(self):
+        while not self._stop.wait(self.max_delay):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+        logger.info(self.summary())
+
+
+class AsyncBulkWriter(BufferedWrites):
+    """Write-behind buffer for asyncio tasks (motor collections)"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._flush_lock = asyncio.Lock()
+        self._stop = asyncio.Event()
+        self._task = None
+
+    async def add(self, collection, operation):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        if self._append(collection, operation):
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            for collection, operations in self._take():
+                try:
+                    await collection.bulk_write(operations, ordered=False)
+                    error = None
+                except Exception as e:
+                    error = e
+                self._record(collection, operations, error)
+
+    async def _run(self):
+        while not self._stop.is_set():
+            try:
+                await asyncio.wait_for(self._stop.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                await self.flush()
+
+    async def close(self):
+        # Stop the timer rather than cancel it so no flush is cut off mid-write
+        self._stop.set()
+        if self._task:
+            await self._task
+            self._task = None
+        await self.flush()
+        logger.info(self.summary())
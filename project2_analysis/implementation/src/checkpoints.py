@@ -0,0 +1,67 @@
+import hashlib
+import json
+from datetime import datetime, timezone
+
+
+def job_checkpoint_key(job_data):
+    """Key of a job's checkpoint, shared by its Faktory retries only.
+
+    The enqueuer gives every push its own enqueue_id, so an identical job
+    pushed again while this one is retried keeps a checkpoint of its own.
+    Jobs enqueued before enqueue_id existed fall back to a hash of the args.
+    """
+    if job_data.get("enqueue_id"):
+        return f"job:{job_data['enqueue_id']}"
+    payload = json.dumps(job_data, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+class JobCheckpoint:
+    """Progress of one job, persisted so a retried job resumes where the
+    previous attempt stopped instead of refetching everything.
+
+    Holds the listing `after` cursor and the ids of posts already stored.
+    Comment-tree frontiers are persisted separately per post (see
+    comment_expansion.py) and resume on their own.
+    """
+
+    def __init__(self, collection, key, state=None):
+        self.collection = collection
+        self.key = key
+        state = state or {}
+        self.after = state.get("after")
+        self.processed_ids = set(state.get("processed_ids", []))
+        self.resumed = bool(state)
+
+    @classmethod
+    def load(cls, collection, job_data):
+        key = job_checkpoint_key(job_data)
+        return cls(collection, key, collection.find_one({"_id": key}))
+
+    def is_processed(self, item_id):
+        return item_id in self.processed_ids
+
+    def record_item(self, item_id):
+        """Mark one post (or other unit of work) as done"""
+        self.processed_ids.add(item_id)
+        self.collection.update_one(
+            {"_id": self.key},
+            {
+                "$addToSet": {"processed_ids": item_id},
+                "$set": {"updated_at": datetime.now(timezone.utc)},
+            },
+            upsert=True,
+        )
+
+    def record_page(self, after):
+        """Advance the listing cursor once every post of a page is stored"""
+        self.after = after
+        self.collection.update_one(
+            {"_id": self.key},
+            {"$set": {"after": after, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+
+    def complete(self):
+        """Drop the checkpoint once the job finished"""
+        self.collection.delete_one({"_id": self.key})
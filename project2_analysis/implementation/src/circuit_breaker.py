@@ -0,0 +1,325 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from config import (
+    BREAKER_WINDOW,
+    BREAKER_MIN_CALLS,
+    BREAKER_FAILURE_RATE,
+    BREAKER_COOLDOWN,
+    BREAKER_MAX_COOLDOWN,
+    BREAKER_PROBE_TIMEOUT,
+    BREAKER_REFRESH_INTERVAL,
+    DEAD_LETTER_REDRIVE_INTERVAL,
+)
+from db import get_mongo_client
+from dead_letters import redrive_dead_letters
+from utils import setup_logger
+
+logger = setup_logger("circuit_breaker")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"  # One process is probing whether the API recovered
+
+BREAKER_NAME = "moderatehatespeech"
+
+
+class CircuitOpenError(Exception):
+    """The detection API is considered down; the call was not made"""
+
+
+class BreakerState:
+    """Failure window of this process and its cached copy of the shared state.
+
+    The breaker itself is one document in CIRCUIT_BREAKER_COLLECTION, so a
+    trip by any worker pauses API calls in all of them. Every transition is
+    an update filtered on the state it leaves, which makes it atomic across
+    processes: only one of them opens the breaker, claims the probe or
+    closes it.
+    """
+
+    def __init__(self, collection, name=BREAKER_NAME):
+        self.collection = collection
+        self.name = name
+        self.shared = {"state": CLOSED}
+        self.refreshed_at = 0.0
+        self.calls = deque()  # (time, succeeded) within BREAKER_WINDOW
+        self.failures = 0
+        self.stats = {"rejected": 0, "trips": 0, "probes": 0, "redrives": 0}
+
+    def _stale(self, now):
+        return now - self.refreshed_at >= BREAKER_REFRESH_INTERVAL
+
+    def _observe(self, succeeded, now):
+        """Record a call; True once the window's failure rate is too high"""
+        self.calls.append((now, succeeded))
+        self.failures += not succeeded
+        while self.calls and self.calls[0][0] < now - BREAKER_WINDOW:
+            _, old = self.calls.popleft()
+            self.failures -= not old
+        return (
+            len(self.calls) >= BREAKER_MIN_CALLS
+            and self.failures / len(self.calls) >= BREAKER_FAILURE_RATE
+        )
+
+    def _reset_window(self):
+        self.calls.clear()
+        self.failures = 0
+
+    def _probe_due(self, now):
+        state = self.shared["state"]
+        return (state == OPEN and self.shared.get("open_until", 0) <= now) or (
+            state == HALF_OPEN and self.shared.get("probe_until", 0) <= now
+        )
+
+    def _paused(self, now):
+        """Whether calls are paused, from the cached state"""
+        return self.shared["state"] != CLOSED and not self._probe_due(now)
+
+    # Filters and updates of the shared transitions
+
+    def _initial(self):
+        return (
+            {"_id": self.name},
+            {
+                "$setOnInsert": {
+                    "state": CLOSED,
+                    "cooldown": BREAKER_COOLDOWN,
+                    "next_redrive_at": 0,
+                }
+            },
+        )
+
+    def _trip(self, now):
+        return (
+            {"_id": self.name, "state": CLOSED},
+            {
+                "$set": {
+                    "state": OPEN,
+                    "opened_at": now,
+                    "open_until": now + BREAKER_COOLDOWN,
+                    "cooldown": BREAKER_COOLDOWN,
+                }
+            },
+        )
+
+    def _claim_probe(self, now):
+        return (
+            {
+                "_id": self.name,
+                "$or": [
+                    {"state": OPEN, "open_until": {"$lte": now}},
+                    {"state": HALF_OPEN, "probe_until": {"$lte": now}},
+                ],
+            },
+            {"$set": {"state": HALF_OPEN, "probe_until": now + BREAKER_PROBE_TIMEOUT}},
+        )
+
+    def _close(self, now):
+        # Parked documents are re-driven as soon as the breaker closes
+        return (
+            {"_id": self.name, "state": HALF_OPEN},
+            {"$set": {"state": CLOSED, "closed_at": now, "next_redrive_at": now}},
+        )
+
+    def _reopen(self, now):
+        cooldown = min(
+            2 * self.shared.get("cooldown", BREAKER_COOLDOWN), BREAKER_MAX_COOLDOWN
+        )
+        return (
+            {"_id": self.name, "state": HALF_OPEN},
+            {
+                "$set": {
+                    "state": OPEN,
+                    "open_until": now + cooldown,
+                    "cooldown": cooldown,
+                }
+            },
+        )
+
+    def _claim_redrive(self, now):
+        return (
+            {"_id": self.name, "state": CLOSED, "next_redrive_at": {"$lte": now}},
+            {"$set": {"next_redrive_at": now + DEAD_LETTER_REDRIVE_INTERVAL}},
+        )
+
+    def summary(self):
+        return (
+            f"Breaker {self.shared['state']}: {self.stats['rejected']:,d} rejected, "
+            f"{self.stats['trips']:,d} trips, {self.stats['probes']:,d} probes, "
+            f"{self.stats['redrives']:,d} re-driven"
+        )
+
+
+class CircuitBreaker(BreakerState):
+    """Shared breaker for worker threads (pymongo collection)"""
+
+    def __init__(self, collection, name=BREAKER_NAME):
+        super().__init__(collection, name)
+        self._lock = threading.Lock()
+
+    def _update(self, transition):
+        query, update = transition
+        return self.collection.update_one(query, update).modified_count == 1
+
+    def _refresh(self, now):
+        """Re-read the shared state; True when this process should re-drive"""
+        shared = self.collection.find_one({"_id": self.name})
+        if not shared:
+            query, update = self._initial()
+            self.collection.update_one(query, update, upsert=True)
+            shared = self.collection.find_one({"_id": self.name})
+        self.shared = shared
+        self.refreshed_at = now
+        return shared["state"] == CLOSED and self._update(self._claim_redrive(now))
+
+    def _redrive(self):
+        # Outside the lock so API calls aren't held up by it
+        try:
+            redriven = redrive_dead_letters(get_mongo_client())
+            with self._lock:
+                self.stats["redrives"] += redriven
+        except Exception as e:
+            logger.error(f"Error re-driving dead letters: {str(e)}")
+
+    def is_open(self):
+        now = time.time()
+        with self._lock:
+            redrive = self._stale(now) and self._refresh(now)
+            paused = self._paused(now)
+        if redrive:
+            self._redrive()
+        return paused
+
+    def allow(self):
+        """Permission for one API call; True when it is the recovery probe.
+
+        Raises CircuitOpenError while the breaker is open.
+        """
+        now = time.time()
+        with self._lock:
+            redrive = self._stale(now) and self._refresh(now)
+            probing = False
+            if self.shared["state"] != CLOSED and self._probe_due(now):
+                probing = self._update(self._claim_probe(now))
+                # Re-read either way so losers stop competing for the probe
+                redrive = self._refresh(now) or redrive
+            rejected = self.shared["state"] != CLOSED and not probing
+            if probing:
+                self.stats["probes"] += 1
+            elif rejected:
+                self.stats["rejected"] += 1
+        if redrive:
+            self._redrive()
+        if rejected:
+            raise CircuitOpenError(f"Circuit breaker {self.name} is open")
+        return probing
+
+    def record(self, succeeded, probing=False):
+        """Outcome of a call made with allow()'s permission"""
+        now = time.time()
+        redrive = False
+        with self._lock:
+            if probing:
+                if succeeded and self._update(self._close(now)):
+                    logger.info(f"Circuit breaker {self.name} closed")
+                    self._reset_window()
+                elif not succeeded and self._update(self._reopen(now)):
+                    logger.warning(f"Probe failed; circuit breaker {self.name} open")
+                redrive = self._refresh(now)
+            elif self._observe(succeeded, now) and self.shared["state"] == CLOSED:
+                if self._update(self._trip(now)):
+                    self.stats["trips"] += 1
+                    logger.warning(
+                        f"Circuit breaker {self.name} open: {self.failures} of "
+                        f"{len(self.calls)} calls failed in {BREAKER_WINDOW}s"
+                    )
+                self._reset_window()
+                self._refresh(now)
+        if redrive:
+            self._redrive()
+
+
+class AsyncCircuitBreaker(BreakerState):
+    """Shared breaker for asyncio tasks (motor collection)"""
+
+    def __init__(self, collection, name=BREAKER_NAME):
+        super().__init__(collection, name)
+        self._lock = asyncio.Lock()
+
+    async def _update(self, transition):
+        query, update = transition
+        result = await self.collection.update_one(query, update)
+        return result.modified_count == 1
+
+    async def _refresh(self, now):
+        shared = await self.collection.find_one({"_id": self.name})
+        if not shared:
+            query, update = self._initial()
+            await self.collection.update_one(query, update, upsert=True)
+            shared = await self.collection.find_one({"_id": self.name})
+        self.shared = shared
+        self.refreshed_at = now
+        return shared["state"] == CLOSED and await self._update(
+            self._claim_redrive(now)
+        )
+
+    async def _redrive(self):
+        try:
+            self.stats["redrives"] += await asyncio.to_thread(
+                redrive_dead_letters, get_mongo_client()
+            )
+        except Exception as e:
+            logger.error(f"Error re-driving dead letters: {str(e)}")
+
+    async def is_open(self):
+        now = time.time()
+        async with self._lock:
+            redrive = self._stale(now) and await self._refresh(now)
+            paused = self._paused(now)
+        if redrive:
+            await self._redrive()
+        return paused
+
+    async def allow(self):
+        now = time.time()
+        async with self._lock:
+            redrive = self._stale(now) and await self._refresh(now)
+            probing = False
+            if self.shared["state"] != CLOSED and self._probe_due(now):
+                probing = await self._update(self._claim_probe(now))
+                redrive = await self._refresh(now) or redrive
+            rejected = self.shared["state"] != CLOSED and not probing
+            if probing:
+                self.stats["probes"] += 1
+            elif rejected:
+                self.stats["rejected"] += 1
+        if redrive:
+            await self._redrive()
+        if rejected:
+            raise CircuitOpenError(f"Circuit breaker {self.name} is open")
+        return probing
+
+    async def record(self, succeeded, probing=False):
+        now = time.time()
+        redrive = False
+        async with self._lock:
+            if probing:
+                if succeeded and await self._update(self._close(now)):
+                    logger.info(f"Circuit breaker {self.name} closed")
+                    self._reset_window()
+                elif not succeeded and await self._update(self._reopen(now)):
+                    logger.warning(f"Probe failed; circuit breaker {self.name} open")
+                redrive = await self._refresh(now)
+            elif self._observe(succeeded, now) and self.shared["state"] == CLOSED:
+                if await self._update(self._trip(now)):
+                    self.stats["trips"] += 1
+                    logger.warning(
+                        f"Circuit breaker {self.name} open: {self.failures} of "
+                        f"{len(self.calls)} calls failed in {BREAKER_WINDOW}s"
+                    )
+                self._reset_window()
+                await self._refresh(now)
+        if redrive:
+            await self._redrive()
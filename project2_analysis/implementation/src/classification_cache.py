@@ -0,0 +1,162 @@
+import hashlib
+import html
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from config import CLASSIFICATION_CACHE_SIZE
+from utils import setup_logger
+
+logger = setup_logger("classification_cache")
+
+# Only the verdict is cached; analyzed_at is stamped when a hit is served
+CACHED_FIELDS = ("class", "confidence")
+
+
+def normalize_text(text):
+    """Collapse the differences that don't change what a text says"""
+    text = html.unescape(text or "")
+    return " ".join(text.split()).casefold()
+
+
+def text_key(text):
+    """Cache key of a text: hash of its normalized form"""
+    return hashlib.sha1(normalize_text(text).encode()).hexdigest()
+
+
+class ClassificationCache:
+    """Hate speech verdicts by text hash: an in-process LRU in front of a
+    Mongo collection shared by every detector (Reddit and 4chan).
+
+    Copypasta, repeated bot comments and identical replies are classified
+    once; every later copy is answered without an API call.
+    """
+
+    def __init__(self, collection, max_entries=CLASSIFICATION_CACHE_SIZE):
+        self.collection = collection
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "stored": 0}
+
+    def _get_local(self, key):
+        with self._lock:
+            verdict = self._entries.get(key)
+            if verdict is not None:
+                self._entries.move_to_end(key)
+            return verdict
+
+    def _put_local(self, key, verdict):
+        with self._lock:
+            self._entries[key] = verdict
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    @staticmethod
+    def _serve(verdict):
+        return {
+            **verdict,
+            "analyzed_at": datetime.utcnow().timestamp(),
+            "source": "cache",
+        }
+
+    @staticmethod
+    def _document(result):
+        return {
+            "$setOnInsert": {
+                "verdict": {field: result.get(field) for field in CACHED_FIELDS},
+                "created_at": datetime.now(timezone.utc),
+            }
+        }
+
+    def get(self, text):
+        """Return the cached result for text, or None on a miss"""
+        key = text_key(text)
+        verdict = self._get_local(key)
+        if verdict is not None:
+            self._count("memory_hits")
+            return self._serve(verdict)
+
+        try:
+            doc = self.collection.find_one({"_id": key}, {"verdict": 1})
+        except Exception as e:
+            logger.error(f"Error reading classification cache: {str(e)}")
+            doc = None
+
+        if doc:
+            self._put_local(key, doc["verdict"])
+            self._count("db_hits")
+            return self._serve(doc["verdict"])
+
+        self._count("misses")
+        return None
+
+    def put(self, text, result):
+        """Remember a successful API result; failures are never cached"""
+        if not result:
+            return
+        key = text_key(text)
+        self._put_local(key, {field: result.get(field) for field in CACHED_FIELDS})
+        try:
+            self.collection.update_one({"_id": key}, self._document(result), upsert=True)
+            self._count("stored")
+        except Exception as e:
+            logger.error(f"Error writing classification cache: {str(e)}")
+
+    @property
+    def hit_rate(self):
+        with self._lock:
+            hits = self.stats["memory_hits"] + self.stats["db_hits"]
+            lookups = hits + self.stats["misses"]
+        return hits / lookups if lookups else 0.0
+
+    def summary(self):
+        """One-line hit-rate report for progress logs"""
+        return (
+            f"Cache hit rate: {self.hit_rate:.1%} "
+            f"(memory {self.stats['memory_hits']:,d}, "
+            f"db {self.stats['db_hits']:,d}, "
+            f"misses {self.stats['misses']:,d})"
+        )
+
+
+class AsyncClassificationCache(ClassificationCache):
+    """ClassificationCache backed by a motor collection"""
+
+    async def get(self, text):
+        key = text_key(text)
+        verdict = self._get_local(key)
+        if verdict is not None:
+            self._count("memory_hits")
+            return self._serve(verdict)
+
+        try:
+            doc = await self.collection.find_one({"_id": key}, {"verdict": 1})
+        except Exception as e:
+            logger.error(f"Error reading classification cache: {str(e)}")
+            doc = None
+
+        if doc:
+            self._put_local(key, doc["verdict"])
+            self._count("db_hits")
+            return self._serve(doc["verdict"])
+
+        self._count("misses")
+        return None
+
+    async def put(self, text, result):
+        if not result:
+            return
+        key = text_key(text)
+        self._put_local(key, {field: result.get(field) for field in CACHED_FIELDS})
+        try:
+            await self.collection.update_one(
+                {"_id": key}, self._document(result), upsert=True
+            )
+            self._count("stored")
+        except Exception as e:
+            logger.error(f"Error writing classification cache: {str(e)}")
@@ -0,0 +1,133 @@
+import heapq
+from datetime import datetime, timezone
+from config import MORECHILDREN_REQUEST_BUDGET
+
+MORECHILDREN_BATCH_SIZE = 100  # Max ids Reddit accepts per morechildren call
+
+
+class MoreChildrenExpander:
+    """Breadth-first frontier of `more` stubs for one post.
+
+    Stubs are expanded shallowest first and, at equal depth, below the
+    highest-scoring parent first. Every requested id is remembered so no id is
+    fetched twice, and the number of morechildren calls is capped by a per-post
+    budget. Whatever is left when the budget runs out can be exported and
+    resumed by a later job.
+
+    A requested batch counts as done only once its comments are stored:
+    until stored() is called after a write, exported state still lists it
+    as pending, so a crash before the write re-requests it on resume.
+    """
+
+    def __init__(self, budget=MORECHILDREN_REQUEST_BUDGET, state=None):
+        self.budget = budget
+        self.requests_made = 0
+        self.visited = set()
+        self._frontier = []
+        self._sequence = 0
+        self._in_flight = []  # (depth, parent score, ids) still being yielded
+        self._fetched = []  # Batches fully yielded, not yet stored
+
+        if state:
+            self.visited.update(state.get("visited", []))
+            for depth, parent_score, ids in state.get("frontier", []):
+                self.add_stub(ids, depth, parent_score)
+
+    def add_stub(self, ids, depth=0, parent_score=0):
+        """Queue the child ids of a `more` stub"""
+        ids = [i for i in ids if i not in self.visited]
+        if not ids:
+            return
+        heapq.heappush(self._frontier, (depth, -parent_score, self._sequence, ids))
+        self._sequence += 1
+
+    @property
+    def has_pending(self):
+        return bool(self._in_flight or self._fetched) or any(
+            i not in self.visited for entry in self._frontier for i in entry[3]
+        )
+
+    @property
+    def budget_exhausted(self):
+        return self.requests_made >= self.budget
+
+    def next_batch(self):
+        """Take the next ids to request, or None when done or out of budget"""
+        if self.budget_exhausted:
+            return None
+
+        batch = []
+        taken = set()
+        batch_depth, batch_score = None, 0
+        while self._frontier and len(batch) < MORECHILDREN_BATCH_SIZE:
+            depth, negative_score, sequence, ids = heapq.heappop(self._frontier)
+            if batch_depth is None:
+                batch_depth, batch_score = depth, -negative_score
+            fresh = [i for i in ids if i not in self.visited and i not in taken]
+            room = MORECHILDREN_BATCH_SIZE - len(batch)
+            batch.extend(fresh[:room])
+            taken.update(fresh[:room])
+            if fresh[room:]:
+                heapq.heappush(
+                    self._frontier, (depth, negative_score, sequence, fresh[room:])
+                )
+
+        if not batch:
+            return None
+
+        self.visited.update(batch)
+        self.requests_made += 1
+        self._in_flight.append((batch_depth, batch_score, batch))
+        return batch
+
+    def _untrack(self, batch):
+        self._in_flight = [entry for entry in self._in_flight if entry[2] != batch]
+
+    def release(self, batch, depth=0):
+        """Return ids of a failed request to the frontier"""
+        self._untrack(batch)
+        self.visited.difference_update(batch)
+        self.add_stub(batch, depth)
+
+    def fetched(self, batch):
+        """Every comment of a requested batch has been yielded"""
+        for entry in self._in_flight:
+            if entry[2] == batch:
+                self._fetched.append(entry)
+        self._untrack(batch)
+
+    def stored(self):
+        """Comments yielded so far are written; their batches are done"""
+        self._fetched = []
+
+    def export_state(self):
+        """Serializable snapshot of the remaining frontier and requested ids.
+
+        Batches whose comments aren't stored yet are exported as frontier
+        entries again, not as visited.
+        """
+        unstored = self._in_flight + self._fetched
+        unstored_ids = {i for _, _, ids in unstored for i in ids}
+        visited = self.visited - unstored_ids
+        frontier = [
+            [depth, -negative_score, [i for i in ids if i not in visited]]
+            for depth, negative_score, _, ids in sorted(self._frontier)
+        ]
+        frontier += [[depth, score, list(ids)] for depth, score, ids in unstored]
+        return {"frontier": frontier, "visited": list(visited)}
+
+
+def load_comment_expander(expansions_collection, post_id):
+    """Resume a post's partially expanded comment tree, if one was saved"""
+    saved = expansions_collection.find_one({"_id": post_id})
+    return MoreChildrenExpander(state=saved)
+
+
+def save_comment_expander(expansions_collection, post_id, expander):
+    """Persist the remaining frontier, or clear it once the tree is complete"""
+    if expander.has_pending:
+        state = expander.export_state()
+        state["updated_at"] = datetime.now(timezone.utc)  # TTL needs a date
+        expansions_collection.replace_one({"_id": post_id}, state, upsert=True)
+    else:
+        expansions_collection.delete_one({"_id": post_id})
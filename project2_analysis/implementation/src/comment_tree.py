@@ -0,0 +1,150 @@
+import re
+
+PATH_SEPARATOR = "/"
+
+
+class CommentTree:
+    """Array-backed tree of one post's comments, built from parent_id in a
+    single pass as comments stream in.
+
+    Only ids, parent positions, depths and materialized paths are kept, so the
+    tree stays small even for megathreads. A path is the chain of comment ids
+    from the root comment down to the comment itself, e.g. "abc/def/ghi".
+    A comment whose ancestors are unknown gets a partial path starting at its
+    parent, flagged incomplete, which its replies inherit.
+    """
+
+    def __init__(self, post_id):
+        self.post_fullname = f"t3_{post_id}"
+        self.ids = []
+        self.parents = []  # Position of the parent comment, -1 for root comments
+        self.depths = []
+        self.paths = []
+        self.complete = []  # Whether the path reaches up to a root comment
+        self._positions = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _append(self, comment_id, parent_position, path, depth, complete):
+        self._positions[comment_id] = len(self.ids)
+        self.ids.append(comment_id)
+        self.parents.append(parent_position)
+        self.depths.append(depth)
+        self.paths.append(path)
+        self.complete.append(complete)
+        return path, depth, complete
+
+    def get(self, comment_id):
+        """Return (path, depth, complete) for a comment in the tree, else None"""
+        position = self._positions.get(comment_id)
+        if position is None:
+            return None
+        return (
+            self.paths[position],
+            self.depths[position],
+            self.complete[position],
+        )
+
+    def add(self, comment_id, parent_fullname):
+        """Place a comment under its parent, returning (path, depth, complete).
+
+        Returns None when the parent comment has not been seen yet; the caller
+        then resolves it with add_orphan.
+        """
+        known = self.get(comment_id)
+        if known:
+            return known
+
+        if not parent_fullname or parent_fullname == self.post_fullname:
+            return self._append(comment_id, -1, comment_id, 0, True)
+
+        parent_id = parent_fullname.split("_", 1)[-1]
+        parent_position = self._positions.get(parent_id)
+        if parent_position is None:
+            return None
+
+        return self._append(
+            comment_id,
+            parent_position,
+            f"{self.paths[parent_position]}{PATH_SEPARATOR}{comment_id}",
+            self.depths[parent_position] + 1,
+            self.complete[parent_position],
+        )
+
+    def add_orphan(self, comment_id, parent_id, depth, parent_path=None, complete=True):
+        """Place a comment whose parent is outside the tree (e.g. stored by an
+        earlier job).
+
+        depth is taken as given. Without a known parent path the path only
+        starts at the parent and is marked incomplete; it is not a root.
+        """
+        if parent_path is None:
+            parent_path, complete = parent_id, False
+
+        return self._append(
+            comment_id,
+            -1,
+            f"{parent_path}{PATH_SEPARATOR}{comment_id}",
+            depth,
+            complete,
+        )
+
+
+def subtree_query(path, include_root=False):
+    """Mongo filter matching every descendant of the comment at path.
+
+    Replies stored with an incomplete path (path_complete False) only match
+    the partial path they were given.
+    """
+    prefix = {"path": {"$regex": f"^{re.escape(path + PATH_SEPARATOR)}"}}
+    if include_root:
+        return {"$or": [{"path": path}, prefix]}
+    return prefix
+
+
+def count_subtree(comments_collection, comment_id):
+    """Number of replies below a comment, via one indexed prefix query"""
+    comment = comments_collection.find_one({"id": comment_id}, {"path": 1})
+    if not comment or not comment.get("path"):
+        return 0
+    return comments_collection.count_documents(subtree_query(comment["path"]))
+
+
+def cascade_sizes(comments_collection, post_id):
+    """Size and depth of every root-level cascade in a post's comment tree"""
+    pipeline = [
+        {
+            "$match": {
+                "post_id": post_id,
+                "path": {"$exists": True},
+                # Incomplete paths don't start at a root comment
+                "path_complete": {"$ne": False},
+            }
+        },
+        {
+            "$group": {
+                "_id": {
+                    "$arrayElemAt": [{"$split": ["$path", PATH_SEPARATOR]}, 0]
+                },
+                "size": {"$sum": 1},
+                "max_depth": {"$max": "$depth"},
+            }
+        },
+        {"$sort": {"size": -1}},
+        {"$project": {"_id": 0, "root_id": "$_id", "size": 1, "max_depth": 1}},
+    ]
+    return list(comments_collection.aggregate(pipeline))
+
+
+def depth_distribution(comments_collection, post_id=None):
+    """Comment counts per depth, for one post or across the collection"""
+    pipeline = []
+    if post_id:
+        pipeline.append({"$match": {"post_id": post_id}})
+    pipeline += [
+        {"$group": {"_id": "$depth", "count": {"$sum": 1}}},
+        {"$sort": {"_id": 1}},
+        {"$project": {"_id": 0, "depth": "$_id", "count": 1}},
+    ]
+    return list(comments_collection.aggregate(pipeline))
@@ -0,0 +1,181 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from config import (
+    HATE_SPEECH_MIN_CONCURRENCY,
+    HATE_SPEECH_MAX_CONCURRENCY,
+    HATE_SPEECH_INITIAL_CONCURRENCY,
+    HATE_SPEECH_LATENCY_TOLERANCE,
+)
+
+THROUGHPUT_WINDOW = 60  # Seconds of completions behind the throughput figure
+LATENCY_SMOOTHING = 0.1  # EWMA weight of the newest sample
+LATENCY_BASELINE_WINDOW = 120  # Seconds the best latency is remembered for
+
+
+class Slot:
+    """One in-flight call; mark it throttled on 429s and failed on 5xx"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.congested = False
+        self.errored = False
+
+    def throttled(self):
+        self.congested = True
+
+    def server_error(self):
+        self.errored = True
+
+
+class AIMDController:
+    """Additive-increase / multiplicative-decrease concurrency limit.
+
+    Each successful call grows the limit by 1/limit, i.e. by one per full
+    window of calls. A 429, 5xx, timeout or other failed call halves it, at
+    most once per smoothed round trip so a burst of throttled in-flight
+    calls counts as one signal. Latency rising past
+    HATE_SPEECH_LATENCY_TOLERANCE times its lowest value of the last
+    LATENCY_BASELINE_WINDOW seconds stops growth and gently shrinks the
+    limit before the API starts refusing calls. The baseline is smoothed and
+    windowed so one unusually fast reply can't pin the limit at its minimum.
+
+    Holds no locks; the thread and asyncio limiters below serialize access.
+    """
+
+    def __init__(
+        self,
+        initial=HATE_SPEECH_INITIAL_CONCURRENCY,
+        min_limit=HATE_SPEECH_MIN_CONCURRENCY,
+        max_limit=HATE_SPEECH_MAX_CONCURRENCY,
+        latency_tolerance=HATE_SPEECH_LATENCY_TOLERANCE,
+        backoff=0.5,
+    ):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.in_flight = 0
+        self.smoothed_latency = None
+        self.recent_latencies = deque()  # (time, latency), latencies ascending
+        self.last_decrease = 0.0
+        self.completions = deque()
+        self.throttled = 0
+
+    def has_capacity(self):
+        return self.in_flight < int(self.limit)
+
+    def on_start(self):
+        self.in_flight += 1
+
+    def on_finish(self, slot, failed):
+        now = time.monotonic()
+        latency = now - slot.started
+        self.in_flight -= 1
+
+        if failed or slot.congested or slot.errored:
+            self.throttled += 1
+            self._decrease(now, self.backoff)
+            return
+
+        self.completions.append(now)
+        while self.completions and self.completions[0] < now - THROUGHPUT_WINDOW:
+            self.completions.popleft()
+
+        if self.smoothed_latency is None:
+            self.smoothed_latency = latency
+        else:
+            self.smoothed_latency += LATENCY_SMOOTHING * (
+                latency - self.smoothed_latency
+            )
+        baseline = self._baseline(now, self.smoothed_latency)
+        if self.smoothed_latency > baseline * self.latency_tolerance:
+            self._decrease(now, 0.9)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def _baseline(self, now, latency):
+        """Lowest smoothed latency of the last LATENCY_BASELINE_WINDOW seconds"""
+        recent = self.recent_latencies
+        while recent and recent[-1][1] >= latency:
+            recent.pop()
+        recent.append((now, latency))
+        while recent[0][0] < now - LATENCY_BASELINE_WINDOW:
+            recent.popleft()
+        return recent[0][1]
+
+    def _decrease(self, now, factor):
+        if now - self.last_decrease < (self.smoothed_latency or 1.0):
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * factor)
+
+    @property
+    def throughput(self):
+        """Successful calls per second over the last THROUGHPUT_WINDOW"""
+        now = time.monotonic()
+        recent = [t for t in self.completions if t >= now - THROUGHPUT_WINDOW]
+        if not recent:
+            return 0.0
+        return len(recent) / max(now - recent[0], 1.0)
+
+    def summary(self):
+        latency = self.smoothed_latency or 0.0
+        return (
+            f"Concurrency limit: {int(self.limit)} "
+            f"(in flight {self.in_flight}, {self.throughput:.2f} calls/sec, "
+            f"latency {latency:.2f}s, throttled {self.throttled:,d})"
+        )
+
+
+class ConcurrencyLimiter(AIMDController):
+    """AIMD limit shared by every thread of a process"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self._condition:
+            self._condition.wait_for(self.has_capacity)
+            self.on_start()
+        slot = Slot()
+        failed = False
+        try:
+            yield slot
+        except Exception:
+            failed = True
+            raise
+        finally:
+            with self._condition:
+                self.on_finish(slot, failed)
+                self._condition.notify_all()
+
+
+class AsyncConcurrencyLimiter(AIMDController):
+    """AIMD limit shared by every task of an event loop"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self._condition:
+            await self._condition.wait_for(self.has_capacity)
+            self.on_start()
+        slot = Slot()
+        failed = False
+        try:
+            yield slot
+        except Exception:
+            failed = True
+            raise
+        finally:
+            async with self._condition:
+                self.on_finish(slot, failed)
+                self._condition.notify_all()
@@ -1,4 +1,5 @@
 import os
+import socket
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,23 +14,88 @@ REDDIT_REDIRECT_URI = os.getenv("REDDIT_REDIRECT_URI")
 
 MODERATE_API_KEY = os.getenv("MODERATE_API_KEY")
 
-# Subreddits to monitor
-SUBREDDITS = ["politics"]
+# Hate speech detection jobs
+HATE_SPEECH_JOB_BATCH_SIZE = 50  # Documents per Faktory job
+HATE_SPEECH_CLASSIFY_THREADS = 32  # Upper bound; the AIMD limiter sets the pace
+HATE_SPEECH_MIN_CONCURRENCY = 1  # AIMD limit on concurrent API calls per worker
+HATE_SPEECH_MAX_CONCURRENCY = 32
+HATE_SPEECH_INITIAL_CONCURRENCY = 8
+HATE_SPEECH_LATENCY_TOLERANCE = 2.0  # Back off once latency doubles its best
+BULK_WRITE_BATCH_SIZE = 500  # Buffered result writes per bulk_write
+BULK_WRITE_MAX_DELAY = 2  # Seconds a buffered result may wait to be written
+# "poll" queries for unanalyzed content, "stream" tails change streams
+HATE_SPEECH_ENQUEUE_MODE = os.getenv("HATE_SPEECH_ENQUEUE_MODE", "poll")
+CHANGE_STREAM_STATE_COLLECTION = "change_stream_state"  # Resume tokens
+CHANGE_STREAM_SWEEP_INTERVAL = 600  # Seconds between sweeps for missed documents
+ANALYSIS_LEASE_SECONDS = 900  # Claimed documents return to the pool after this
+ANALYSIS_MAX_ATTEMPTS = 3  # Failed API calls before a document is marked failed
+ANALYSIS_RETRY_DELAY = 300  # Seconds before a failed document is retried
+CLASSIFICATION_CACHE_COLLECTION = "classification_cache"  # In MONGODB_DB
+CLASSIFICATION_CACHE_SIZE = 100000  # In-process LRU entries
+CLASSIFICATION_CACHE_TTL = 30 * 24 * 3600  # Re-classify texts after 30 days
+CIRCUIT_BREAKER_COLLECTION = "circuit_breakers"  # Shared breaker state
+BREAKER_WINDOW = 30  # Seconds of API calls the failure rate is measured over
+BREAKER_MIN_CALLS = 20  # Calls in the window before the breaker may open
+BREAKER_FAILURE_RATE = 0.5  # Failed share of calls that opens the breaker
+BREAKER_COOLDOWN = 30  # Seconds open before a probe; doubles per failed probe
+BREAKER_MAX_COOLDOWN = 600
+BREAKER_PROBE_TIMEOUT = 60  # A probe never reported back is retried after this
+BREAKER_REFRESH_INTERVAL = 2  # Seconds each process caches the shared state
+DEAD_LETTER_COLLECTION = "detection_dead_letters"  # Parked failed documents
+DEAD_LETTER_REDRIVE_INTERVAL = 60  # Seconds between re-drives while closed
+DEAD_LETTER_REDRIVE_BATCH = 5000  # Entries re-driven per run
+DEAD_LETTER_MAX_REDRIVES = 3  # Later re-drives only with dead_letters.py redrive
+
+# Unified async detection service (src/detection_service.py)
+DETECTION_SERVICE_SOURCES = os.getenv(
+    "DETECTION_SERVICE_SOURCES", "post,comment,4chan_post"
+).split(",")
+DETECTION_CLAIM_BATCH_SIZE = 100  # Documents leased per source per claim
+DETECTION_IDLE_POLL_INTERVAL = 5  # Seconds before re-polling a drained source
+
+# Subreddits to monitor (comma-separated SUBREDDITS env var overrides)
+SUBREDDITS = [
+    s.strip() for s in os.getenv("SUBREDDITS", "politics").split(",") if s.strip()
+]
+
+# Multi-subreddit crawl scheduling
+SUBREDDIT_ACTIVITY_COLLECTION = "subreddit_activity"
+SUBREDDIT_MIN_POLL_INTERVAL = 120  # Busiest subreddits
+SUBREDDIT_MAX_POLL_INTERVAL = 6 * 3600  # Quietest subreddits
+SUBREDDIT_LIVE_JOB_TIMEOUT = 3600  # Poll again if a live job has not finished by then
+SUBREDDIT_POSTS_PER_POLL = 25  # Aim for about this many new posts per poll
+MULTI_LISTING_MAX_POSTS = 300  # Expected posts per multi-subreddit job (3 pages)
+MULTI_LISTING_MAX_SUBREDDITS = 50  # Keeps /r/a+b+.../new URLs short
 
 # Faktory configuration
 FAKTORY_URL = os.getenv("FAKTORY_URL")
 
+# Worker node partitioning
+WORKER_NODE_ID = os.getenv("WORKER_NODE_ID", socket.gethostname())
+WORKER_NODES_COLLECTION = "worker_nodes"
+NODE_HEARTBEAT_INTERVAL = 30
+NODE_LIVENESS_TIMEOUT = 90  # Nodes silent for longer leave the hash ring
+PARTITION_VNODES = 64  # Virtual nodes per worker node on the ring
+
 # MongoDB configuration
 MONGODB_URI = os.getenv("MONGODB_URI")
 MONGODB_DB = "crawler4Reddit"
 MONGODB_COLLECTION = "posts"
 COMMENTS_COLLECTION = "comments"
+POST_HISTORY_COLLECTION = "post_history"  # Time-series, metaField post_id
+COMMENT_EXPANSIONS_COLLECTION = "comment_expansions"  # Resumable morechildren state
+MORECHILDREN_REQUEST_BUDGET = 50  # Max morechildren calls per post per job
+JOB_CHECKPOINTS_COLLECTION = "job_checkpoints"  # Progress of running jobs
 COMMENT_BATCH_SIZE = 100
+COMMENT_FINGERPRINT_CACHE_SIZE = 200000  # Comment ids kept in the in-process LRU
 
 # Rate limiting
 REQUESTS_PER_MINUTE = 99
 REQUESTS_PER_MINUTE_COMMENTS = 90
 
+# HTTP connection pooling
+HTTP_POOL_SIZE = 20
+
 # 4chan configuration
 BOARDS = ["pol", "b"]
 MEDIA_DIR = "4chan_media"
@@ -37,7 +103,78 @@ MEDIA_DIR = "4chan_media"
 FOURCHAN_BOARDS_DB = "crawler_4chan"
 FOURCHAN_BOARDS_COLLECTION = "threads"
 
+FOURCHAN_DB = "crawler_4chan_v2"
+FOURCHAN_THREADS_COLLECTION = "threads"
+FOURCHAN_POSTS_COLLECTION = "posts"
+
+# Bookkeeping collection for schema/index manifest versions
+SCHEMA_VERSIONS_COLLECTION = "schema_versions"
+
+# Content classified for hate speech: job content type -> (db, collection, key)
+HATE_SPEECH_CONTENT_SOURCES = {
+    "post": (MONGODB_DB, MONGODB_COLLECTION, "id"),
+    "comment": (MONGODB_DB, COMMENTS_COLLECTION, "id"),
+    "4chan_post": (FOURCHAN_DB, FOURCHAN_POSTS_COLLECTION, "_id"),
+}
+
 # Logging
 LOG_DIR = "logs"
 if not os.path.exists(LOG_DIR):
     os.makedirs(LOG_DIR)
+
+# Small state files shared between worker processes on the same host
+STATE_DIR = os.getenv("STATE_DIR", "state")
+if not os.path.exists(STATE_DIR):
+    os.makedirs(STATE_DIR)
+
+# Shared Reddit rate limiter state
+REDDIT_RATE_LIMIT_FILE = os.path.join(STATE_DIR, "reddit_rate_limit.json")
+REDDIT_RATE_LIMIT_RESERVE = 2  # Requests kept in hand for clock skew
+REDDIT_WORKER_CONCURRENCY = int(os.getenv("REDDIT_WORKER_CONCURRENCY", "4"))
+
+# Reddit rate budget split between job classes
+REDDIT_BUDGET_FILE = os.path.join(STATE_DIR, "reddit_budget.json")
+REDDIT_JOB_QUEUES = {
+    "live": "reddit_live_queue",  # Chunks covering the last few hours
+    "refresh": "reddit_refresh_queue",  # Re-fetching known posts
+    "backfill": "reddit_backfill_queue",  # Older chunks
+}
+REDDIT_BUDGET_WEIGHTS = {"live": 0.5, "refresh": 0.3, "backfill": 0.2}
+REDDIT_LIVE_WINDOW = 6 * 3600  # Chunks ending within this many seconds are live
+REDDIT_LIVE_RESERVED_SLOTS = 1  # Consumer slots other job classes never take
+REDDIT_LEGACY_QUEUE = "reddit_refresh_queue2"  # Drained after the class queues
+
+# Reddit OAuth token cache
+REDDIT_TOKEN_CACHE_FILE = os.path.join(STATE_DIR, "reddit_token.json")
+REDDIT_TOKEN_REFRESH_MARGIN = 300  # Refresh 5 minutes before expiry
+
+# Optional local pre-filter in front of the hate speech API (src/prefilter.py)
+PREFILTER_ENABLED = os.getenv("PREFILTER_ENABLED", "false").lower() == "true"
+PREFILTER_MODEL_FILE = os.getenv(
+    "PREFILTER_MODEL_FILE", os.path.join(STATE_DIR, "prefilter_model.json")
+)
+PREFILTER_LEXICON_FILE = os.getenv(
+    "PREFILTER_LEXICON_FILE", os.path.join(STATE_DIR, "prefilter_lexicon.txt")
+)
+PREFILTER_HASH_BUCKETS = 2**18
+PREFILTER_NORMAL_THRESHOLD = 0.02  # Max hate probability labelled locally
+PREFILTER_AUDIT_RATE = 0.05  # Share of local labels still checked by the API
+PREFILTER_TRAIN_LIMIT = 200000  # Labelled texts read per collection
+
+# Sampling-based toxicity estimation (src/toxicity_sampling.py)
+# Communities whose content is only sampled, as platform:name (e.g. 4chan:b)
+SAMPLED_COMMUNITIES = {
+    s.strip().lower() for s in os.getenv("SAMPLED_COMMUNITIES", "").split(",") if s
+}
+SAMPLING_MARGIN_OF_ERROR = 0.05  # Target CI half-width of a community's daily rate
+SAMPLING_CONFIDENCE_Z = 1.96  # 95% confidence intervals
+SAMPLING_MIN_PER_STRATUM = 2  # An hourly stratum needs two items for a variance
+SAMPLING_SETTLE_DELAY = 6 * 3600  # Days are drawn this long after they end (UTC)
+TOXICITY_SAMPLES_COLLECTION = "toxicity_samples"  # In MONGODB_DB
+TOXICITY_ESTIMATES_COLLECTION = "toxicity_estimates"
+
+# Hourly toxicity rollups, swept from newly classified documents
+TOXICITY_ROLLUPS_COLLECTION = "toxicity_rollups"  # In MONGODB_DB
+ROLLUP_BATCH_SIZE = 1000  # Classified documents claimed per rollup sweep
+ROLLUP_SWEEP_INTERVAL = 30  # Seconds between sweeps of the async detectors
+ROLLUP_CLAIM_TIMEOUT = 600  # Seconds before a dead sweep's batch is claimed again
@@ -0,0 +1,25 @@
+import os
+import threading
+from pymongo import MongoClient
+from config import MONGODB_URI
+
+_mongo_client = None
+_mongo_client_pid = None
+_mongo_client_lock = threading.Lock()
+
+
+def get_mongo_client():
+    """Return the process-wide MongoClient, creating it on first use.
+
+    MongoClient is thread-safe and owns its own connection pool, so every job
+    handled by a worker process shares one client instead of paying for a new
+    pool and server discovery per job. A client is not fork-safe, so job
+    processes forked from a worker that already opened one open their own.
+    """
+    global _mongo_client, _mongo_client_pid
+
+    with _mongo_client_lock:
+        if _mongo_client is None or _mongo_client_pid != os.getpid():
+            _mongo_client = MongoClient(MONGODB_URI, serverSelectionTimeoutMS=5000)
+            _mongo_client_pid = os.getpid()
+        return _mongo_client
@@ -0,0 +1,139 @@
+import sys
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from pymongo import UpdateOne
+from config import (
+    MONGODB_DB,
+    HATE_SPEECH_CONTENT_SOURCES,
+    BULK_WRITE_MAX_DELAY,
+    DEAD_LETTER_COLLECTION,
+    DEAD_LETTER_REDRIVE_BATCH,
+    DEAD_LETTER_MAX_REDRIVES,
+)
+from analysis_state import FAILED, PENDING
+from db import get_mongo_client
+from utils import setup_logger
+
+logger = setup_logger("dead_letters")
+
+PARKED = "parked"
+REDRIVEN = "redriven"
+
+
+def dead_letter_operation(content_type, content_id, update):
+    """Dead-letter entry for a document whose result update parks it.
+
+    Returns None unless the update leaves the document failed. Entries are
+    keyed by document, so parking it again keeps its re-drive count.
+    """
+    if update.get("analysis_state") != FAILED:
+        return None
+    return UpdateOne(
+        {"_id": f"{content_type}:{content_id}"},
+        {
+            "$set": {
+                "content_type": content_type,
+                "content_id": content_id,
+                "state": PARKED,
+                "reason": update.get("analysis_skipped_reason"),
+                "parked_at": datetime.now(timezone.utc),
+            },
+            "$unset": {"redriven_at": ""},
+            "$setOnInsert": {"redrives": 0},
+        },
+        upsert=True,
+    )
+
+
+def redrive_dead_letters(
+    client, limit=DEAD_LETTER_REDRIVE_BATCH, max_redrives=DEAD_LETTER_MAX_REDRIVES
+):
+    """Return parked documents to pending for another round of attempts.
+
+    Entries are buffered like results, so ones younger than a couple of
+    flush delays are left for the next run: their document may not be
+    marked failed yet. Returns the number of entries handled.
+    """
+    dead_letters = client[MONGODB_DB][DEAD_LETTER_COLLECTION]
+    now = datetime.now(timezone.utc)
+    query = {
+        "state": PARKED,
+        "parked_at": {"$lt": now - timedelta(seconds=2 * BULK_WRITE_MAX_DELAY)},
+    }
+    if max_redrives is not None:
+        query["redrives"] = {"$lt": max_redrives}
+    entries = list(
+        dead_letters.find(query, {"content_type": 1, "content_id": 1}).limit(limit)
+    )
+    if not entries:
+        return 0
+
+    by_type = defaultdict(list)
+    for entry in entries:
+        by_type[entry["content_type"]].append(entry["content_id"])
+
+    redriven = 0
+    for content_type, content_ids in by_type.items():
+        db_name, collection_name, key = HATE_SPEECH_CONTENT_SOURCES[content_type]
+        result = client[db_name][collection_name].update_many(
+            {key: {"$in": content_ids}, "analysis_state": FAILED},
+            {
+                "$set": {
+                    "analysis_state": PENDING,
+                    "lease_expires_at": 0,
+                    "analysis_attempts": 0,
+                }
+            },
+        )
+        redriven += result.modified_count
+
+    dead_letters.update_many(
+        {"_id": {"$in": [entry["_id"] for entry in entries]}},
+        {"$set": {"state": REDRIVEN, "redriven_at": now}, "$inc": {"redrives": 1}},
+    )
+    logger.info(f"Re-drove {redriven:,d} of {len(entries):,d} parked documents")
+    return len(entries)
+
+
+def report():
+    """Parked documents per content type and reason"""
+    dead_letters = get_mongo_client()[MONGODB_DB][DEAD_LETTER_COLLECTION]
+    pipeline = [
+        {"$match": {"state": PARKED}},
+        {
+            "$group": {
+                "_id": {"content_type": "$content_type", "reason": "$reason"},
+                "count": {"$sum": 1},
+                "oldest": {"$min": "$parked_at"},
+            }
+        },
+    ]
+    rows = list(dead_letters.aggregate(pipeline))
+    if not rows:
+        logger.info("No parked documents")
+    for row in rows:
+        logger.info(
+            f"{row['_id']['content_type']} ({row['_id']['reason']}): "
+            f"{row['count']:,d} parked, oldest {row['oldest']:%Y-%m-%d %H:%M}"
+        )
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else "report"
+    try:
+        if command == "report":
+            report()
+        elif command == "redrive":
+            # Manual re-drive ignores DEAD_LETTER_MAX_REDRIVES
+            client = get_mongo_client()
+            while redrive_dead_letters(client, max_redrives=None):
+                pass
+        else:
+            logger.error(f"Unknown command {command}; use report or redrive")
+    except Exception as e:
+        logger.error(f"Dead letter {command} failed: {str(e)}")
+        raise
+
+
+if __name__ == "__main__":
+    main()
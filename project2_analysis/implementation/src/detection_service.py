@@ -0,0 +1,310 @@
+import asyncio
+import signal
+import time
+from collections import deque
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from config import (
+    MONGODB_URI,
+    MONGODB_DB,
+    MODERATE_API_KEY,
+    CLASSIFICATION_CACHE_COLLECTION,
+    HATE_SPEECH_MAX_CONCURRENCY,
+    HATE_SPEECH_CONTENT_SOURCES,
+    DETECTION_SERVICE_SOURCES,
+    DETECTION_CLAIM_BATCH_SIZE,
+    DETECTION_IDLE_POLL_INTERVAL,
+    CIRCUIT_BREAKER_COLLECTION,
+    DEAD_LETTER_COLLECTION,
+    BREAKER_REFRESH_INTERVAL,
+)
+from analysis_state import (
+    PARKED_STATE,
+    claim_documents_async,
+    release_leases_async,
+    result_state,
+)
+from async_detector import AsyncHateSpeechDetector
+from bulk_writer import AsyncBulkWriter
+from circuit_breaker import AsyncCircuitBreaker, CircuitOpenError
+from classification_cache import AsyncClassificationCache
+from dead_letters import dead_letter_operation
+from prefilter import load_prefilter
+from text_normalization import TEXT_FIELDS, content_text
+from toxicity_rollups import (
+    NOT_ROLLED_UP,
+    pending_rollup,
+    roll_up_pending_async,
+    sweep_rollups,
+)
+from utils import setup_logger
+
+logger = setup_logger("detection_service")
+
+WORKER_COUNT = HATE_SPEECH_MAX_CONCURRENCY  # The AIMD limiter gates API calls
+QUEUE_SIZE = 2 * WORKER_COUNT  # Small, so dispatch order is service order
+PROGRESS_INTERVAL = 30  # Seconds between progress log lines
+EMPTY_MARKERS = ["", "[deleted]", "[removed]"]
+
+
+class ContentSource:
+    """A collection of text to classify, claimed in leased batches"""
+
+    def __init__(self, content_type, collection, key):
+        self.content_type = content_type
+        self.collection = collection
+        self.key = key
+        self.text_fields = TEXT_FIELDS[content_type]
+        self.projection = {
+            field: 1
+            for field in (key, "lease_token", "analysis_attempts", *self.text_fields)
+        }
+        self.buffer = deque()  # (document, lease token)
+        self.idle_until = 0.0
+        self.stats = {
+            "processed": 0,
+            "flagged": 0,
+            "skipped": 0,
+            "api_errors": 0,
+            "parked": 0,
+        }
+
+    async def next_document(self):
+        """Next leased document, claiming a new batch when the buffer is empty.
+
+        A source with nothing claimable is not asked again for
+        DETECTION_IDLE_POLL_INTERVAL seconds.
+        """
+        if not self.buffer and time.monotonic() >= self.idle_until:
+            token, documents = await claim_documents_async(
+                self.collection, self.key, DETECTION_CLAIM_BATCH_SIZE, self.projection
+            )
+            if documents:
+                self.buffer.extend((document, token) for document in documents)
+            else:
+                self.idle_until = time.monotonic() + DETECTION_IDLE_POLL_INTERVAL
+        return self.buffer.popleft()[0] if self.buffer else None
+
+    async def release(self):
+        """Return still-buffered documents to the pending pool"""
+        tokens = {token for _, token in self.buffer}
+        self.buffer.clear()
+        released = 0
+        for token in tokens:
+            released += await release_leases_async(self.collection, token)
+        return released
+
+    def text(self, document):
+        return content_text(self.content_type, document)
+
+    def summary(self):
+        return (
+            f"{self.content_type}: {self.stats['processed']:,d} processed, "
+            f"{self.stats['flagged']:,d} flagged, "
+            f"{self.stats['skipped']:,d} skipped, "
+            f"{self.stats['api_errors']:,d} errors, "
+            f"{self.stats['parked']:,d} parked"
+        )
+
+
+class DetectionService:
+    """Continuous hate speech detection over every configured source.
+
+    One dispatcher takes a document from each source in turn, so a source
+    with a large backlog can't starve the others, and feeds a small queue
+    drained by WORKER_COUNT tasks. All of them share one detector (HTTP
+    session, classification cache, pre-filter and AIMD limiter) and one
+    bulk writer. Work is claimed through analysis_state leases, so the
+    service can run alongside the Faktory workers or as several replicas.
+    While the detector's circuit breaker is open nothing is claimed.
+    """
+
+    def __init__(self, sources, detector, writer, dead_letters):
+        self.sources = sources
+        self.detector = detector
+        self.writer = writer
+        self.dead_letters = dead_letters
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.stopping = asyncio.Event()
+        self.started = time.time()
+
+    async def wait(self, seconds):
+        """Sleep unless the service is stopped first"""
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def dispatch(self):
+        breaker = self.detector.breaker
+        while not self.stopping.is_set():
+            if breaker and await breaker.is_open():
+                await self.wait(BREAKER_REFRESH_INTERVAL)
+                continue
+
+            dispatched = False
+            for source in self.sources:
+                try:
+                    document = await source.next_document()
+                except Exception as e:
+                    logger.error(f"Error claiming {source.content_type}s: {str(e)}")
+                    continue
+                if document:
+                    await self.queue.put((source, document))
+                    dispatched = True
+
+            if not dispatched:
+                await self.wait(DETECTION_IDLE_POLL_INTERVAL)
+
+    async def consume(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                if item is None:
+                    return
+                await self.classify(*item)
+            except Exception as e:
+                logger.error(f"Error classifying document: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    async def classify(self, source, document):
+        text = source.text(document)
+        update = {"hate_speech_analyzed": True, "hate_speech_updated_at": time.time()}
+
+        if not text or text in EMPTY_MARKERS:
+            update.update(
+                {
+                    "hate_speech_result": None,
+                    "analysis_skipped": True,
+                    "analysis_skipped_reason": "deleted_or_removed",
+                    **result_state(document, succeeded=True),
+                }
+            )
+            source.stats["skipped"] += 1
+        else:
+            try:
+                result = await self.detector.detect(text)
+                reason = None if result else "api_error"
+                state = result_state(document, succeeded=bool(result))
+            except CircuitOpenError:
+                # The API is down: park it without spending an attempt
+                result, reason, state = None, "circuit_open", PARKED_STATE
+            update.update(
+                {
+                    "hate_speech_result": result,
+                    "analysis_skipped": not result,
+                    "analysis_skipped_reason": reason,
+                    **state,
+                }
+            )
+            if not result:
+                source.stats["api_errors"] += 1
+            elif result["class"] != "normal":
+                source.stats["flagged"] += 1
+
+        source.stats["processed"] += 1
+        # Counted by the next rollup sweep, once this write has landed
+        update.update(pending_rollup(update))
+        # Only written while this lease is still the document's current one,
+        # and never over a result already rolled up
+        query = {
+            source.key: document[source.key],
+            "lease_token": document["lease_token"],
+            **NOT_ROLLED_UP,
+        }
+        await self.writer.add(source.collection, UpdateOne(query, {"$set": update}))
+
+        dead_letter = dead_letter_operation(
+            source.content_type, document[source.key], update
+        )
+        if dead_letter:
+            source.stats["parked"] += 1
+            await self.writer.add(self.dead_letters, dead_letter)
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            processed = sum(source.stats["processed"] for source in self.sources)
+            rate = processed / (time.time() - self.started)
+            reporters = [self.detector.cache, self.detector.prefilter]
+            reporters += [self.detector.limiter, self.detector.breaker, self.writer]
+            logger.info(
+                f"Processed {processed:,d} ({rate:.2f}/sec) | "
+                + " | ".join(source.summary() for source in self.sources)
+                + " | "
+                + " | ".join(reporter.summary() for reporter in reporters if reporter)
+            )
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stopping.set)
+
+        logger.info(
+            "Detection service started for "
+            + ", ".join(source.content_type for source in self.sources)
+        )
+        consumers = [asyncio.create_task(self.consume()) for _ in range(WORKER_COUNT)]
+        reporter = asyncio.create_task(self.report())
+        content_types = [source.content_type for source in self.sources]
+        sweeper = asyncio.create_task(sweep_rollups(content_types))
+
+        try:
+            await self.dispatch()
+        finally:
+            logger.info("Stopping: finishing queued documents")
+            for _ in consumers:
+                await self.queue.put(None)
+            await asyncio.gather(*consumers)
+            reporter.cancel()
+            sweeper.cancel()
+            # Results first, so releasing can't touch processed documents
+            await self.writer.close()
+            await roll_up_pending_async(content_types)
+            for source in self.sources:
+                released = await source.release()
+                if released:
+                    logger.info(
+                        f"Released {released} unprocessed {source.content_type}s"
+                    )
+
+
+async def run_service():
+    client = AsyncIOMotorClient(MONGODB_URI)
+    cache = AsyncClassificationCache(
+        client[MONGODB_DB][CLASSIFICATION_CACHE_COLLECTION]
+    )
+    detector = AsyncHateSpeechDetector(
+        MODERATE_API_KEY,
+        cache=cache,
+        prefilter=load_prefilter(),
+        breaker=AsyncCircuitBreaker(client[MONGODB_DB][CIRCUIT_BREAKER_COLLECTION]),
+    )
+    await detector.init_session()
+
+    sources = []
+    for content_type in DETECTION_SERVICE_SOURCES:
+        db_name, collection_name, key = HATE_SPEECH_CONTENT_SOURCES[content_type]
+        sources.append(
+            ContentSource(content_type, client[db_name][collection_name], key)
+        )
+
+    try:
+        dead_letters = client[MONGODB_DB][DEAD_LETTER_COLLECTION]
+        await DetectionService(sources, detector, AsyncBulkWriter(), dead_letters).run()
+    finally:
+        await detector.close()
+        client.close()
+
+
+def main():
+    try:
+        asyncio.run(run_service())
+    except Exception as e:
+        logger.critical(f"Fatal error in detection service: {str(e)}")
+        raise
+
+
+if __name__ == "__main__":
+    main()
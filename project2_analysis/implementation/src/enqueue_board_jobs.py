@@ -7,8 +7,11 @@ from pymongo import MongoClient, DESCENDING
 from config import (
     FAKTORY_URL,
     MONGODB_URI,
+    MONGODB_DB,
     BOARDS,
+    WORKER_NODES_COLLECTION,
 )
+from partitioning import NodeRegistry, PartitionRouter
 from utils import setup_logger, handle_api_response
 
 # New database and collection names
@@ -43,6 +46,13 @@ class FourChanBoardsEnqueuer:
                 )
                 self.db = self.mongo_client[FOURCHAN_DB]
                 self.threads_collection = self.db[THREADS_COLLECTION]
+                self.router = PartitionRouter(
+                    NodeRegistry(
+                        self.mongo_client[MONGODB_DB][WORKER_NODES_COLLECTION],
+                        "4chan",
+                    ),
+                    logger,
+                )
 
                 self.mongo_client.server_info()
                 logger.info("Successfully connected to MongoDB")
@@ -158,7 +168,10 @@ class FourChanBoardsEnqueuer:
             return Job(
                 jobtype="fetch_4chan_threads",
                 args=[thread["board"], thread["no"]],
-                queue="4chan_threads_queue",
+                # Same thread always lands on the same node's queue
+                queue=self.router.queue_for(
+                    "4chan_threads_queue", f"{thread['board']}:{thread['no']}"
+                ),
                 retry=3,
                 reserve_for=900,  # 15 minutes timeout
                 custom={
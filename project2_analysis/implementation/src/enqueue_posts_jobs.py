@@ -1,8 +1,23 @@
 import time
+import uuid
 from pyfaktory import Client, Job, Producer
 from pymongo import MongoClient
 from datetime import datetime, timedelta
-from config import FAKTORY_URL, MONGODB_URI, MONGODB_DB, MONGODB_COLLECTION, SUBREDDITS
+from config import (
+    FAKTORY_URL,
+    MONGODB_URI,
+    MONGODB_DB,
+    MONGODB_COLLECTION,
+    SUBREDDITS,
+    SUBREDDIT_ACTIVITY_COLLECTION,
+    SUBREDDIT_MIN_POLL_INTERVAL,
+    REDDIT_JOB_QUEUES,
+    REDDIT_LIVE_WINDOW,
+    WORKER_NODES_COLLECTION,
+)
+from budget import classify_reddit_job
+from partitioning import NodeRegistry, PartitionRouter, partition_queue
+from subreddit_scheduler import SubredditCrawlScheduler, chunk_subreddits
 from utils import setup_logger
 
 # Configure logging
@@ -28,9 +43,24 @@ class RedditTimeWindowEnqueuer:
         self.chunk_size = chunk_size
         self.refresh_interval = refresh_interval
         self.total_jobs_enqueued = 0
+        self.last_full_cycle = 0
 
         # Initialize MongoDB
         self._init_mongodb()
+        self.scheduler = SubredditCrawlScheduler(
+            self.subreddits,
+            self.collection,
+            self.db[SUBREDDIT_ACTIVITY_COLLECTION],
+            logger,
+        )
+        self.router = PartitionRouter(
+            NodeRegistry(self.db[WORKER_NODES_COLLECTION], "reddit"), logger
+        )
+
+    def job_queue(self, job_class, node):
+        """Queue for a job class, on the owning node's partition if any"""
+        base_queue = REDDIT_JOB_QUEUES[job_class]
+        return partition_queue(base_queue, node) if node else base_queue
 
     def _init_mongodb(self):
         """Initialize MongoDB connection"""
@@ -55,7 +85,7 @@ class RedditTimeWindowEnqueuer:
 
         return chunks
 
-    def get_posts_needing_refresh(self, subreddit):
+    def get_posts_needing_refresh(self, subreddits):
         """Get existing posts that need refreshing"""
         try:
             current_time = time.time()
@@ -63,7 +93,7 @@ class RedditTimeWindowEnqueuer:
 
             # Find posts within date range that need refresh
             query = {
-                "subreddit": subreddit,
+                "subreddit": {"$in": subreddits},
                 "created": {
                     "$gte": self.start_date.timestamp(),
                     "$lte": self.end_date.timestamp(),
@@ -74,32 +104,41 @@ class RedditTimeWindowEnqueuer:
                 ],
             }
 
-            posts = self.collection.find(query, {"id": 1, "created": 1})
+            posts = self.collection.find(
+                query, {"id": 1, "subreddit": 1, "created": 1}
+            )
             return list(posts)
 
         except Exception as e:
             logger.error(f"Error getting posts for refresh: {str(e)}")
             return []
 
-    def create_chunk_job(self, subreddit, start_time, end_time):
-        """Create a job for a specific time chunk"""
+    def create_chunk_job(self, subreddits, start_time, end_time, node=None):
+        """Create a job for a specific time chunk of one or more subreddits"""
         try:
+            # A multi-subreddit path (a+b+c) lists all of them in one request
+            subreddit = "+".join(subreddits)
+
             # Convert datetime to timestamp for the worker
             job_data = {
                 "subreddit": subreddit,
                 "start_date": start_time.timestamp(),
                 "end_date": end_time.timestamp(),
+                # Identifies this push: a retry keeps it, a duplicate doesn't
+                "enqueue_id": uuid.uuid4().hex,
             }
+            job_data["job_class"] = classify_reddit_job(job_data)
 
             return Job(
                 jobtype="refresh_reddit_data",
                 args=[job_data],
-                queue="reddit_refresh_queue2",
+                queue=self.job_queue(job_data["job_class"], node),
                 retry=3,
                 reserve_for=1800,
                 custom={
                     "enqueued_at": time.time(),
                     "subreddit": subreddit,
+                    "job_class": job_data["job_class"],
                     "chunk_start": start_time.isoformat(),
                     "chunk_end": end_time.isoformat(),
                 },
@@ -108,20 +147,23 @@ class RedditTimeWindowEnqueuer:
             logger.error(f"Error creating chunk job: {str(e)}")
             return None
 
-    def create_refresh_job(self, subreddit, post_ids):
+    def create_refresh_job(self, subreddits, post_ids, node=None):
         """Create a job for refreshing specific posts"""
         try:
+            subreddit = "+".join(sorted(subreddits))
             job_data = {
                 "subreddit": subreddit,
                 "post_ids": post_ids,
                 "start_date": self.start_date.timestamp(),
                 "end_date": self.end_date.timestamp(),
+                "job_class": "refresh",
+                "enqueue_id": uuid.uuid4().hex,
             }
 
             return Job(
                 jobtype="refresh_reddit_data",
                 args=[job_data],
-                queue="reddit_refresh_queue2",
+                queue=self.job_queue("refresh", node),
                 retry=3,
                 reserve_for=1800,
                 custom={
@@ -135,40 +177,81 @@ class RedditTimeWindowEnqueuer:
             logger.error(f"Error creating refresh job: {str(e)}")
             return None
 
+    def enqueue_live_jobs(self, producer):
+        """Enqueue listing jobs for the subreddits whose poll is due"""
+        enqueued_count = 0
+        now = time.time()
+
+        for batch in self.scheduler.plan(now, partition=self.router.node_for):
+            job = self.create_chunk_job(
+                batch["subreddits"],
+                datetime.fromtimestamp(batch["start_date"]),
+                datetime.fromtimestamp(batch["end_date"]),
+                node=batch["partition"],
+            )
+            if job:
+                producer.push(job)
+                self.scheduler.mark_enqueued(batch["subreddits"], now)
+                enqueued_count += 1
+                logger.info(
+                    f"Enqueued live job for {len(batch['subreddits'])} subreddits "
+                    f"(~{batch['expected_posts']:.0f} new posts expected)"
+                )
+
+        return enqueued_count
+
     def enqueue_jobs(self, producer):
-        """Enqueue chunk jobs & refresh jobs"""
+        """Enqueue backfill chunk jobs & refresh jobs"""
         enqueued_count = 0
 
         try:
-            for subreddit in self.subreddits:
-                time_chunks = self.generate_time_chunks(self.start_date, self.end_date)
+            subreddit_groups = chunk_subreddits(
+                self.subreddits, partition=self.router.node_for
+            )
+
+            # Chunks inside the live window are covered by live polls
+            backfill_end = min(
+                self.end_date,
+                datetime.fromtimestamp(time.time() - REDDIT_LIVE_WINDOW),
+            )
+            time_chunks = self.generate_time_chunks(self.start_date, backfill_end)
 
-                for chunk_start, chunk_end in time_chunks:
-                    job = self.create_chunk_job(subreddit, chunk_start, chunk_end)
+            for chunk_start, chunk_end in time_chunks:
+                for node, group in subreddit_groups:
+                    job = self.create_chunk_job(
+                        group, chunk_start, chunk_end, node=node
+                    )
                     if job:
                         producer.push(job)
                         enqueued_count += 1
                         logger.info(
-                            f"Enqueued chunk job for r/{subreddit}: "
+                            f"Enqueued chunk job for {len(group)} subreddits: "
                             f"{chunk_start.strftime('%Y-%m-%d %H:%M')} to "
                             f"{chunk_end.strftime('%Y-%m-%d %H:%M')}"
                         )
 
-                posts = self.get_posts_needing_refresh(subreddit)
-                if posts:
-                    batch_size = 100
-                    for i in range(0, len(posts), batch_size):
-                        batch = posts[i : i + batch_size]
-                        post_ids = [post["id"] for post in batch]
-
-                        job = self.create_refresh_job(subreddit, post_ids)
-                        if job:
-                            producer.push(job)
-                            enqueued_count += 1
-                            logger.info(
-                                f"Enqueued refresh job for r/{subreddit}: "
-                                f"{len(post_ids)} posts"
-                            )
+            # Refresh jobs mix the subreddits of one node; one by_id request
+            # covers 100 posts
+            posts_by_node = {}
+            for post in self.get_posts_needing_refresh(self.subreddits):
+                node = self.router.node_for(post["subreddit"])
+                posts_by_node.setdefault(node, []).append(post)
+
+            batch_size = 100
+            for node, posts in posts_by_node.items():
+                for i in range(0, len(posts), batch_size):
+                    batch = posts[i : i + batch_size]
+                    post_ids = [post["id"] for post in batch]
+                    subreddits = {post["subreddit"] for post in batch}
+
+                    job = self.create_refresh_job(subreddits, post_ids, node=node)
+                    if job:
+                        producer.push(job)
+                        enqueued_count += 1
+                        logger.info(
+                            f"Enqueued refresh job for {len(subreddits)} subreddits: "
+                            f"{len(post_ids)} posts"
+                        )
 
             return enqueued_count
 
@@ -182,9 +265,7 @@ class RedditTimeWindowEnqueuer:
         logger.info(f"Collection window: {self.start_date} to {self.end_date}")
         logger.info(f"Chunk size: {self.chunk_size} seconds")
         logger.info(f"Refresh interval: {self.refresh_interval} seconds")
-        logger.info(
-            f"Monitoring subreddits: {', '.join(['r/' + s for s in self.subreddits])}"
-        )
+        logger.info(f"Monitoring {len(self.subreddits)} subreddits")
 
         while True:
             cycle_start = time.time()
@@ -193,8 +274,11 @@ class RedditTimeWindowEnqueuer:
                 with Client(faktory_url=self.faktory_url, role="producer") as client:
                     producer = Producer(client=client)
 
-                    # Enqueue all jobs
-                    enqueued = self.enqueue_jobs(producer)
+                    # Live polls every cycle, backfill and refresh less often
+                    enqueued = self.enqueue_live_jobs(producer)
+                    if cycle_start - self.last_full_cycle >= self.refresh_interval:
+                        enqueued += self.enqueue_jobs(producer)
+                        self.last_full_cycle = cycle_start
                     self.total_jobs_enqueued += enqueued
 
                     logger.info(
@@ -209,7 +293,7 @@ class RedditTimeWindowEnqueuer:
                 continue
 
             elapsed = time.time() - cycle_start
-            sleep_time = max(0, self.refresh_interval - elapsed)
+            sleep_time = max(0, SUBREDDIT_MIN_POLL_INTERVAL - elapsed)
 
             if sleep_time > 0:
                 logger.debug(f"Sleeping for {sleep_time:.2f} seconds until next cycle")
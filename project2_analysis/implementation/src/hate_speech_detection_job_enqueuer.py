@@ -3,13 +3,22 @@ import logging
 import time
 from datetime import datetime, timedelta
 from pymongo import MongoClient, UpdateMany
+from pymongo.errors import OperationFailure
 from config import (
     FAKTORY_URL,
     MONGODB_URI,
     MONGODB_DB,
     MONGODB_COLLECTION,
     COMMENTS_COLLECTION,
+    HATE_SPEECH_JOB_BATCH_SIZE,
+    HATE_SPEECH_ENQUEUE_MODE,
+    HATE_SPEECH_CONTENT_SOURCES,
+    CHANGE_STREAM_STATE_COLLECTION,
+    CHANGE_STREAM_SWEEP_INTERVAL,
+    CIRCUIT_BREAKER_COLLECTION,
 )
+from analysis_state import claim_batch, claim_ids
+from circuit_breaker import CircuitBreaker
 from utils import setup_logger
 
 logger = setup_logger("hatespeech_detection_enqueuer")
@@ -17,11 +26,17 @@ logger = setup_logger("hatespeech_detection_enqueuer")
 
 class HateSpeechDetectionEnqueuer:
     def __init__(
-        self, faktory_url, mongodb_uri, batch_size=100, interval=5  # 5 seconds
+        self,
+        faktory_url,
+        mongodb_uri,
+        batch_size=100,
+        interval=5,  # 5 seconds
+        job_batch_size=HATE_SPEECH_JOB_BATCH_SIZE,
     ):
         self.faktory_url = faktory_url
         self.mongodb_uri = mongodb_uri
         self.batch_size = batch_size
+        self.job_batch_size = job_batch_size
         self.interval = interval
         self.total_jobs_enqueued = 0
         self.failed_jobs = 0
@@ -35,121 +50,97 @@ class HateSpeechDetectionEnqueuer:
             self.db = self.mongo_client[MONGODB_DB]
             self.posts_collection = self.db[MONGODB_COLLECTION]
             self.comments_collection = self.db[COMMENTS_COLLECTION]
+            # Nothing is leased while the detection API is down
+            self.breaker = CircuitBreaker(self.db[CIRCUIT_BREAKER_COLLECTION])
             logger.info("Successfully connected to MongoDB")
         except Exception as e:
             logger.error(f"MongoDB connection failed: {str(e)}")
             raise
 
-    def create_detection_job(self, content_type, content_id):
-        """Create a job for hate speech detection"""
+    def create_detection_job(self, content_type, content_ids, lease_token=None):
+        """Create a job for hate speech detection of a batch of documents"""
         try:
             return Job(
                 jobtype="detect_hate_speech",
-                args=[{"content_type": content_type, "content_id": content_id}],
+                args=[
+                    {
+                        "content_type": content_type,
+                        "content_ids": content_ids,
+                        "lease_token": lease_token,
+                    }
+                ],
                 queue="hate_speech_detection_queue",
                 retry=3,
                 reserve_for=600,  # 10 minutes timeout
-                custom={"enqueued_at": time.time(), "content_type": content_type},
+                custom={
+                    "enqueued_at": time.time(),
+                    "content_type": content_type,
+                    "batch_size": len(content_ids),
+                },
             )
         except Exception as e:
             logger.error(
-                f"Error creating job for {content_type} {content_id}: {str(e)}"
+                f"Error creating job for {len(content_ids)} {content_type}s: {str(e)}"
             )
             return None
 
+    def create_detection_jobs(self, content_type, content_ids, lease_token=None):
+        """Split ids into jobs of at most job_batch_size documents"""
+        jobs = []
+        for i in range(0, len(content_ids), self.job_batch_size):
+            job = self.create_detection_job(
+                content_type, content_ids[i : i + self.job_batch_size], lease_token
+            )
+            if job:
+                jobs.append(job)
+        return jobs
+
     def get_and_mark_unanalyzed_content(self):
-        """Get content that hasn't been analyzed and mark it as in progress"""
-        try:
-            current_time = time.time()
+        """Lease a batch of unanalyzed posts and comments.
 
-            # Query for unanalyzed content
-            content_query = {
-                "$and": [
-                    {"hate_speech_analyzed": {"$exists": False}},
-                    # Also check if there's no enqueued_at or if it's old (stuck jobs)
-                    {
-                        "$or": [
-                            {"hate_speech_enqueued_at": {"$exists": False}},
-                            # Consider jobs older than 1 hour as stuck
-                            {"hate_speech_enqueued_at": {"$lt": current_time - 3600}},
-                        ]
-                    },
-                ]
-            }
-
-            # Find posts and comments in one go
-            posts = list(
-                self.posts_collection.find(content_query, {"id": 1, "_id": 0}).limit(
-                    self.batch_size
-                )
+        Leasing is atomic per document, so several enqueuers can run side by
+        side; documents whose job never finished return once the lease
+        expires.
+        """
+        try:
+            post_token, post_ids = claim_batch(
+                self.posts_collection, "id", self.batch_size
             )
-
-            comments = list(
-                self.comments_collection.find(content_query, {"id": 1, "_id": 0}).limit(
-                    self.batch_size
-                )
+            comment_token, comment_ids = claim_batch(
+                self.comments_collection, "id", self.batch_size
             )
 
-            # Mark posts as enqueued
-            if posts:
-                post_ids = [post["id"] for post in posts]
-                self.posts_collection.update_many(
-                    {"id": {"$in": post_ids}},
-                    {
-                        "$set": {
-                            "hate_speech_enqueued_at": current_time,
-                            "hate_speech_enqueued": True,
-                        }
-                    },
-                )
-
-            # Mark comments as enqueued
-            if comments:
-                comment_ids = [comment["id"] for comment in comments]
-                self.comments_collection.update_many(
-                    {"id": {"$in": comment_ids}},
-                    {
-                        "$set": {
-                            "hate_speech_enqueued_at": current_time,
-                            "hate_speech_enqueued": True,
-                        }
-                    },
-                )
-
             logger.info(
-                f"Found {len(posts)} unanalyzed posts and {len(comments)} unanalyzed comments"
+                f"Leased {len(post_ids)} unanalyzed posts and "
+                f"{len(comment_ids)} unanalyzed comments"
             )
-            return posts, comments
+            return (post_token, post_ids), (comment_token, comment_ids)
 
         except Exception as e:
             logger.error(f"Error getting unanalyzed content: {str(e)}")
-            return [], []
+            return (None, []), (None, [])
 
     def enqueue_batch(self, producer):
         """Enqueue a batch of hate speech detection jobs"""
         try:
+            if self.breaker.is_open():
+                logger.info("Detection API circuit breaker is open; not enqueueing")
+                return 0
+
             posts, comments = self.get_and_mark_unanalyzed_content()
-            jobs = []
+            (post_token, post_ids), (comment_token, comment_ids) = posts, comments
             enqueued_count = 0
 
-            # Create jobs for posts
-            for post in posts:
-                job = self.create_detection_job("post", post["id"])
-                if job:
-                    jobs.append(job)
-
-            # Create jobs for comments
-            for comment in comments:
-                job = self.create_detection_job("comment", comment["id"])
-                if job:
-                    jobs.append(job)
+            jobs = self.create_detection_jobs("post", post_ids, post_token)
+            jobs += self.create_detection_jobs("comment", comment_ids, comment_token)
 
             # Enqueue jobs in batches
             if jobs:
                 producer.push_bulk(jobs)
                 enqueued_count = len(jobs)
                 logger.info(
-                    f"Enqueued batch of {enqueued_count} hate speech detection jobs"
+                    f"Enqueued batch of {enqueued_count} hate speech detection jobs "
+                    f"covering {len(post_ids) + len(comment_ids)} documents"
                 )
 
             return enqueued_count
@@ -207,9 +198,196 @@ class HateSpeechDetectionEnqueuer:
                 time.sleep(sleep_time)
 
 
+class ChangeStreamEnqueuer(HateSpeechDetectionEnqueuer):
+    """Enqueue new posts and comments as they are inserted.
+
+    One change stream covers the Reddit posts and comments and the 4chan
+    posts. Its resume token is persisted after every push so a restart
+    continues where it stopped. An indexed sweep at startup and every
+    CHANGE_STREAM_SWEEP_INTERVAL catches whatever the stream missed:
+    documents inserted while the token was lost, or leases that expired.
+    """
+
+    STATE_ID = "hate_speech_enqueuer"
+    HISTORY_LOST_CODES = (280, 286)  # ChangeStreamFatalError, HistoryLost
+
+    def __init__(self, faktory_url, mongodb_uri, **kwargs):
+        super().__init__(faktory_url, mongodb_uri, **kwargs)
+        self.state_collection = self.db[CHANGE_STREAM_STATE_COLLECTION]
+        self.sources = {
+            content_type: (self.mongo_client[db][collection], key)
+            for content_type, (db, collection, key) in (
+                HATE_SPEECH_CONTENT_SOURCES.items()
+            )
+        }
+        self.namespaces = {
+            (db, collection): content_type
+            for content_type, (db, collection, _) in (
+                HATE_SPEECH_CONTENT_SOURCES.items()
+            )
+        }
+
+    def load_resume_token(self):
+        state = self.state_collection.find_one({"_id": self.STATE_ID})
+        return state.get("resume_token") if state else None
+
+    def save_resume_token(self, token):
+        if token:
+            self.state_collection.update_one(
+                {"_id": self.STATE_ID},
+                {"$set": {"resume_token": token, "updated_at": time.time()}},
+                upsert=True,
+            )
+
+    def push(self, producer, pending):
+        """Lease {content_type: [key values]} and enqueue jobs for them.
+
+        Documents another enqueuer already leased are skipped, and while the
+        circuit breaker is open nothing is leased; the next sweep finds them.
+        """
+        enqueued = 0
+        if self.breaker.is_open():
+            return enqueued
+        for content_type, key_values in pending.items():
+            collection, key = self.sources[content_type]
+            lease_token, leased = claim_ids(collection, key, key_values)
+            if not leased:
+                continue
+            jobs = self.create_detection_jobs(
+                content_type, [str(value) for value in leased], lease_token
+            )
+            if jobs:
+                producer.push_bulk(jobs)
+                enqueued += len(jobs)
+        self.total_jobs_enqueued += enqueued
+        return enqueued
+
+    def sweep(self, producer):
+        """Enqueue every claimable document: never enqueued, or whose lease
+        expired without a result. Served by the analysis_state partial index.
+        """
+        swept = 0
+        for content_type, (collection, key) in self.sources.items():
+            while not self.breaker.is_open():
+                lease_token, leased = claim_batch(
+                    collection, key, self.batch_size * self.job_batch_size
+                )
+                if not leased:
+                    break
+                jobs = self.create_detection_jobs(
+                    content_type, [str(value) for value in leased], lease_token
+                )
+                if jobs:
+                    producer.push_bulk(jobs)
+                    self.total_jobs_enqueued += len(jobs)
+                swept += len(leased)
+        logger.info(f"Sweep enqueued {swept} documents the change stream missed")
+        return swept
+
+    def _pipeline(self):
+        return [
+            {
+                "$match": {
+                    "operationType": "insert",
+                    "$or": [
+                        {"ns.db": db, "ns.coll": collection}
+                        for db, collection in self.namespaces
+                    ],
+                }
+            },
+            {"$project": {"ns": 1, "fullDocument._id": 1, "fullDocument.id": 1}},
+        ]
+
+    def stream(self, producer):
+        """Tail inserts, pushing a job once a batch fills or the stream idles"""
+        resume_token = self.load_resume_token()
+        if not resume_token:
+            logger.info("No resume token saved; starting the change stream now")
+
+        with self.mongo_client.watch(
+            self._pipeline(), resume_after=resume_token, max_await_time_ms=1000
+        ) as stream:
+            # The stream is open, so nothing inserted from here on is missed
+            self.sweep(producer)
+            last_sweep = last_save = time.time()
+            pending, pending_count = {}, 0
+
+            while stream.alive:
+                change = stream.try_next()
+                if change:
+                    ns = change["ns"]
+                    content_type = self.namespaces.get((ns["db"], ns["coll"]))
+                    if content_type:
+                        _, key = self.sources[content_type]
+                        key_value = change["fullDocument"][key]
+                        pending.setdefault(content_type, []).append(key_value)
+                        pending_count += 1
+
+                if pending_count and (
+                    change is None or pending_count >= self.job_batch_size
+                ):
+                    self.push(producer, pending)
+                    self.save_resume_token(stream.resume_token)
+                    last_save = time.time()
+                    pending, pending_count = {}, 0
+                    continue
+
+                if change is None:
+                    # Idle: keep the saved token close to the stream's position
+                    if time.time() - last_save >= 60:
+                        self.save_resume_token(stream.resume_token)
+                        last_save = time.time()
+                    if time.time() - last_sweep >= CHANGE_STREAM_SWEEP_INTERVAL:
+                        self.sweep(producer)
+                        last_sweep = time.time()
+
+    def run(self):
+        """Main change stream loop"""
+        logger.info("Starting hate speech detection enqueuer (change streams)...")
+
+        consecutive_errors = 0
+        ERROR_THRESHOLD = 3
+
+        while True:
+            try:
+                with Client(faktory_url=self.faktory_url, role="producer") as client:
+                    self.stream(Producer(client=client))
+                consecutive_errors = 0
+
+            except OperationFailure as e:
+                if e.code in self.HISTORY_LOST_CODES:
+                    # Token fell off the oplog; the startup sweep covers the gap
+                    logger.warning(f"Resume token no longer valid: {str(e)}")
+                    self.state_collection.delete_one({"_id": self.STATE_ID})
+                    continue
+                consecutive_errors += 1
+                logger.error(f"Change stream failed: {str(e)}")
+
+            except Exception as e:
+                consecutive_errors += 1
+                logger.error(f"Error in change stream: {str(e)}")
+
+            if consecutive_errors >= ERROR_THRESHOLD:
+                backoff_time = min(
+                    300, 30 * (2 ** (consecutive_errors - ERROR_THRESHOLD))
+                )
+                logger.warning(
+                    f"Multiple errors detected, backing off for {backoff_time} seconds"
+                )
+                time.sleep(backoff_time)
+            else:
+                time.sleep(self.interval)
+
+
 def main():
     try:
-        enqueuer = HateSpeechDetectionEnqueuer(
+        # "stream" tails change streams (needs a replica set); "poll" queries
+        enqueuer_class = (
+            ChangeStreamEnqueuer
+            if HATE_SPEECH_ENQUEUE_MODE == "stream"
+            else HateSpeechDetectionEnqueuer
+        )
+        enqueuer = enqueuer_class(
             faktory_url=FAKTORY_URL,
             mongodb_uri=MONGODB_URI,
             batch_size=100,
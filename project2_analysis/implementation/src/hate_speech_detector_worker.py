@@ -1,45 +1,63 @@
 from pyfaktory import Client, Consumer
 import requests
+import threading
 import time
 import logging
-from pymongo import MongoClient, UpdateOne
+from concurrent.futures import ThreadPoolExecutor
+from pebble import ThreadPool
+from bson import ObjectId
+from pymongo import UpdateOne
 from datetime import datetime
 from config import (
     FAKTORY_URL,
-    MONGODB_URI,
     MONGODB_DB,
     MONGODB_COLLECTION,
     COMMENTS_COLLECTION,
     MODERATE_API_KEY,  # Add this to config.py
+    HATE_SPEECH_CLASSIFY_THREADS,
+    CLASSIFICATION_CACHE_COLLECTION,
+    HATE_SPEECH_CONTENT_SOURCES,
+    CIRCUIT_BREAKER_COLLECTION,
+    DEAD_LETTER_COLLECTION,
 )
-from utils import setup_logger, handle_api_response
+from analysis_state import PARKED_STATE, holds_lease, result_state
+from bulk_writer import BulkWriter
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from classification_cache import ClassificationCache
+from concurrency import ConcurrencyLimiter
+from db import get_mongo_client
+from dead_letters import dead_letter_operation
+from prefilter import load_prefilter
+from text_normalization import content_text
+from toxicity_rollups import NOT_ROLLED_UP, pending_rollup, roll_up_pending
+from indexes import ensure_indexes
+from utils import get_http_session, setup_logger, handle_api_response
 
 
 logger = setup_logger("hatespeech_detection_worker")
 
 
-# Initialize MongoDB connection
 def init_mongodb():
-    """Initialize MongoDB connection with collections"""
+    """Return the shared MongoDB client with the posts and comments collections"""
     try:
-        client = MongoClient(MONGODB_URI)
+        client = get_mongo_client()
+        ensure_indexes(client)
         db = client[MONGODB_DB]
-        posts_collection = db[MONGODB_COLLECTION]
-        comments_collection = db[COMMENTS_COLLECTION]
-
-        # Create new indexes for hate speech detection
-        posts_collection.create_index("hate_speech_analyzed")
-        comments_collection.create_index("hate_speech_analyzed")
-
-        return client, posts_collection, comments_collection
+        return client, db[MONGODB_COLLECTION], db[COMMENTS_COLLECTION]
     except Exception as e:
         logger.error(f"MongoDB connection failed: {str(e)}")
         raise
 
 
 class HateSpeechDetector:
-    def __init__(self, api_key):
+    def __init__(
+        self, api_key, cache=None, prefilter=None, limiter=None, breaker=None
+    ):
         self.api_key = api_key
+        self.cache = cache
+        self.prefilter = prefilter
+        self.limiter = limiter or ConcurrencyLimiter()
+        self.breaker = breaker
         self.api_url = "https://api.moderatehatespeech.com/api/v1/moderate/"
         self.max_retries = 3
         self.base_delay = 1
@@ -61,6 +79,19 @@ class HateSpeechDetector:
         if not text or text in ["[deleted]", "[removed]"]:
             return None
 
+        # Identical texts were classified before; skip the API call
+        if self.cache:
+            cached = self.cache.get(text)
+            if cached:
+                return cached
+
+        # Obviously benign text is labelled locally
+        audit = None
+        if self.prefilter:
+            local_result, audit = self.prefilter.screen(text)
+            if local_result:
+                return local_result
+
         # Clean the text
         cleaned_text = self.clean_text(text)
 
@@ -70,19 +101,28 @@ class HateSpeechDetector:
         headers = {"Content-Type": "application/json"}
 
         for attempt in range(self.max_retries):
+            # Raises CircuitOpenError while the API is considered down
+            probing = self.breaker.allow() if self.breaker else False
+            answered = False  # Whether the API was up; throttling counts
             try:
                 # Make request using json parameter instead of data
-                response = requests.post(
-                    self.api_url,
-                    json=request_data,  # Use json parameter to handle serialization
-                    headers=headers,
-                    timeout=30,
-                )
+                with self.limiter.slot() as slot:
+                    response = get_http_session().post(
+                        self.api_url,
+                        json=request_data,  # Use json parameter to handle serialization
+                        headers=headers,
+                        timeout=30,
+                    )
+                    if response.status_code == 429:
+                        slot.throttled()
+                    elif response.status_code >= 500:
+                        slot.server_error()
 
                 # Log response for debugging
                 logger.info(f"API response: {response.text}")
 
                 if response.status_code == 429:
+                    answered = True
                     delay = (2**attempt) * self.base_delay
                     logger.warning(f"Rate limit hit, backing off for {delay} seconds")
                     time.sleep(delay)
@@ -97,11 +137,18 @@ class HateSpeechDetector:
                     continue
 
                 if response_data.get("response") == "Success":
-                    return {
+                    answered = True
+                    result = {
                         "class": response_data.get("class"),
                         "confidence": float(response_data.get("confidence", 0)),
                         "analyzed_at": datetime.utcnow().timestamp(),
+                        "source": "api",
                     }
+                    if audit:
+                        result["prefilter"] = audit
+                    if self.cache:
+                        self.cache.put(text, result)
+                    return result
                 else:
                     logger.error(f"API Error: {response_data}")
 
@@ -112,6 +159,9 @@ class HateSpeechDetector:
             except Exception as e:
                 logger.error(f"Unexpected error on attempt {attempt + 1}: {str(e)}")
                 logger.error(f"Full error: {str(e)}")
+            finally:
+                if self.breaker:
+                    self.breaker.record(answered, probing)
 
             if attempt < self.max_retries - 1:
                 time.sleep((2**attempt) * self.base_delay)
@@ -119,24 +169,17 @@ class HateSpeechDetector:
         return None
 
 
-def process_content(content_type, content_data, detector, collections):
+def process_content(content_type, content_data, detector, lease_token=None):
     """
-    Process content (post or comment) for hate speech detection
+    Classify content (post, comment or 4chan post) and return the update
+    for its document and, when it is parked, its dead-letter entry
     """
-    posts_collection, comments_collection = collections
-    collection = posts_collection if content_type == "post" else comments_collection
-
     try:
-        # Extract text based on content type
-        if content_type == "post":
-            title = content_data.get("title", "")
-            selftext = content_data.get("selftext", "")
-            # Combine title and selftext with proper spacing
-            text = f"{title} {selftext}".strip()
-            content_id = content_data["id"]
-        else:
-            text = content_data.get("body", "")
-            content_id = content_data["id"]
+        _, _, key = HATE_SPEECH_CONTENT_SOURCES[content_type]
+        content_id = content_data[key]
+
+        # Title and selftext, comment body or the 4chan post's com_text
+        text = content_text(content_type, content_data)
 
         # Skip already analyzed or deleted/removed content
         if not text or text in ["[deleted]", "[removed]"]:
@@ -145,61 +188,173 @@ def process_content(content_type, content_data, detector, collections):
                 "hate_speech_result": None,
                 "analysis_skipped": True,
                 "analysis_skipped_reason": "deleted_or_removed",
+                **result_state(content_data, succeeded=True),
             }
         else:
             # Perform hate speech detection
-            detection_result = detector.detect(text)
+            try:
+                detection_result = detector.detect(text)
+                reason = None if detection_result else "api_error"
+                state = result_state(content_data, succeeded=bool(detection_result))
+            except CircuitOpenError:
+                # The API is down: park it without spending an attempt
+                detection_result, reason, state = None, "circuit_open", PARKED_STATE
             result = {
                 "hate_speech_analyzed": True,
                 "hate_speech_result": detection_result,
                 "analysis_skipped": False if detection_result else True,
-                "analysis_skipped_reason": None if detection_result else "api_error",
+                "analysis_skipped_reason": reason,
+                **state,
             }
 
-        # Update the document
-        collection.update_one({"id": content_id}, {"$set": result})
-
-        logger.info(f"Processed {content_type} {content_id} for hate speech detection")
-        return True
+        # Counted by the next rollup sweep, once this write has landed
+        result.update(pending_rollup(result))
+
+        # A job whose lease expired and was re-claimed must not overwrite,
+        # nor may anything overwrite a result already rolled up
+        query = {key: content_id, **NOT_ROLLED_UP}
+        if lease_token:
+            query["lease_token"] = lease_token
+        return (
+            UpdateOne(query, {"$set": result}),
+            dead_letter_operation(content_type, content_id, result),
+        )
 
     except Exception as e:
         logger.error(
-            f"Error processing {content_type} {content_data.get('id')}: {str(e)}"
+            f"Error processing {content_type} "
+            f"{content_data.get('id') or content_data.get('_id')}: {str(e)}"
         )
-        return False
+        return None
+
+
+classification_pool = ThreadPoolExecutor(max_workers=HATE_SPEECH_CLASSIFY_THREADS)
+# Results of all jobs are written together; see bulk_writer.py
+result_writer = BulkWriter()
+_detector = None
+_detector_lock = threading.Lock()
+
+
+def get_detector():
+    """Detector shared by all jobs of the worker, which runs them as threads
+    of this one process (see ThreadedConsumer), so API calls stay under one
+    AIMD limit. Built by the first job rather than at import, so the Mongo
+    client of its cache and breaker is opened by the process that uses it.
+    """
+    global _detector
+    with _detector_lock:
+        if _detector is None:
+            cache = ClassificationCache(
+                get_mongo_client()[MONGODB_DB][CLASSIFICATION_CACHE_COLLECTION]
+            )
+            # Pauses API calls in every worker while the API is failing
+            breaker = CircuitBreaker(
+                get_mongo_client()[MONGODB_DB][CIRCUIT_BREAKER_COLLECTION]
+            )
+            _detector = HateSpeechDetector(
+                MODERATE_API_KEY,
+                cache=cache,
+                prefilter=load_prefilter(),
+                breaker=breaker,
+            )
+        return _detector
 
 
 def process_hate_speech_job(job_data):
     """
-    Process a hate speech detection job
+    Process a batch hate speech detection job: one $in read, concurrent
+    classification and buffered bulk writes
     """
     try:
-        mongo_client, posts_collection, comments_collection = init_mongodb()
-        detector = HateSpeechDetector(MODERATE_API_KEY)
-        collections = (posts_collection, comments_collection)
+        setup_start = time.perf_counter()
+        mongo_client, _, _ = init_mongodb()
+        logger.debug(
+            f"Job setup took {(time.perf_counter() - setup_start) * 1000:.1f} ms"
+        )
 
         content_type = job_data.get("content_type")
-        content_id = job_data.get("content_id")
+        # Jobs enqueued before batching carry a single content_id
+        content_ids = job_data.get("content_ids") or [job_data.get("content_id")]
+        content_ids = [content_id for content_id in content_ids if content_id]
+        lease_token = job_data.get("lease_token")
 
-        if not content_type or not content_id:
-            logger.error("Invalid job data: missing content_type or content_id")
+        if content_type not in HATE_SPEECH_CONTENT_SOURCES or not content_ids:
+            logger.error("Invalid job data: missing content_type or content_ids")
             return False
 
         # Fetch content from appropriate collection
-        collection = posts_collection if content_type == "post" else comments_collection
-        content_data = collection.find_one({"id": content_id})
-
-        if not content_data:
-            logger.error(f"{content_type} {content_id} not found")
+        db_name, collection_name, key = HATE_SPEECH_CONTENT_SOURCES[content_type]
+        collection = mongo_client[db_name][collection_name]
+        if key == "_id":
+            # 4chan posts are keyed by ObjectId, sent as strings in job args
+            content_ids = [ObjectId(content_id) for content_id in content_ids]
+        documents = list(collection.find({key: {"$in": content_ids}}))
+        found = len(documents)
+        documents = [doc for doc in documents if holds_lease(doc, lease_token)]
+        if len(documents) < found:
+            logger.info(
+                f"Skipping {found - len(documents)} {content_type}s no longer "
+                f"leased to this job"
+            )
+
+        if found < len(content_ids):
+            logger.warning(
+                f"{len(content_ids) - found} of {len(content_ids)} "
+                f"{content_type}s not found"
+            )
+        if not documents:
             return False
 
-        return process_content(content_type, content_data, detector, collections)
+        detector = get_detector()
+        operations = [
+            operations
+            for operations in classification_pool.map(
+                lambda doc: process_content(content_type, doc, detector, lease_token),
+                documents,
+            )
+            if operations
+        ]
+
+        dead_letters = mongo_client[MONGODB_DB][DEAD_LETTER_COLLECTION]
+        for operation, dead_letter in operations:
+            result_writer.add(collection, operation)
+            if dead_letter:
+                result_writer.add(dead_letters, dead_letter)
+        # Batched with other jobs' results, but written before this job is
+        # acked so a stopped worker can't lose them
+        result_writer.flush()
+
+        # This job's results are written, so the sweep counts them too
+        try:
+            roll_up_pending(mongo_client, content_type)
+        except Exception as e:
+            logger.error(f"Error rolling up {content_type}s: {str(e)}")
+
+        logger.info(
+            f"Processed {len(operations)}/{len(content_ids)} {content_type}s "
+            f"for hate speech detection | {detector.cache.summary()}"
+            + (f" | {detector.prefilter.summary()}" if detector.prefilter else "")
+            + f" | {detector.limiter.summary()}"
+            + f" | {detector.breaker.summary()}"
+            + f" | {result_writer.summary()}"
+        )
+        return True
 
     except Exception as e:
         logger.error(f"Error in hate speech detection job: {str(e)}")
         raise
 
 
+class ThreadedConsumer(Consumer):
+    """Consumer running jobs in a thread pool instead of pyfaktory's process
+    pool, so concurrent jobs share the detector, its limiter and the result
+    writer rather than each forked process keeping its own"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.pool = ThreadPool(max_workers=self.concurrency)
+
+
 def main():
     """
     Initialize and run the hate speech detection worker
@@ -210,31 +365,36 @@ def main():
     max_consecutive_errors = 3
     base_sleep_time = 30
 
-    while True:
-        try:
-            with Client(faktory_url=FAKTORY_URL, role="consumer") as client:
-                consumer = Consumer(
-                    client=client,
-                    queues=["hate_speech_detection_queue"],
-                    concurrency=15,
-                )
-                consumer.register("detect_hate_speech", process_hate_speech_job)
-                logger.info("Worker started and listening for jobs...")
-                consumer.run()
-                consecutive_errors = 0
+    try:
+        while True:
+            try:
+                with Client(faktory_url=FAKTORY_URL, role="consumer") as client:
+                    consumer = ThreadedConsumer(
+                        client=client,
+                        queues=["hate_speech_detection_queue"],
+                        concurrency=4,
+                    )
+                    consumer.register("detect_hate_speech", process_hate_speech_job)
+                    logger.info("Worker started and listening for jobs...")
+                    consumer.run()
+                    consecutive_errors = 0
 
-        except Exception as e:
-            consecutive_errors += 1
-            sleep_time = base_sleep_time * (2 ** (consecutive_errors - 1))
+            except Exception as e:
+                consecutive_errors += 1
+                sleep_time = base_sleep_time * (2 ** (consecutive_errors - 1))
 
-            logger.error(f"Worker error (attempt {consecutive_errors}): {str(e)}")
-            logger.info(f"Restarting worker in {sleep_time} seconds...")
+                logger.error(f"Worker error (attempt {consecutive_errors}): {str(e)}")
+                logger.info(f"Restarting worker in {sleep_time} seconds...")
 
-            if consecutive_errors >= max_consecutive_errors:
-                logger.critical("Too many consecutive errors. Exiting...")
-                raise
+                if consecutive_errors >= max_consecutive_errors:
+                    logger.critical("Too many consecutive errors. Exiting...")
+                    raise
 
-            time.sleep(sleep_time)
+                time.sleep(sleep_time)
+    finally:
+        # Jobs flush their own results; this writes out any a job still
+        # running buffered and logs the writer's totals
+        result_writer.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,248 @@
+import threading
+import time
+from pymongo import IndexModel, ASCENDING
+from config import (
+    MONGODB_DB,
+    MONGODB_COLLECTION,
+    COMMENTS_COLLECTION,
+    POST_HISTORY_COLLECTION,
+    COMMENT_EXPANSIONS_COLLECTION,
+    JOB_CHECKPOINTS_COLLECTION,
+    WORKER_NODES_COLLECTION,
+    FOURCHAN_DB,
+    FOURCHAN_THREADS_COLLECTION,
+    FOURCHAN_POSTS_COLLECTION,
+    SCHEMA_VERSIONS_COLLECTION,
+    CLASSIFICATION_CACHE_COLLECTION,
+    CLASSIFICATION_CACHE_TTL,
+    TOXICITY_SAMPLES_COLLECTION,
+    TOXICITY_ESTIMATES_COLLECTION,
+    TOXICITY_ROLLUPS_COLLECTION,
+    DEAD_LETTER_COLLECTION,
+)
+from analysis_state import OPEN_STATES, LEASED, UNSAMPLED
+from db import get_mongo_client
+from utils import setup_logger
+
+logger = setup_logger("index_manifest")
+
+# Bump whenever INDEX_MANIFEST changes so workers pick it up on next deploy
+INDEX_MANIFEST_VERSION = 14
+
+# Time-series collections, created before their indexes are applied
+TIMESERIES_MANIFEST = {
+    (MONGODB_DB, POST_HISTORY_COLLECTION): {
+        "timeField": "timestamp",
+        "metaField": "post_id",
+        "granularity": "minutes",
+    },
+}
+
+
+def analysis_state_indexes():
+    """Claim queries only ever look at open documents; partialFilterExpression
+    with $in needs MongoDB 6.0+"""
+    return [
+        IndexModel(
+            [("analysis_state", ASCENDING), ("lease_expires_at", ASCENDING)],
+            name="analysis_state_open",
+            partialFilterExpression={"analysis_state": {"$in": OPEN_STATES}},
+        ),
+        IndexModel(
+            "lease_token",
+            name="lease_token_leased",
+            partialFilterExpression={"analysis_state": LEASED},
+        ),
+    ]
+
+
+def unsampled_index(community_field, time_field):
+    """Sample draws only look at unsampled documents of one community-hour"""
+    return IndexModel(
+        [(community_field, ASCENDING), (time_field, ASCENDING)],
+        name="unsampled_community_time",
+        partialFilterExpression={"analysis_state": UNSAMPLED},
+    )
+
+
+def pending_rollup_indexes():
+    """Rollup sweeps only look at results not yet rolled up and at claims of
+    sweeps that may have failed"""
+    return [
+        IndexModel(
+            "rolled_up",
+            name="rolled_up_pending",
+            partialFilterExpression={"rolled_up": False},
+        ),
+        IndexModel(
+            "rolled_up",
+            name="rolled_up_claimed",
+            partialFilterExpression={"rolled_up": {"$type": "objectId"}},
+        ),
+    ]
+
+
+INDEX_MANIFEST = {
+    (MONGODB_DB, MONGODB_COLLECTION): [
+        IndexModel("id", unique=True),
+        IndexModel("created"),
+        IndexModel("subreddit"),
+        IndexModel([("subreddit", ASCENDING), ("created", ASCENDING)]),
+        IndexModel("last_updated"),
+        IndexModel("removed"),
+        IndexModel("deleted"),
+        IndexModel("hate_speech_analyzed"),
+        *analysis_state_indexes(),
+        unsampled_index("subreddit", "created"),
+        *pending_rollup_indexes(),
+    ],
+    (MONGODB_DB, COMMENTS_COLLECTION): [
+        IndexModel("id", unique=True),
+        IndexModel([("post_id", ASCENDING), ("created_utc", ASCENDING)]),
+        IndexModel("parent_id"),
+        IndexModel("path"),
+        IndexModel("last_updated"),
+        IndexModel("is_root"),
+        IndexModel("depth"),
+        IndexModel("hate_speech_analyzed"),
+        # Per community-day counts of toxicity_sampling.py
+        IndexModel([("subreddit", ASCENDING), ("created_utc", ASCENDING)]),
+        *analysis_state_indexes(),
+        unsampled_index("subreddit", "created_utc"),
+        *pending_rollup_indexes(),
+    ],
+    (MONGODB_DB, POST_HISTORY_COLLECTION): [
+        IndexModel([("post_id", ASCENDING), ("timestamp", ASCENDING)]),
+    ],
+    (MONGODB_DB, COMMENT_EXPANSIONS_COLLECTION): [
+        # Abandon frontiers of posts nobody refreshed for a week
+        IndexModel("updated_at", expireAfterSeconds=7 * 24 * 3600),
+    ],
+    (MONGODB_DB, JOB_CHECKPOINTS_COLLECTION): [
+        # Checkpoints of jobs that were never retried are useless after a day
+        IndexModel("updated_at", expireAfterSeconds=24 * 3600),
+    ],
+    (MONGODB_DB, WORKER_NODES_COLLECTION): [
+        IndexModel([("role", ASCENDING), ("last_seen", ASCENDING)]),
+        # Departed nodes are kept a day so their queues can be drained
+        IndexModel("last_seen_at", expireAfterSeconds=24 * 3600),
+    ],
+    (MONGODB_DB, CLASSIFICATION_CACHE_COLLECTION): [
+        IndexModel("created_at", expireAfterSeconds=CLASSIFICATION_CACHE_TTL),
+    ],
+    (MONGODB_DB, DEAD_LETTER_COLLECTION): [
+        IndexModel(
+            [
+                ("state", ASCENDING),
+                ("redrives", ASCENDING),
+                ("parked_at", ASCENDING),
+            ]
+        ),
+        # Entries of re-driven documents are history after a week
+        IndexModel("redriven_at", expireAfterSeconds=7 * 24 * 3600),
+    ],
+    (MONGODB_DB, TOXICITY_SAMPLES_COLLECTION): [
+        IndexModel(
+            [
+                ("content_type", ASCENDING),
+                ("community", ASCENDING),
+                ("day_start", ASCENDING),
+            ]
+        ),
+        IndexModel("estimated"),
+    ],
+    (MONGODB_DB, TOXICITY_ESTIMATES_COLLECTION): [
+        IndexModel([("platform", ASCENDING), ("date", ASCENDING)]),
+    ],
+    (MONGODB_DB, TOXICITY_ROLLUPS_COLLECTION): [
+        IndexModel([("content_type", ASCENDING), ("hour_start", ASCENDING)]),
+    ],
+    (FOURCHAN_DB, FOURCHAN_THREADS_COLLECTION): [
+        IndexModel([("board", ASCENDING), ("thread_id", ASCENDING)], unique=True),
+        IndexModel("last_modified"),
+        IndexModel("archived"),
+        IndexModel([("board", ASCENDING)]),
+    ],
+    (FOURCHAN_DB, FOURCHAN_POSTS_COLLECTION): [
+        IndexModel(
+            [("board", ASCENDING), ("thread_id", ASCENDING), ("no", ASCENDING)],
+            unique=True,
+        ),
+        IndexModel([("thread_id", ASCENDING)]),
+        IndexModel([("board", ASCENDING)]),
+        IndexModel([("no", ASCENDING)]),
+        IndexModel([("hate_speech_analyzed", ASCENDING)]),
+        IndexModel([("hate_speech_enqueued_at", ASCENDING)]),
+        # Keyset pagination of 4chan_hate_speech.py
+        IndexModel([("time", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("board", ASCENDING), ("time", ASCENDING)]),
+        *analysis_state_indexes(),
+        unsampled_index("board", "time"),
+        *pending_rollup_indexes(),
+    ],
+}
+
+_manifest_checked = False
+_manifest_lock = threading.Lock()
+
+
+def _versions_collection(client):
+    return client[MONGODB_DB][SCHEMA_VERSIONS_COLLECTION]
+
+
+def apply_index_manifest(client):
+    """Create every index in the manifest and record the applied version"""
+    for (db_name, collection_name), options in TIMESERIES_MANIFEST.items():
+        db = client[db_name]
+        if collection_name not in db.list_collection_names():
+            db.create_collection(collection_name, timeseries=options)
+            logger.info(f"Created time-series collection {db_name}.{collection_name}")
+
+    for (db_name, collection_name), indexes in INDEX_MANIFEST.items():
+        client[db_name][collection_name].create_indexes(indexes)
+        logger.info(
+            f"Ensured {len(indexes)} indexes on {db_name}.{collection_name}"
+        )
+
+    _versions_collection(client).update_one(
+        {"_id": "index_manifest"},
+        {"$set": {"version": INDEX_MANIFEST_VERSION, "applied_at": time.time()}},
+        upsert=True,
+    )
+
+
+def ensure_indexes(client):
+    """Apply the manifest lazily, at most once per process and once per version.
+
+    Workers call this on first use; it costs a single find_one when the
+    manifest was already applied by this deploy (or by `python3 src/indexes.py`).
+    """
+    global _manifest_checked
+
+    if _manifest_checked:
+        return
+
+    with _manifest_lock:
+        if _manifest_checked:
+            return
+
+        applied = _versions_collection(client).find_one({"_id": "index_manifest"})
+        if not applied or applied.get("version", 0) < INDEX_MANIFEST_VERSION:
+            logger.info(f"Applying index manifest v{INDEX_MANIFEST_VERSION}")
+            apply_index_manifest(client)
+
+        _manifest_checked = True
+
+
+def main():
+    """Apply the index manifest as a one-off deploy step"""
+    try:
+        apply_index_manifest(get_mongo_client())
+        logger.info(f"Index manifest v{INDEX_MANIFEST_VERSION} applied")
+    except Exception as e:
+        logger.critical(f"Failed to apply index manifest: {str(e)}")
+        raise
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import bisect
+import hashlib
+import threading
+import time
+from datetime import datetime, timezone
+from pyfaktory import Consumer
+from config import (
+    WORKER_NODE_ID,
+    NODE_HEARTBEAT_INTERVAL,
+    NODE_LIVENESS_TIMEOUT,
+    PARTITION_VNODES,
+)
+
+
+def partition_queue(base_queue, node_id):
+    """Name of a node's private copy of base_queue"""
+    return f"{base_queue}.{node_id}"
+
+
+def _ring_hash(key):
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+
+class ConsistentHashRing:
+    """Maps keys (boards, threads, subreddits) to worker nodes.
+
+    Each node owns PARTITION_VNODES points on the ring, so adding or removing
+    a node only moves about 1/N of the keys.
+    """
+
+    def __init__(self, nodes=(), vnodes=PARTITION_VNODES):
+        self.vnodes = vnodes
+        self.nodes = sorted(set(nodes))
+        self._points = []
+        self._owners = []
+        for node in self.nodes:
+            for i in range(vnodes):
+                self._points.append(_ring_hash(f"{node}#{i}"))
+                self._owners.append(node)
+        order = sorted(range(len(self._points)), key=self._points.__getitem__)
+        self._points = [self._points[i] for i in order]
+        self._owners = [self._owners[i] for i in order]
+
+    def node_for(self, key):
+        """Node owning key, or None when the ring is empty"""
+        if not self._points:
+            return None
+        position = bisect.bisect(self._points, _ring_hash(str(key)))
+        return self._owners[position % len(self._points)]
+
+
+class NodeRegistry:
+    """Worker node membership for one role (e.g. "reddit", "4chan"),
+    maintained through heartbeats in a shared collection"""
+
+    def __init__(self, collection, role, node_id=WORKER_NODE_ID):
+        self.collection = collection
+        self.role = role
+        self.node_id = node_id
+
+    def heartbeat(self):
+        now = time.time()
+        self.collection.update_one(
+            {"_id": f"{self.role}:{self.node_id}"},
+            {
+                "$set": {
+                    "role": self.role,
+                    "node_id": self.node_id,
+                    "last_seen": now,
+                    "last_seen_at": datetime.fromtimestamp(now, tz=timezone.utc),
+                }
+            },
+            upsert=True,
+        )
+
+    def leave(self):
+        self.collection.delete_one({"_id": f"{self.role}:{self.node_id}"})
+
+    def members(self):
+        """Return (live, departed) node ids for this role"""
+        cutoff = time.time() - NODE_LIVENESS_TIMEOUT
+        live, departed = [], []
+        for doc in self.collection.find({"role": self.role}):
+            (live if doc["last_seen"] >= cutoff else departed).append(doc["node_id"])
+        return sorted(live), sorted(departed)
+
+
+class PartitionRouter:
+    """Routes partition keys to per-node queues, rebuilding the ring whenever
+    node membership changes"""
+
+    def __init__(self, registry, logger, refresh_interval=NODE_HEARTBEAT_INTERVAL):
+        self.registry = registry
+        self.logger = logger
+        self.refresh_interval = refresh_interval
+        self._ring = ConsistentHashRing()
+        self._refreshed_at = 0
+
+    @property
+    def ring(self):
+        if time.time() - self._refreshed_at >= self.refresh_interval:
+            try:
+                live, _ = self.registry.members()
+                if live != self._ring.nodes:
+                    self.logger.info(
+                        f"Rebalancing {self.registry.role} partitions across "
+                        f"{len(live)} nodes: {', '.join(live) or 'none'}"
+                    )
+                    self._ring = ConsistentHashRing(live)
+            except Exception as e:
+                self.logger.error(f"Error refreshing node membership: {str(e)}")
+            self._refreshed_at = time.time()
+        return self._ring
+
+    def node_for(self, key):
+        return self.ring.node_for(key)
+
+    def queue_for(self, base_queue, key):
+        """Partition queue of the node owning key, or the shared queue when
+        no node is registered"""
+        node = self.node_for(key)
+        return partition_queue(base_queue, node) if node else base_queue
+
+
+class NodeMembership:
+    """Keeps this node registered and tracks the queues it should consume.
+
+    For each base queue (in the given priority order) a node consumes its own
+    partition queue, then the shared queue; the partition queues of departed
+    nodes come last so their backlog is drained.
+    """
+
+    def __init__(self, registry, base_queues, logger, on_change=None):
+        self.registry = registry
+        self.base_queues = list(base_queues)
+        self.logger = logger
+        self.on_change = on_change
+        self.live_nodes = [registry.node_id]
+        self.departed_nodes = []
+        self._lock = threading.Lock()
+
+    def _beat(self):
+        self.registry.heartbeat()
+        live, departed = self.registry.members()
+        with self._lock:
+            changed = live != self.live_nodes
+            self.live_nodes = live or [self.registry.node_id]
+            self.departed_nodes = departed
+        if changed:
+            self.logger.info(
+                f"{self.registry.role} nodes: {len(live)} live, {len(departed)} departed"
+            )
+            if self.on_change:
+                self.on_change(self)
+
+    def start(self):
+        """Register now and keep heartbeating from a daemon thread"""
+        self._beat()
+
+        def loop():
+            while True:
+                time.sleep(NODE_HEARTBEAT_INTERVAL)
+                try:
+                    self._beat()
+                except Exception as e:
+                    self.logger.error(f"Heartbeat failed: {str(e)}")
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def queues(self, base_queues=None):
+        base_queues = base_queues or self.base_queues
+        with self._lock:
+            departed = list(self.departed_nodes)
+        queues = []
+        for queue in base_queues:
+            queues += [partition_queue(queue, self.registry.node_id), queue]
+        return queues + [
+            partition_queue(q, node) for node in departed for q in base_queues
+        ]
+
+
+class PartitionedConsumer(Consumer):
+    """Consumer fetching from this node's partition queues before the shared
+    and orphaned ones"""
+
+    def __init__(self, membership, **kwargs):
+        super().__init__(**kwargs)
+        self.membership = membership
+
+    def get_queues(self):
+        return self.membership.queues()
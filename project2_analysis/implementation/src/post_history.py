@@ -0,0 +1,129 @@
+from datetime import datetime, timezone
+from config import POST_HISTORY_COLLECTION
+
+# Mutable post metrics recorded at every refresh
+HISTORY_FIELDS = (
+    "score",
+    "num_comments",
+    "upvote_ratio",
+    "removed",
+    "deleted",
+)
+
+
+def get_post_history_collection(db):
+    """Return the time-series collection holding post score history"""
+    return db[POST_HISTORY_COLLECTION]
+
+
+def build_history_point(processed_post):
+    """Build one time-series measurement from a processed post"""
+    point = {
+        "timestamp": datetime.fromtimestamp(
+            processed_post["last_updated"], tz=timezone.utc
+        ),
+        "post_id": processed_post["id"],
+    }
+    for field in HISTORY_FIELDS:
+        point[field] = processed_post.get(field)
+    return point
+
+
+def record_history_point(history_collection, processed_post):
+    """Append a measurement for a post; never reads or rewrites earlier points"""
+    history_collection.insert_one(build_history_point(processed_post))
+
+
+def get_post_trajectory(history_collection, post_id, start=None, end=None):
+    """Return the measurements of one post in time order.
+
+    start/end are optional datetimes bounding the range scan.
+    """
+    query = {"post_id": post_id}
+    time_range = {}
+    if start:
+        time_range["$gte"] = start
+    if end:
+        time_range["$lt"] = end
+    if time_range:
+        query["timestamp"] = time_range
+
+    return list(
+        history_collection.find(query, {"_id": 0}).sort("timestamp", 1)
+    )
+
+
+def get_score_trajectories(history_collection, post_ids, start, end, unit="hour"):
+    """Return per-post score trajectories bucketed by unit (minute/hour/day).
+
+    Each row holds post_id, bucket and the max/last score and comment count
+    seen in that bucket, ready for a pandas pivot.
+    """
+    pipeline = [
+        {
+            "$match": {
+                "post_id": {"$in": list(post_ids)},
+                "timestamp": {"$gte": start, "$lt": end},
+            }
+        },
+        {"$sort": {"timestamp": 1}},
+        {
+            "$group": {
+                "_id": {
+                    "post_id": "$post_id",
+                    "bucket": {"$dateTrunc": {"date": "$timestamp", "unit": unit}},
+                },
+                "max_score": {"$max": "$score"},
+                "last_score": {"$last": "$score"},
+                "last_num_comments": {"$last": "$num_comments"},
+                "samples": {"$sum": 1},
+            }
+        },
+        {"$sort": {"_id.post_id": 1, "_id.bucket": 1}},
+        {
+            "$project": {
+                "_id": 0,
+                "post_id": "$_id.post_id",
+                "bucket": "$_id.bucket",
+                "max_score": 1,
+                "last_score": 1,
+                "last_num_comments": 1,
+                "samples": 1,
+            }
+        },
+    ]
+    return list(history_collection.aggregate(pipeline))
+
+
+def get_score_growth(history_collection, post_ids, start, end):
+    """Return first/last score per post in a window, for growth-rate analysis"""
+    pipeline = [
+        {
+            "$match": {
+                "post_id": {"$in": list(post_ids)},
+                "timestamp": {"$gte": start, "$lt": end},
+            }
+        },
+        {"$sort": {"timestamp": 1}},
+        {
+            "$group": {
+                "_id": "$post_id",
+                "first_seen": {"$first": "$timestamp"},
+                "last_seen": {"$last": "$timestamp"},
+                "first_score": {"$first": "$score"},
+                "last_score": {"$last": "$score"},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "post_id": "$_id",
+                "first_seen": 1,
+                "last_seen": 1,
+                "first_score": 1,
+                "last_score": 1,
+                "score_change": {"$subtract": ["$last_score", "$first_score"]},
+            }
+        },
+    ]
+    return list(history_collection.aggregate(pipeline))
@@ -0,0 +1,317 @@
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime
+from config import (
+    MONGODB_DB,
+    MONGODB_COLLECTION,
+    COMMENTS_COLLECTION,
+    FOURCHAN_DB,
+    FOURCHAN_POSTS_COLLECTION,
+    PREFILTER_ENABLED,
+    PREFILTER_MODEL_FILE,
+    PREFILTER_LEXICON_FILE,
+    PREFILTER_HASH_BUCKETS,
+    PREFILTER_NORMAL_THRESHOLD,
+    PREFILTER_AUDIT_RATE,
+    PREFILTER_TRAIN_LIMIT,
+)
+from classification_cache import normalize_text
+from db import get_mongo_client
+from text_normalization import TEXT_FIELDS, content_text
+from utils import setup_logger
+
+logger = setup_logger("prefilter")
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+# Where labelled text lives: (db, collection, content type of its text)
+TRAINING_SOURCES = [
+    (MONGODB_DB, MONGODB_COLLECTION, "post"),
+    (MONGODB_DB, COMMENTS_COLLECTION, "comment"),
+    (FOURCHAN_DB, FOURCHAN_POSTS_COLLECTION, "4chan_post"),
+]
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(normalize_text(text))
+
+
+def hashed_features(tokens, buckets=PREFILTER_HASH_BUCKETS):
+    """Bag of hashed word unigrams and bigrams.
+
+    crc32 rather than hash() so buckets agree across processes and runs.
+    """
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    features = {}
+    for gram in grams:
+        bucket = zlib.crc32(gram.encode()) % buckets
+        features[bucket] = features.get(bucket, 0) + 1
+    if features:
+        # Length-normalize so long posts don't saturate the sigmoid
+        norm = math.sqrt(sum(v * v for v in features.values()))
+        features = {k: v / norm for k, v in features.items()}
+    return features
+
+
+def sigmoid(z):
+    if z < -35:
+        return 0.0
+    return 1.0 / (1.0 + math.exp(-z))
+
+
+def load_lexicon(path=PREFILTER_LEXICON_FILE):
+    """Terms (one per line) that always send a text to the API"""
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {
+            normalize_text(line)
+            for line in f
+            if line.strip() and not line.startswith("#")
+        }
+
+
+class PreFilter:
+    """CPU-only screen in front of the ModerateHatespeech API.
+
+    A text is labelled normal locally only when it contains no lexicon term
+    and the hashed n-gram model gives it a hate probability below the
+    threshold. Everything else, plus a small audit sample of the locally
+    confident texts, still goes to the API so agreement stays measurable.
+    """
+
+    def __init__(self, model, lexicon=None, threshold=PREFILTER_NORMAL_THRESHOLD):
+        self.weights = {int(k): v for k, v in model["weights"].items()}
+        self.bias = model["bias"]
+        self.buckets = model.get("buckets", PREFILTER_HASH_BUCKETS)
+        self.lexicon = set(model.get("lexicon", [])) | (lexicon or set())
+        self.threshold = threshold
+        self.version = model.get("trained_at")
+        self.stats = {"local": 0, "api": 0, "audited": 0}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path=PREFILTER_MODEL_FILE):
+        """Load the trained model, or return None if there is none"""
+        if not os.path.exists(path):
+            logger.warning(f"No pre-filter model at {path}; all texts go to the API")
+            return None
+        try:
+            with open(path) as f:
+                return cls(json.load(f), lexicon=load_lexicon())
+        except Exception as e:
+            logger.error(f"Error loading pre-filter model: {str(e)}")
+            return None
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def hate_probability(self, tokens):
+        features = hashed_features(tokens, self.buckets)
+        z = self.bias + sum(self.weights.get(k, 0.0) * v for k, v in features.items())
+        return sigmoid(z)
+
+    def has_lexicon_term(self, tokens):
+        if not self.lexicon:
+            return False
+        grams = set(tokens) | {f"{a} {b}" for a, b in zip(tokens, tokens[1:])}
+        return not self.lexicon.isdisjoint(grams)
+
+    def screen(self, text):
+        """Return (local_result, audit) for a text.
+
+        local_result is a complete hate speech result when the text can be
+        labelled normal without the API, else None. audit is set when a
+        confident text was sampled for an API check; attach it to the API
+        result.
+        """
+        tokens = tokenize(text)
+        if self.has_lexicon_term(tokens):
+            self._count("api")
+            return None, None
+
+        p_hate = self.hate_probability(tokens)
+        if p_hate >= self.threshold:
+            self._count("api")
+            return None, None
+
+        audit = {"class": "normal", "p_hate": round(p_hate, 4), "model": self.version}
+        if random.random() < PREFILTER_AUDIT_RATE:
+            self._count("audited")
+            return None, audit
+
+        self._count("local")
+        return (
+            {
+                "class": "normal",
+                "confidence": round(1 - p_hate, 4),
+                "analyzed_at": datetime.utcnow().timestamp(),
+                "source": "prefilter",
+                "model": self.version,
+            },
+            None,
+        )
+
+    def summary(self):
+        screened = sum(self.stats.values())
+        local_share = self.stats["local"] / screened if screened else 0.0
+        return (
+            f"Pre-filter: {local_share:.1%} labelled locally "
+            f"({self.stats['local']:,d} local, {self.stats['api']:,d} api, "
+            f"{self.stats['audited']:,d} audited)"
+        )
+
+
+def load_prefilter():
+    """The pre-filter detectors should use, or None when disabled"""
+    return PreFilter.load() if PREFILTER_ENABLED else None
+
+
+def iter_labelled_texts(client, limit=PREFILTER_TRAIN_LIMIT):
+    """Yield (tokens, is_hate) for texts the API itself classified"""
+    for db_name, collection_name, content_type in TRAINING_SOURCES:
+        query = {
+            "hate_speech_result.class": {"$exists": True},
+            # Never learn from the pre-filter's own labels
+            "hate_speech_result.source": {"$ne": "prefilter"},
+        }
+        projection = {field: 1 for field in TEXT_FIELDS[content_type]}
+        projection["hate_speech_result.class"] = 1
+        cursor = client[db_name][collection_name].find(query, projection).limit(limit)
+        for doc in cursor:
+            tokens = tokenize(content_text(content_type, doc))
+            if tokens:
+                yield tokens, doc["hate_speech_result"]["class"] != "normal"
+
+
+def train_model(samples, epochs=5, learning_rate=0.5, l2=1e-6):
+    """Logistic regression by SGD over hashed features.
+
+    Classes are weighted inversely to their frequency since flagged text
+    is rare.
+    """
+    positives = sum(1 for _, label in samples if label)
+    negatives = len(samples) - positives
+    if not positives or not negatives:
+        raise ValueError("Training data needs both normal and flagged texts")
+    class_weight = {
+        True: len(samples) / (2 * positives),
+        False: len(samples) / (2 * negatives),
+    }
+
+    weights, bias = {}, 0.0
+    features = [(hashed_features(tokens), label) for tokens, label in samples]
+    for epoch in range(epochs):
+        random.shuffle(features)
+        rate = learning_rate / (1 + epoch)
+        for x, label in features:
+            z = bias + sum(weights.get(k, 0.0) * v for k, v in x.items())
+            gradient = (sigmoid(z) - label) * class_weight[label]
+            for k, v in x.items():
+                w = weights.get(k, 0.0)
+                weights[k] = w - rate * (gradient * v + l2 * w)
+            bias -= rate * gradient
+    return weights, bias
+
+
+def evaluate(prefilter, samples):
+    """Share of texts labelled locally and how many of those were flagged"""
+    local, missed = 0, 0
+    for tokens, label in samples:
+        if prefilter.has_lexicon_term(tokens):
+            continue
+        if prefilter.hate_probability(tokens) < prefilter.threshold:
+            local += 1
+            missed += label
+    return {
+        "holdout_size": len(samples),
+        "local_share": local / len(samples) if samples else 0.0,
+        "flagged_among_local": missed / local if local else 0.0,
+    }
+
+
+def train(path=PREFILTER_MODEL_FILE):
+    """Train on stored API labels, report holdout agreement and save"""
+    samples = list(iter_labelled_texts(get_mongo_client()))
+    random.shuffle(samples)
+    split = int(len(samples) * 0.9)
+    train_set, holdout = samples[:split], samples[split:]
+    logger.info(f"Training pre-filter on {len(train_set):,d} labelled texts")
+
+    weights, bias = train_model(train_set)
+    model = {
+        "weights": {str(k): round(v, 6) for k, v in weights.items() if abs(v) > 1e-6},
+        "bias": bias,
+        "buckets": PREFILTER_HASH_BUCKETS,
+        "trained_at": int(time.time()),
+    }
+    model["holdout"] = evaluate(PreFilter(model, lexicon=load_lexicon()), holdout)
+    logger.info(
+        f"Holdout: {model['holdout']['local_share']:.1%} labelled locally, "
+        f"{model['holdout']['flagged_among_local']:.2%} of those flagged by the API"
+    )
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(model, f)
+    os.replace(tmp_path, path)
+    logger.info(f"Pre-filter model saved to {path}")
+
+
+def report():
+    """Agreement between the pre-filter and the API on audited texts"""
+    client = get_mongo_client()
+    for db_name, collection_name, _ in TRAINING_SOURCES:
+        pipeline = [
+            {"$match": {"hate_speech_result.prefilter": {"$exists": True}}},
+            {
+                "$group": {
+                    "_id": None,
+                    "audited": {"$sum": 1},
+                    "agreed": {
+                        "$sum": {
+                            "$cond": [
+                                {"$eq": ["$hate_speech_result.class", "normal"]},
+                                1,
+                                0,
+                            ]
+                        }
+                    },
+                }
+            },
+        ]
+        result = list(client[db_name][collection_name].aggregate(pipeline))
+        if result:
+            audited, agreed = result[0]["audited"], result[0]["agreed"]
+            logger.info(
+                f"{db_name}.{collection_name}: {agreed:,d}/{audited:,d} audited "
+                f"texts agreed with the API ({agreed / audited:.2%})"
+            )
+        else:
+            logger.info(f"{db_name}.{collection_name}: no audited texts yet")
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else "train"
+    try:
+        if command == "train":
+            train()
+        elif command == "report":
+            report()
+        else:
+            logger.error(f"Unknown command {command}; use train or report")
+    except Exception as e:
+        logger.error(f"Pre-filter {command} failed: {str(e)}")
+        raise
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import json
+import logging
+import time
+from config import (
+    REQUESTS_PER_MINUTE,
+    REDDIT_RATE_LIMIT_FILE,
+    REDDIT_RATE_LIMIT_RESERVE,
+)
+from utils import file_lock
+
+logger = logging.getLogger("reddit_rate_limiter")
+
+
+class SharedRateLimiter:
+    """Token bucket shared by every thread and worker process on the host.
+
+    The bucket state lives in a small JSON file guarded by an advisory lock.
+    While Reddit's X-Ratelimit-Remaining/X-Ratelimit-Reset headers describe a
+    current window they take precedence over the local refill rate, so the
+    limiter spends exactly the budget the server reports. This host's share
+    of the budget is kept in the same file, so it applies to every process.
+    """
+
+    def __init__(
+        self,
+        state_file=REDDIT_RATE_LIMIT_FILE,
+        calls=REQUESTS_PER_MINUTE,
+        period=60,
+        reserve=REDDIT_RATE_LIMIT_RESERVE,
+    ):
+        self.state_file = state_file
+        self.lock_file = f"{state_file}.lock"
+        self.calls = calls
+        self.period = period
+        self.reserve = reserve
+
+    def set_share(self, share):
+        """Limit this host to a fraction of the API budget, e.g. 1/N when N
+        worker nodes share the same OAuth client"""
+        with file_lock(self.lock_file):
+            state = self._load()
+            state["share"] = share
+            state["tokens"] = min(state["tokens"], self.calls * share)
+            self._save(state)
+
+    def _load(self):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {
+                "tokens": self.calls,
+                "updated_at": time.time(),
+                "remaining": None,
+                "reset_at": 0,
+            }
+        state.setdefault("share", 1.0)
+        return state
+
+    def _save(self, state):
+        with open(self.state_file, "w") as f:
+            json.dump(state, f)
+
+    def _take(self, state, now):
+        """Consume one request from state, returning seconds to wait if none"""
+        # Server-reported window
+        if state["remaining"] is not None and state["reset_at"] > now:
+            if state["remaining"] - self.reserve >= 1:
+                state["remaining"] -= 1
+                return 0
+            return state["reset_at"] - now
+
+        # Local token bucket between windows
+        capacity = self.calls * state["share"]
+        rate = capacity / self.period
+        elapsed = max(0, now - state["updated_at"])
+        state["tokens"] = min(capacity, state["tokens"] + elapsed * rate)
+        state["updated_at"] = now
+        if state["tokens"] >= 1:
+            state["tokens"] -= 1
+            return 0
+        return (1 - state["tokens"]) / rate
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with file_lock(self.lock_file):
+                state = self._load()
+                wait = self._take(state, time.time())
+                self._save(state)
+
+            if wait <= 0:
+                return
+            logger.debug(f"Rate budget exhausted, waiting {wait:.2f} seconds")
+            time.sleep(wait)
+
+    def update_from_headers(self, headers):
+        """Feed X-Ratelimit-* response headers back into the shared bucket"""
+        try:
+            remaining = float(headers["X-Ratelimit-Remaining"])
+            reset_at = time.time() + float(headers["X-Ratelimit-Reset"])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        with file_lock(self.lock_file):
+            state = self._load()
+            remaining *= state["share"]
+            same_window = abs(state["reset_at"] - reset_at) < 2
+            if same_window and state["remaining"] is not None:
+                # Requests still in flight are not counted by the server yet
+                remaining = min(remaining, state["remaining"])
+            state["remaining"] = remaining
+            state["reset_at"] = reset_at
+            self._save(state)
+
+    def penalize(self, headers):
+        """Stop all callers until the window a 429 response points at resets"""
+        retry_after = headers.get("Retry-After") or headers.get("X-Ratelimit-Reset")
+        try:
+            retry_after = float(retry_after)
+        except (TypeError, ValueError):
+            retry_after = 60
+
+        with file_lock(self.lock_file):
+            state = self._load()
+            state["remaining"] = 0
+            state["reset_at"] = max(state["reset_at"], time.time() + retry_after)
+            self._save(state)
+
+        return retry_after
+
+
+reddit_rate_limiter = SharedRateLimiter()
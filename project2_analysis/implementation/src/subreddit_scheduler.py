@@ -0,0 +1,151 @@
+import time
+from pymongo import UpdateOne
+from config import (
+    REDDIT_LIVE_WINDOW,
+    SUBREDDIT_MIN_POLL_INTERVAL,
+    SUBREDDIT_MAX_POLL_INTERVAL,
+    SUBREDDIT_LIVE_JOB_TIMEOUT,
+    SUBREDDIT_POSTS_PER_POLL,
+    MULTI_LISTING_MAX_POSTS,
+    MULTI_LISTING_MAX_SUBREDDITS,
+)
+
+LISTING_MAX_POSTS = 1000  # Reddit never pages deeper than this
+POLL_OVERLAP = 60  # Seconds re-read at the start of each window
+
+
+def chunk_subreddits(subreddits, size=MULTI_LISTING_MAX_SUBREDDITS, partition=None):
+    """Split subreddits into (partition, group) pairs that each fit one
+    multi-subreddit listing and never span two partitions"""
+    by_partition = {}
+    for subreddit in sorted(subreddits):
+        key = partition(subreddit) if partition else None
+        by_partition.setdefault(key, []).append(subreddit)
+
+    return [
+        (key, group[i : i + size])
+        for key, group in by_partition.items()
+        for i in range(0, len(group), size)
+    ]
+
+
+class SubredditCrawlScheduler:
+    """Plans live listing polls across many subreddits.
+
+    Each subreddit is polled at an interval proportional to how quiet it is,
+    measured from the posts already stored. Subreddits that are due are packed
+    into multi-subreddit listings (/r/a+b+c/new) sized so one job reads only a
+    few pages, so covering hundreds of quiet subreddits costs about as much as
+    a handful of busy ones. A subreddit counts as polled once a worker has
+    listed it; until then it is not planned again unless its job times out.
+    """
+
+    def __init__(self, subreddits, posts_collection, activity_collection, logger):
+        self.subreddits = list(subreddits)
+        self.posts_collection = posts_collection
+        self.activity_collection = activity_collection
+        self.logger = logger
+
+    def measure_activity(self, window=24 * 3600):
+        """Posts per second for each subreddit over the last window"""
+        since = time.time() - window
+        rates = {s: 0.0 for s in self.subreddits}
+        try:
+            pipeline = [
+                {
+                    "$match": {
+                        "subreddit": {"$in": self.subreddits},
+                        "created": {"$gte": since},
+                    }
+                },
+                {"$group": {"_id": "$subreddit", "count": {"$sum": 1}}},
+            ]
+            for row in self.posts_collection.aggregate(pipeline):
+                rates[row["_id"]] = row["count"] / window
+        except Exception as e:
+            self.logger.error(f"Error measuring subreddit activity: {str(e)}")
+        return rates
+
+    def poll_interval(self, rate):
+        """Seconds between polls so each poll finds about POSTS_PER_POLL posts"""
+        if rate <= 0:
+            return SUBREDDIT_MAX_POLL_INTERVAL
+        interval = SUBREDDIT_POSTS_PER_POLL / rate
+        return max(SUBREDDIT_MIN_POLL_INTERVAL, min(SUBREDDIT_MAX_POLL_INTERVAL, interval))
+
+    def plan(self, now=None, partition=None):
+        """Return listing batches that are due, each a dict with subreddits,
+        start_date, end_date and the partition (worker node) owning them.
+
+        partition maps a subreddit to its node; batches never mix nodes.
+        """
+        now = now or time.time()
+        rates = self.measure_activity()
+        state = {
+            doc["_id"]: doc
+            for doc in self.activity_collection.find(
+                {"_id": {"$in": self.subreddits}}
+            )
+        }
+
+        due = []
+        for subreddit in self.subreddits:
+            last_polled = state.get(subreddit, {}).get("last_polled_at")
+            last_enqueued = state.get(subreddit, {}).get("last_enqueued_at")
+            if (
+                last_enqueued is not None
+                and last_enqueued > (last_polled or 0)
+                and now - last_enqueued < SUBREDDIT_LIVE_JOB_TIMEOUT
+            ):
+                # Its live job is still queued or running
+                continue
+            if last_polled is None:
+                # New subreddits start with one live window of history
+                last_polled = now - REDDIT_LIVE_WINDOW
+            elif now - last_polled < self.poll_interval(rates[subreddit]):
+                continue
+            expected = min(LISTING_MAX_POSTS, rates[subreddit] * (now - last_polled))
+            due.append((expected, subreddit, last_polled))
+
+        # Busiest first so quiet subreddits fill the remaining room in batches
+        due.sort(reverse=True)
+        batches = []
+        for expected, subreddit, last_polled in due:
+            key = partition(subreddit) if partition else None
+            for batch in batches:
+                if (
+                    batch["partition"] == key
+                    and batch["expected_posts"] + expected <= MULTI_LISTING_MAX_POSTS
+                    and len(batch["subreddits"]) < MULTI_LISTING_MAX_SUBREDDITS
+                ):
+                    break
+            else:
+                batch = {
+                    "subreddits": [],
+                    "expected_posts": 0,
+                    "start_date": now,
+                    "partition": key,
+                }
+                batches.append(batch)
+
+            batch["subreddits"].append(subreddit)
+            batch["expected_posts"] += expected
+            batch["start_date"] = min(batch["start_date"], last_polled - POLL_OVERLAP)
+
+        for batch in batches:
+            batch["end_date"] = now
+        return batches
+
+    def mark_enqueued(self, subreddits, now=None):
+        """Record that subreddits were handed to a live job"""
+        now = now or time.time()
+        self._update(subreddits, {"$set": {"last_enqueued_at": now}})
+
+    def mark_polled(self, subreddits, polled_until):
+        """Record that a live job listed subreddits up to polled_until"""
+        self._update(subreddits, {"$max": {"last_polled_at": polled_until}})
+
+    def _update(self, subreddits, update):
+        operations = [UpdateOne({"_id": s}, update, upsert=True) for s in subreddits]
+        if operations:
+            self.activity_collection.bulk_write(operations, ordered=False)
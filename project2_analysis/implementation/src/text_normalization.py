@@ -0,0 +1,101 @@
+import html
+import re
+import sys
+from pymongo import UpdateOne
+from config import FOURCHAN_DB, FOURCHAN_POSTS_COLLECTION, BULK_WRITE_BATCH_SIZE
+from db import get_mongo_client
+from utils import setup_logger
+
+logger = setup_logger("text_normalization")
+
+# 4chan comment markup, compiled once. Post references (>>123, >>>/pol/123)
+# say nothing about the text and differ between otherwise identical replies.
+QUOTELINK_PATTERN = re.compile(
+    r'<a [^>]*class="quotelink"[^>]*>.*?</a>|<span class="deadlink">.*?</span>',
+    re.IGNORECASE | re.DOTALL,
+)
+WORD_BREAK_PATTERN = re.compile(r"<wbr\s*/?>", re.IGNORECASE)
+LINE_BREAK_PATTERN = re.compile(r"<br\s*/?>", re.IGNORECASE)
+TAG_PATTERN = re.compile(r"<[^>]+>")
+POST_REFERENCE_PATTERN = re.compile(r">>\d+|>>>/\w+/\d*")
+SPACE_PATTERN = re.compile(r"[^\S\n]+")
+
+# Fields holding the text classified for each content type
+TEXT_FIELDS = {
+    "post": ("title", "selftext"),
+    "comment": ("body",),
+    "4chan_post": ("com_text", "com"),
+}
+
+
+def normalize_4chan_comment(com):
+    """Plain text of a 4chan comment's HTML.
+
+    Tags are stripped and entities decoded; quote links are dropped while
+    greentext keeps its leading ">" and line breaks are kept.
+    """
+    if not com:
+        return ""
+    text = QUOTELINK_PATTERN.sub("", com)
+    text = WORD_BREAK_PATTERN.sub("", text)
+    text = LINE_BREAK_PATTERN.sub("\n", text)
+    text = html.unescape(TAG_PATTERN.sub("", text))
+    text = POST_REFERENCE_PATTERN.sub("", text)
+    lines = (SPACE_PATTERN.sub(" ", line).strip() for line in text.split("\n"))
+    return "\n".join(line for line in lines if line)
+
+
+def comment_text(post):
+    """Classified text of a stored 4chan post.
+
+    Posts crawled before com_text existed are normalized on the fly.
+    """
+    if "com_text" in post:
+        return post["com_text"] or ""
+    return normalize_4chan_comment(post.get("com"))
+
+
+def content_text(content_type, document):
+    """Text classified for a post, comment or 4chan post document"""
+    if content_type == "4chan_post":
+        return comment_text(document)
+    return " ".join(
+        document.get(field) or "" for field in TEXT_FIELDS[content_type]
+    ).strip()
+
+
+def backfill_comment_text():
+    """Store com_text on 4chan posts crawled before it existed"""
+    posts = get_mongo_client()[FOURCHAN_DB][FOURCHAN_POSTS_COLLECTION]
+    operations = []
+    updated = 0
+    for post in posts.find({"com_text": {"$exists": False}}, {"com": 1}):
+        operations.append(
+            UpdateOne(
+                {"_id": post["_id"]},
+                {"$set": {"com_text": normalize_4chan_comment(post.get("com"))}},
+            )
+        )
+        if len(operations) >= BULK_WRITE_BATCH_SIZE:
+            updated += posts.bulk_write(operations, ordered=False).modified_count
+            operations = []
+            logger.info(f"Normalized {updated:,d} 4chan posts")
+    if operations:
+        updated += posts.bulk_write(operations, ordered=False).modified_count
+    logger.info(f"Backfill complete: {updated:,d} 4chan posts normalized")
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else "backfill"
+    if command != "backfill":
+        logger.error(f"Unknown command {command}; use backfill")
+        return
+    try:
+        backfill_comment_text()
+    except Exception as e:
+        logger.error(f"com_text backfill failed: {str(e)}")
+        raise
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+import asyncio
+import sys
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from pymongo import UpdateOne
+from config import (
+    MONGODB_DB,
+    HATE_SPEECH_CONTENT_SOURCES,
+    TOXICITY_ROLLUPS_COLLECTION,
+    ROLLUP_BATCH_SIZE,
+    ROLLUP_SWEEP_INTERVAL,
+    ROLLUP_CLAIM_TIMEOUT,
+)
+from db import get_mongo_client
+from indexes import ensure_indexes
+from utils import setup_logger
+
+logger = setup_logger("toxicity_rollups")
+
+HOUR = 3600
+
+# Content type -> (platform, community field, time field, engagement field)
+ROLLUP_SOURCES = {
+    "post": ("reddit", "subreddit", "created", "score"),
+    "comment": ("reddit", "subreddit", "created_utc", "score"),
+    "4chan_post": ("4chan", "board", "time", "replies"),
+}
+
+# Document fields a sweep reads for the rollup
+ROLLUP_FIELDS = {
+    content_type: fields[1:] for content_type, fields in ROLLUP_SOURCES.items()
+}
+
+# A stored result whose increments are not applied yet; a sweep replaces
+# False with its claim id and that with True once counted, rebuild with True
+PENDING_ROLLUP = {"rolled_up": False}
+# Result writes skip documents already rolled up, so none is counted twice
+NOT_ROLLED_UP = {"rolled_up": {"$exists": False}}
+
+
+def rollup_id(content_type, community, hour_start):
+    return f"{content_type}:{community or ''}:{hour_start}"
+
+
+def pending_rollup(update):
+    """Fields flagging a result update for the next rollup sweep"""
+    return PENDING_ROLLUP if update.get("hate_speech_result") else {}
+
+
+def rollup_operation(content_type, document):
+    """Increments of the hourly rollup for a classified document.
+
+    Returns None unless the document has a result and a time. Each (content type,
+    community, hour) keeps count, flagged count and the sums, sums of
+    squares and cross-product of confidence and engagement, from which
+    averages, flagged rates and the confidence/engagement correlation of
+    any range follow. Engagement is counted as it was when rolled up.
+    """
+    result = document.get("hate_speech_result")
+    if not result:
+        return None
+    platform, community_field, time_field, engagement_field = ROLLUP_SOURCES[
+        content_type
+    ]
+    if document.get(time_field) is None:
+        return None
+    community = document.get(community_field)
+    hour_start = int(document[time_field] // HOUR * HOUR)
+    hour = datetime.fromtimestamp(hour_start, timezone.utc)
+    confidence = result.get("confidence") or 0.0
+    engagement = document.get(engagement_field) or 0
+    return UpdateOne(
+        {"_id": rollup_id(content_type, community, hour_start)},
+        {
+            "$setOnInsert": {
+                "platform": platform,
+                "content_type": content_type,
+                "community": community,
+                "day": hour.strftime("%Y-%m-%d"),
+                "hour": hour.hour,
+                "hour_start": hour_start,
+                "date": hour,
+            },
+            "$inc": {
+                "count": 1,
+                "flagged": int(result.get("class") != "normal"),
+                "confidence_sum": confidence,
+                "confidence_sq_sum": confidence * confidence,
+                "engagement_sum": engagement,
+                "engagement_sq_sum": engagement * engagement,
+                "confidence_engagement_sum": confidence * engagement,
+            },
+        },
+        upsert=True,
+    )
+
+
+def roll_up_pending(client, content_type, limit=ROLLUP_BATCH_SIZE):
+    """Apply the increments of documents classified since the last sweep.
+
+    Only result writes that actually landed leave rolled_up False behind.
+    Each batch is claimed by setting rolled_up to a fresh ObjectId, so
+    concurrent sweeps never count a document twice; exactly the documents
+    holding that id are counted and then marked True. Like a lease, a claim
+    left by a sweep that failed in between is taken over once it is older
+    than ROLLUP_CLAIM_TIMEOUT, recounting whatever part of its write landed.
+    Documents without a time are marked without being counted.
+    """
+    db_name, collection_name, _ = HATE_SPEECH_CONTENT_SOURCES[content_type]
+    collection = client[db_name][collection_name]
+    rollups = client[MONGODB_DB][TOXICITY_ROLLUPS_COLLECTION]
+    projection = {
+        field: 1 for field in ("hate_speech_result", *ROLLUP_FIELDS[content_type])
+    }
+
+    rolled_up = 0
+    while True:
+        # Claim ids start with their creation time, so older claims sort first
+        expired = ObjectId.from_datetime(
+            datetime.now(timezone.utc) - timedelta(seconds=ROLLUP_CLAIM_TIMEOUT)
+        )
+        claimable = {"$or": [PENDING_ROLLUP, {"rolled_up": {"$lt": expired}}]}
+        ids = [
+            document["_id"]
+            for document in collection.find(claimable, {"_id": 1}).limit(limit)
+        ]
+        if not ids:
+            break
+        claim = ObjectId()
+        collection.update_many(
+            {"_id": {"$in": ids}, **claimable}, {"$set": {"rolled_up": claim}}
+        )
+        claimed = list(
+            collection.find({"_id": {"$in": ids}, "rolled_up": claim}, projection)
+        )
+        operations = [
+            operation
+            for operation in (
+                rollup_operation(content_type, document) for document in claimed
+            )
+            if operation
+        ]
+        if len(operations) < len(claimed):
+            logger.warning(
+                f"Skipped {len(claimed) - len(operations)} {content_type}s "
+                f"without a result or time"
+            )
+        if operations:
+            rollups.bulk_write(operations, ordered=False)
+        collection.update_many({"rolled_up": claim}, {"$set": {"rolled_up": True}})
+        rolled_up += len(operations)
+        if len(ids) < limit:
+            break
+    return rolled_up
+
+
+async def roll_up_pending_async(content_types):
+    """Sweep from asyncio code; pymongo runs in a thread like the breaker's
+    dead-letter re-drives"""
+    for content_type in content_types:
+        try:
+            await asyncio.to_thread(roll_up_pending, get_mongo_client(), content_type)
+        except Exception as e:
+            logger.error(f"Error rolling up {content_type}s: {str(e)}")
+
+
+async def sweep_rollups(content_types, interval=ROLLUP_SWEEP_INTERVAL):
+    """Roll up newly classified documents every interval until cancelled"""
+    while True:
+        await asyncio.sleep(interval)
+        await roll_up_pending_async(content_types)
+
+
+def rebuild_rollups(content_type, start=None, end=None):
+    """Recompute a content type's rollups from its classified documents.
+
+    Backfills content classified before rollups existed and refreshes
+    engagement. The documents are marked rolled up so sweeps skip them.
+    Buckets are replaced whole, so increments made while an hour is being
+    rebuilt are lost or doubled: rebuild settled ranges or stop the detectors first.
+    """
+    platform, community_field, time_field, engagement_field = ROLLUP_SOURCES[
+        content_type
+    ]
+    db_name, collection_name, _ = HATE_SPEECH_CONTENT_SOURCES[content_type]
+    collection = get_mongo_client()[db_name][collection_name]
+
+    match = {"hate_speech_result.confidence": {"$exists": True}}
+    if start is not None or end is not None:
+        match[time_field] = {}
+        if start is not None:
+            match[time_field]["$gte"] = start
+        if end is not None:
+            match[time_field]["$lt"] = end
+
+    collection.update_many(match, {"$set": {"rolled_up": True}})
+
+    time_value = f"${time_field}"
+    confidence = "$hate_speech_result.confidence"
+    engagement = {"$ifNull": [f"${engagement_field}", 0]}
+    flagged = {"$ne": ["$hate_speech_result.class", "normal"]}
+    hour_date = {"$toDate": {"$multiply": ["$_id.hour_start", 1000]}}
+    pipeline = [
+        {"$match": match},
+        {
+            "$group": {
+                "_id": {
+                    "community": f"${community_field}",
+                    "hour_start": {
+                        "$toLong": {
+                            "$subtract": [time_value, {"$mod": [time_value, HOUR]}]
+                        }
+                    },
+                },
+                "count": {"$sum": 1},
+                "flagged": {"$sum": {"$cond": [flagged, 1, 0]}},
+                "confidence_sum": {"$sum": confidence},
+                "confidence_sq_sum": {"$sum": {"$multiply": [confidence, confidence]}},
+                "engagement_sum": {"$sum": engagement},
+                "engagement_sq_sum": {"$sum": {"$multiply": [engagement, engagement]}},
+                "confidence_engagement_sum": {
+                    "$sum": {"$multiply": [confidence, engagement]}
+                },
+            }
+        },
+        {
+            "$project": {
+                "_id": {
+                    "$concat": [
+                        f"{content_type}:",
+                        {"$ifNull": ["$_id.community", ""]},
+                        ":",
+                        {"$toString": "$_id.hour_start"},
+                    ]
+                },
+                "platform": {"$literal": platform},
+                "content_type": {"$literal": content_type},
+                "community": "$_id.community",
+                "day": {"$dateToString": {"format": "%Y-%m-%d", "date": hour_date}},
+                "hour": {"$hour": hour_date},
+                "hour_start": "$_id.hour_start",
+                "date": hour_date,
+                "count": 1,
+                "flagged": 1,
+                "confidence_sum": 1,
+                "confidence_sq_sum": 1,
+                "engagement_sum": 1,
+                "engagement_sq_sum": 1,
+                "confidence_engagement_sum": 1,
+            }
+        },
+        {
+            "$merge": {
+                "into": {"db": MONGODB_DB, "coll": TOXICITY_ROLLUPS_COLLECTION},
+                "on": "_id",
+                "whenMatched": "replace",
+                "whenNotMatched": "insert",
+            }
+        },
+    ]
+    collection.aggregate(pipeline, allowDiskUse=True)
+    logger.info(f"Rebuilt {content_type} rollups")
+
+
+def parse_day(value):
+    return int(
+        datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+    )
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else "rebuild"
+    if command not in ("rebuild", "sweep"):
+        logger.error(
+            f"Unknown command {command}; use rebuild [START_DAY END_DAY] or sweep"
+        )
+        return
+    try:
+        client = get_mongo_client()
+        ensure_indexes(client)
+        if command == "sweep":
+            for content_type in ROLLUP_SOURCES:
+                rolled_up = roll_up_pending(client, content_type)
+                logger.info(f"Rolled up {rolled_up:,d} {content_type}s")
+            return
+        # Optional UTC day range, end exclusive
+        start = parse_day(sys.argv[2]) if len(sys.argv) > 2 else None
+        end = parse_day(sys.argv[3]) if len(sys.argv) > 3 else None
+        for content_type in ROLLUP_SOURCES:
+            rebuild_rollups(content_type, start, end)
+    except Exception as e:
+        logger.error(f"Toxicity rollup {command} failed: {str(e)}")
+        raise
+
+
+if __name__ == "__main__":
+    main()
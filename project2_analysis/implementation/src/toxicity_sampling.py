@@ -0,0 +1,384 @@
+import math
+import sys
+from datetime import datetime, timezone
+from config import (
+    MONGODB_DB,
+    HATE_SPEECH_CONTENT_SOURCES,
+    SAMPLING_MARGIN_OF_ERROR,
+    SAMPLING_CONFIDENCE_Z,
+    SAMPLING_MIN_PER_STRATUM,
+    SAMPLING_SETTLE_DELAY,
+    TOXICITY_SAMPLES_COLLECTION,
+    TOXICITY_ESTIMATES_COLLECTION,
+)
+from analysis_state import OPEN_STATES, PENDING, UNSAMPLED
+from db import get_mongo_client
+from indexes import ensure_indexes
+from utils import setup_logger
+
+logger = setup_logger("toxicity_sampling")
+
+DAY = 24 * 3600
+HOUR = 3600
+EMPTY_TEXTS = ["", None, "[deleted]", "[removed]"]
+
+# Content type -> (platform, community field, time field, classifiable filter).
+# Text that is never sent to the API is left out of both population and sample.
+SAMPLING_SOURCES = {
+    "post": ("reddit", "subreddit", "created", {}),
+    "comment": ("reddit", "subreddit", "created_utc", {"body": {"$nin": EMPTY_TEXTS}}),
+    "4chan_post": ("4chan", "board", "time", {"com_text": {"$nin": EMPTY_TEXTS}}),
+}
+
+
+def required_sample_size(population, margin=SAMPLING_MARGIN_OF_ERROR):
+    """Items to classify for a rate within +/- margin of the population's.
+
+    Worst case p = 0.5 with the finite population correction: a large day
+    needs about z^2 / (4 margin^2) items (385 at 5% and 95%), a small one
+    is classified almost completely.
+    """
+    if population <= 0:
+        return 0
+    n0 = SAMPLING_CONFIDENCE_Z**2 * 0.25 / margin**2
+    return min(population, math.ceil(n0 / (1 + (n0 - 1) / population)))
+
+
+def allocate(populations, total):
+    """Split a day's sample across its hourly strata in proportion to size"""
+    day_population = sum(populations.values())
+    return {
+        hour: min(
+            size,
+            max(SAMPLING_MIN_PER_STRATUM, math.ceil(total * size / day_population)),
+        )
+        for hour, size in populations.items()
+    }
+
+
+def stratified_estimate(strata):
+    """Flagged rate and confidence interval from (N, n, flagged) per stratum.
+
+    The rate is the population-weighted mean of the stratum rates; its
+    variance sums W^2 (1 - n/N) p (1 - p) / (n - 1). Strata with nothing
+    classified yet are left out, so partial samples estimate the hours
+    they cover.
+    """
+    measured = [(N, n, flagged) for N, n, flagged in strata if n > 0]
+    population = sum(N for N, _, _ in measured)
+    if not population:
+        return None
+
+    rate = variance = 0.0
+    for N, n, flagged in measured:
+        weight = N / population
+        p = flagged / n
+        rate += weight * p
+        if n > 1:
+            variance += weight**2 * max(0.0, 1 - n / N) * p * (1 - p) / (n - 1)
+
+    standard_error = math.sqrt(variance)
+    margin = SAMPLING_CONFIDENCE_Z * standard_error
+    return {
+        "rate": rate,
+        "standard_error": standard_error,
+        "ci_low": max(0.0, rate - margin),
+        "ci_high": min(1.0, rate + margin),
+    }
+
+
+def day_label(day_start):
+    return datetime.fromtimestamp(day_start, timezone.utc).strftime("%Y-%m-%d")
+
+
+def sample_id(content_type, community, day_start):
+    return f"{content_type}:{community}:{day_label(day_start)}"
+
+
+def hourly_counts(collection, content_type, community, day_start):
+    """Population, classified, flagged, open and unsampled counts per hour"""
+    _, community_field, time_field, classifiable = SAMPLING_SOURCES[content_type]
+    has_class = {"$ifNull": ["$hate_speech_result.class", False]}
+    pipeline = [
+        {
+            "$match": {
+                community_field: community,
+                time_field: {"$gte": day_start, "$lt": day_start + DAY},
+                **classifiable,
+            }
+        },
+        {
+            "$group": {
+                "_id": {
+                    "$floor": {
+                        "$divide": [{"$subtract": [f"${time_field}", day_start]}, HOUR]
+                    }
+                },
+                "population": {"$sum": 1},
+                "classified": {"$sum": {"$cond": [has_class, 1, 0]}},
+                "flagged": {
+                    "$sum": {
+                        "$cond": [
+                            {
+                                "$and": [
+                                    has_class,
+                                    {"$ne": ["$hate_speech_result.class", "normal"]},
+                                ]
+                            },
+                            1,
+                            0,
+                        ]
+                    }
+                },
+                "open": {
+                    "$sum": {"$cond": [{"$in": ["$analysis_state", OPEN_STATES]}, 1, 0]}
+                },
+                "unsampled": {
+                    "$sum": {"$cond": [{"$eq": ["$analysis_state", UNSAMPLED]}, 1, 0]}
+                },
+            }
+        },
+    ]
+    return {int(row["_id"]): row for row in collection.aggregate(pipeline)}
+
+
+def draw_day(collection, samples, content_type, community, day_start):
+    """Release a stratified random sample of one community-day for analysis.
+
+    Each hour is a stratum. Drawn documents go from unsampled to pending,
+    where the normal enqueuers and the detection service pick them up, and
+    keep their stratum id in toxicity_sample. Drawing a day again after
+    more of it arrived only tops the sample up to the new target.
+    """
+    platform, community_field, time_field, classifiable = SAMPLING_SOURCES[
+        content_type
+    ]
+    counts = hourly_counts(collection, content_type, community, day_start)
+    populations = {hour: row["population"] for hour, row in counts.items()}
+    if not populations:
+        return 0
+
+    target = required_sample_size(sum(populations.values()))
+    strata = {}
+    total_drawn = 0
+    for hour, size in allocate(populations, target).items():
+        stratum = f"{sample_id(content_type, community, day_start)}:{hour:02d}"
+        # Documents already selected (or crawled before sampling) count too
+        selected = counts[hour]["population"] - counts[hour]["unsampled"]
+        needed = size - selected
+        drawn = 0
+        if needed > 0:
+            hour_start = day_start + hour * HOUR
+            ids = [
+                doc["_id"]
+                for doc in collection.aggregate(
+                    [
+                        {
+                            "$match": {
+                                "analysis_state": UNSAMPLED,
+                                community_field: community,
+                                time_field: {
+                                    "$gte": hour_start,
+                                    "$lt": hour_start + HOUR,
+                                },
+                                **classifiable,
+                            }
+                        },
+                        {"$sample": {"size": needed}},
+                        {"$project": {"_id": 1}},
+                    ]
+                )
+            ]
+            if ids:
+                result = collection.update_many(
+                    {"_id": {"$in": ids}, "analysis_state": UNSAMPLED},
+                    {
+                        "$set": {
+                            "analysis_state": PENDING,
+                            "lease_expires_at": 0,
+                            "toxicity_sample": stratum,
+                        }
+                    },
+                )
+                drawn = result.modified_count
+        strata[f"{hour:02d}"] = {
+            "population": populations[hour],
+            "target": size,
+            "selected": selected + drawn,
+        }
+        total_drawn += drawn
+
+    population = sum(populations.values())
+    selected = sum(stratum["selected"] for stratum in strata.values())
+    samples.update_one(
+        {"_id": sample_id(content_type, community, day_start)},
+        {
+            "$set": {
+                "platform": platform,
+                "content_type": content_type,
+                "community": community,
+                "day": day_label(day_start),
+                "day_start": day_start,
+                "population": population,
+                "target": target,
+                "selected": selected,
+                # Compared with later counts to spot documents arriving late
+                "unsampled": population - selected,
+                "strata": strata,
+                "drawn_at": datetime.now(timezone.utc),
+                # The population changed, so the day is estimated again
+                "estimated": False,
+            },
+            "$inc": {"drawn": total_drawn},
+        },
+        upsert=True,
+    )
+    return total_drawn
+
+
+def unsampled_days(collection, content_type, last_day):
+    """Unsampled classifiable documents per (community, day) up to last_day"""
+    _, community_field, time_field, classifiable = SAMPLING_SOURCES[content_type]
+    time_value = f"${time_field}"
+    pipeline = [
+        {
+            "$match": {
+                "analysis_state": UNSAMPLED,
+                time_field: {"$lt": last_day + DAY},
+                **classifiable,
+            }
+        },
+        {
+            "$group": {
+                "_id": {
+                    "community": f"${community_field}",
+                    "day_start": {
+                        "$subtract": [time_value, {"$mod": [time_value, DAY]}]
+                    },
+                },
+                "unsampled": {"$sum": 1},
+            }
+        },
+    ]
+    return {
+        (row["_id"]["community"], int(row["_id"]["day_start"])): row["unsampled"]
+        for row in collection.aggregate(pipeline)
+    }
+
+
+def draw_samples():
+    """Draw every settled community-day with unsampled content.
+
+    A day is drawn again whenever more of it arrived since its last draw:
+    Reddit comments and backfilled posts often come in after
+    SAMPLING_SETTLE_DELAY, and leaving them out of the sample while they
+    count towards the population would bias the estimate.
+    """
+    client = get_mongo_client()
+    ensure_indexes(client)
+    samples = client[MONGODB_DB][TOXICITY_SAMPLES_COLLECTION]
+    now = datetime.now(timezone.utc).timestamp()
+    # Days ending at least SAMPLING_SETTLE_DELAY ago
+    last_day = (now - SAMPLING_SETTLE_DELAY) // DAY * DAY - DAY
+
+    for content_type in SAMPLING_SOURCES:
+        db_name, collection_name, _ = HATE_SPEECH_CONTENT_SOURCES[content_type]
+        collection = client[db_name][collection_name]
+        drawn_days = {
+            (sample["community"], sample["day_start"]): sample.get("unsampled")
+            for sample in samples.find(
+                {"content_type": content_type},
+                {"community": 1, "day_start": 1, "unsampled": 1},
+            )
+        }
+
+        days = unsampled_days(collection, content_type, last_day)
+        ordered = sorted(days.items(), key=lambda item: (item[0][1], str(item[0][0])))
+        for (community, day_start), unsampled in ordered:
+            previous = drawn_days.get((community, day_start))
+            # Nothing arrived since the last draw (samples recorded before
+            # "unsampled" existed are topped up once)
+            if previous is not None and unsampled <= previous:
+                continue
+            drawn = draw_day(collection, samples, content_type, community, day_start)
+            logger.info(
+                f"{content_type} {community} {day_label(day_start)}: "
+                f"drew {drawn:,d} for analysis"
+                + (" after late arrivals" if previous is not None else "")
+            )
+
+
+def estimate_samples():
+    """(Re-)estimate drawn days until every sampled document has a result"""
+    client = get_mongo_client()
+    ensure_indexes(client)
+    samples = client[MONGODB_DB][TOXICITY_SAMPLES_COLLECTION]
+    estimates = client[MONGODB_DB][TOXICITY_ESTIMATES_COLLECTION]
+
+    for sample in samples.find({"estimated": False}):
+        content_type = sample["content_type"]
+        db_name, collection_name, _ = HATE_SPEECH_CONTENT_SOURCES[content_type]
+        counts = hourly_counts(
+            client[db_name][collection_name],
+            content_type,
+            sample["community"],
+            sample["day_start"],
+        )
+        estimate = stratified_estimate(
+            [
+                (row["population"], row["classified"], row["flagged"])
+                for row in counts.values()
+            ]
+        )
+        if not estimate:
+            continue
+
+        complete = not any(row["open"] for row in counts.values())
+        estimates.update_one(
+            {"_id": sample["_id"]},
+            {
+                "$set": {
+                    "platform": sample["platform"],
+                    "content_type": content_type,
+                    "community": sample["community"],
+                    "day": sample["day"],
+                    "date": datetime.fromtimestamp(sample["day_start"], timezone.utc),
+                    "population": sum(row["population"] for row in counts.values()),
+                    "classified": sum(row["classified"] for row in counts.values()),
+                    "flagged": sum(row["flagged"] for row in counts.values()),
+                    "confidence_z": SAMPLING_CONFIDENCE_Z,
+                    "complete": complete,
+                    "estimated_at": datetime.now(timezone.utc),
+                    **estimate,
+                }
+            },
+            upsert=True,
+        )
+        if complete:
+            samples.update_one({"_id": sample["_id"]}, {"$set": {"estimated": True}})
+        logger.info(
+            f"{sample['_id']}: {estimate['rate']:.1%} flagged "
+            f"({estimate['ci_low']:.1%}-{estimate['ci_high']:.1%})"
+            + ("" if complete else ", sample still being classified")
+        )
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else "update"
+    try:
+        if command == "draw":
+            draw_samples()
+        elif command == "estimate":
+            estimate_samples()
+        elif command == "update":
+            draw_samples()
+            estimate_samples()
+        else:
+            logger.error(f"Unknown command {command}; use draw, estimate or update")
+    except Exception as e:
+        logger.error(f"Toxicity sampling {command} failed: {str(e)}")
+        raise
+
+
+if __name__ == "__main__":
+    main()
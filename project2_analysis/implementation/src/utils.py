@@ -1,9 +1,27 @@
 import requests
 import base64
+import fcntl
+import json
 import logging
 import logging.handlers
+import os
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
-from config import REDDIT_CLIENT_ID, REDDIT_CLIENT_SECRET, REDDIT_USER_AGENT, LOG_DIR
+from requests.adapters import HTTPAdapter
+from config import (
+    REDDIT_CLIENT_ID,
+    REDDIT_CLIENT_SECRET,
+    REDDIT_USER_AGENT,
+    LOG_DIR,
+    HTTP_POOL_SIZE,
+    REDDIT_TOKEN_CACHE_FILE,
+    REDDIT_TOKEN_REFRESH_MARGIN,
+)
+
+_http_session = None
+_http_session_lock = threading.Lock()
 
 
 def setup_logger(name):
@@ -31,8 +49,36 @@ def setup_logger(name):
     return logger
 
 
-def get_access_token():
-    """Obtain OAuth2 access token for Reddit API with proper error handling"""
+def get_http_session():
+    """Return the process-wide keep-alive HTTP session with a pooled adapter"""
+    global _http_session
+
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+
+        return _http_session
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive advisory lock on path for the duration of the block"""
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def fetch_access_token():
+    """Request a new OAuth2 token, returning (access_token, expires_in)"""
     logger = logging.getLogger("reddit_auth")
 
     try:
@@ -47,27 +93,111 @@ def get_access_token():
 
         data = {"grant_type": "client_credentials"}
 
-        response = requests.post(auth_url, headers=headers, data=data, timeout=10)
+        response = get_http_session().post(
+            auth_url, headers=headers, data=data, timeout=10
+        )
         response.raise_for_status()
 
         response_data = response.json()
 
         if "access_token" in response_data:
             logger.info("Successfully obtained access token")
-            return response_data["access_token"]
+            return response_data["access_token"], int(
+                response_data.get("expires_in", 3600)
+            )
         else:
             logger.error(f"No access token in response: {response_data}")
-            return None
+            return None, 0
 
     except requests.exceptions.Timeout:
         logger.error("Timeout while obtaining access token")
-        return None
+        return None, 0
     except requests.exceptions.RequestException as e:
         logger.error(f"Error obtaining access token: {str(e)}")
-        return None
+        return None, 0
     except Exception as e:
         logger.error(f"Unexpected error while obtaining access token: {str(e)}")
-        return None
+        return None, 0
+
+
+def get_access_token():
+    """Obtain OAuth2 access token for Reddit API with proper error handling"""
+    access_token, _ = fetch_access_token()
+    return access_token
+
+
+class RedditTokenManager:
+    """Reddit OAuth token shared by all threads of a process and, through a
+    small JSON cache file, by all worker processes on the same host"""
+
+    def __init__(
+        self,
+        cache_file=REDDIT_TOKEN_CACHE_FILE,
+        refresh_margin=REDDIT_TOKEN_REFRESH_MARGIN,
+    ):
+        self.cache_file = cache_file
+        self.lock_file = f"{cache_file}.lock"
+        self.refresh_margin = refresh_margin
+        self.logger = logging.getLogger("reddit_auth")
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._expires_at = 0
+
+    def _is_fresh(self, expires_at):
+        return time.time() < expires_at - self.refresh_margin
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                cached = json.load(f)
+            return cached.get("access_token"), cached.get("expires_at", 0)
+        except (OSError, ValueError):
+            return None, 0
+
+    def _write_cache(self, access_token, expires_at):
+        try:
+            tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump({"access_token": access_token, "expires_at": expires_at}, f)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            self.logger.warning(f"Could not write token cache: {str(e)}")
+
+    def get_token(self):
+        """Return a valid token, refreshing it ahead of expiry if needed"""
+        with self._lock:
+            if self._access_token and self._is_fresh(self._expires_at):
+                return self._access_token
+
+            with file_lock(self.lock_file):
+                # Another process may have refreshed while we waited
+                access_token, expires_at = self._read_cache()
+                if not access_token or not self._is_fresh(expires_at):
+                    access_token, expires_in = fetch_access_token()
+                    if not access_token:
+                        return None
+                    expires_at = time.time() + expires_in
+                    self._write_cache(access_token, expires_at)
+
+            self._access_token = access_token
+            self._expires_at = expires_at
+            return access_token
+
+    def invalidate(self, access_token=None):
+        """Drop a token the API rejected so the next caller fetches a new one"""
+        with self._lock:
+            if access_token and access_token != self._access_token:
+                return
+            self._access_token = None
+            self._expires_at = 0
+
+            with file_lock(self.lock_file):
+                cached_token, _ = self._read_cache()
+                if cached_token and access_token in (None, cached_token):
+                    self._write_cache(None, 0)
+
+
+reddit_token_manager = RedditTokenManager()
 
 
 # Helper function to handle API responses
@@ -1,8 +1,12 @@
-from pyfaktory import Client, Consumer
+from pyfaktory import Client
 from config import (
     FAKTORY_URL,
-    MONGODB_URI,
+    MONGODB_DB,
+    WORKER_NODES_COLLECTION,
     MEDIA_DIR,
+    FOURCHAN_DB,
+    FOURCHAN_THREADS_COLLECTION,
+    FOURCHAN_POSTS_COLLECTION,
 )
 import requests
 import os
@@ -10,14 +14,14 @@ import hashlib
 import time
 from datetime import datetime
 import logging
-from pymongo import MongoClient, errors, UpdateOne
+from pymongo import errors, UpdateOne
+from analysis_state import new_document_state
+from db import get_mongo_client
+from indexes import ensure_indexes
+from partitioning import NodeMembership, NodeRegistry, PartitionedConsumer
+from text_normalization import normalize_4chan_comment
 from utils import setup_logger, handle_api_response
 
-# New database and collection names
-FOURCHAN_DB = "crawler_4chan_v2"
-THREADS_COLLECTION = "threads"
-POSTS_COLLECTION = "posts"
-
 logger = setup_logger("fourchan_boards_worker")
 
 
@@ -25,28 +29,12 @@ def init_mongodb(max_retries=3):
     """Initialize MongoDB connection with retry logic"""
     for attempt in range(max_retries):
         try:
-            client = MongoClient(MONGODB_URI, serverSelectionTimeoutMS=5000)
+            client = get_mongo_client()
             client.server_info()
+            ensure_indexes(client)
             db = client[FOURCHAN_DB]
-            threads_collection = db[THREADS_COLLECTION]
-            posts_collection = db[POSTS_COLLECTION]
-
-            # Create indexes if they don't exist
-            threads_collection.create_index(
-                [("board", 1), ("thread_id", 1)], unique=True
-            )
-            threads_collection.create_index("last_modified")
-            threads_collection.create_index("archived")
-            threads_collection.create_index([("board", 1)])
-
-            posts_collection.create_index(
-                [("board", 1), ("thread_id", 1), ("no", 1)], unique=True
-            )
-            posts_collection.create_index([("thread_id", 1)])
-            posts_collection.create_index([("board", 1)])
-            posts_collection.create_index([("no", 1)])
-            posts_collection.create_index([("hate_speech_analyzed", 1)])
-            posts_collection.create_index([("hate_speech_enqueued_at", 1)])
+            threads_collection = db[FOURCHAN_THREADS_COLLECTION]
+            posts_collection = db[FOURCHAN_POSTS_COLLECTION]
 
             logger.info("Successfully connected to MongoDB")
             return client, threads_collection, posts_collection
@@ -159,6 +147,8 @@ def process_post(post, board, thread_id):
         "time": post.get("time"),
         "name": post.get("name", "Anonymous"),
         "com": post.get("com", ""),
+        # Plain text that is classified, cached and deduplicated
+        "com_text": normalize_4chan_comment(post.get("com")),
         "filename": post.get("filename", ""),
         "ext": post.get("ext", ""),
         "w": post.get("w"),
@@ -238,7 +228,10 @@ def process_thread(board, thread_id):
                                 "thread_id": thread_id,
                                 "no": processed_post["no"],
                             },
-                            {"$set": processed_post},
+                            {
+                                "$set": processed_post,
+                                "$setOnInsert": new_document_state("4chan", board),
+                            },
                             upsert=True,
                         )
                     )
@@ -296,11 +289,22 @@ def main():
 
     os.makedirs(MEDIA_DIR, exist_ok=True)
 
+    membership = NodeMembership(
+        NodeRegistry(mongo_client[MONGODB_DB][WORKER_NODES_COLLECTION], "4chan"),
+        ["4chan_threads_queue"],
+        logger,
+    )
+    membership.start()
+
     while True:
         try:
             with Client(faktory_url=FAKTORY_URL, role="consumer") as client:
-                consumer = Consumer(
-                    client=client, queues=["4chan_threads_queue"], concurrency=10
+                consumer = PartitionedConsumer(
+                    membership,
+                    client=client,
+                    queues=membership.queues(),
+                    priority="strict",
+                    concurrency=10,
                 )
                 consumer.register("fetch_4chan_threads", process_thread)
                 logger.info("Worker started and listening for jobs...")
@@ -1,71 +1,93 @@
+import hashlib
+import ijson
 import requests
+import threading
 import time
-from pymongo import MongoClient, UpdateOne, ASCENDING
-from pyfaktory import Client, Consumer
-from ratelimit import limits, sleep_and_retry
+from collections import OrderedDict
+from pymongo import UpdateOne
+from pyfaktory import Client
 from datetime import datetime
 from config import (
     FAKTORY_URL,
-    MONGODB_URI,
     MONGODB_DB,
     MONGODB_COLLECTION,
     COMMENTS_COLLECTION,
     REDDIT_USER_AGENT,
-    REQUESTS_PER_MINUTE,
+    REDDIT_WORKER_CONCURRENCY,
+    REDDIT_JOB_QUEUES,
+    REDDIT_LEGACY_QUEUE,
+    WORKER_NODES_COLLECTION,
+    COMMENT_EXPANSIONS_COLLECTION,
+    JOB_CHECKPOINTS_COLLECTION,
+    SUBREDDIT_ACTIVITY_COLLECTION,
     COMMENT_BATCH_SIZE,
+    COMMENT_FINGERPRINT_CACHE_SIZE,
+)
+from analysis_state import new_document_state
+from budget import RunningJobClasses, classify_reddit_job, reddit_budget_allocator
+from checkpoints import JobCheckpoint
+from comment_expansion import (
+    MoreChildrenExpander,
+    load_comment_expander,
+    save_comment_expander,
+)
+from comment_tree import CommentTree
+from db import get_mongo_client
+from indexes import ensure_indexes
+from partitioning import NodeMembership, NodeRegistry, PartitionedConsumer
+from post_history import get_post_history_collection, record_history_point
+from rate_limiter import reddit_rate_limiter
+from subreddit_scheduler import SubredditCrawlScheduler
+from utils import (
+    get_http_session,
+    reddit_token_manager,
+    setup_logger,
+    handle_api_response,
 )
-from utils import get_access_token, setup_logger, handle_api_response
 
 logger = setup_logger("reddit_time_window_worker")
 
 
 def init_mongodb():
-    """Initialize MongoDB connection with separate collections for posts and comments"""
+    """Return the shared MongoDB client with the posts and comments collections"""
     try:
-        client = MongoClient(MONGODB_URI)
+        client = get_mongo_client()
+        ensure_indexes(client)
         db = client[MONGODB_DB]
-        posts_collection = db[MONGODB_COLLECTION]
-        comments_collection = db[COMMENTS_COLLECTION]
-
-        # Create indexes for posts
-        posts_collection.create_index("id", unique=True)
-        posts_collection.create_index("created")
-        posts_collection.create_index("subreddit")
-        posts_collection.create_index("last_updated")
-        posts_collection.create_index("removed")
-        posts_collection.create_index("deleted")
-
-        # Create indexes for comments
-        comments_collection.create_index("id", unique=True)
-        comments_collection.create_index(
-            [("post_id", ASCENDING), ("created_utc", ASCENDING)]
-        )
-        comments_collection.create_index("parent_id")
-        comments_collection.create_index("path")
-        comments_collection.create_index("last_updated")
-        comments_collection.create_index("is_root")
-        comments_collection.create_index("depth")
-
-        return client, posts_collection, comments_collection
+        return client, db[MONGODB_COLLECTION], db[COMMENTS_COLLECTION]
     except Exception as e:
         logger.error(f"MongoDB connection failed: {str(e)}")
         raise
 
 
-ONE_MINUTE = 60
+def limited_request(url, headers, params=None, max_attempts=3, stream=False):
+    """Make requests paced by the shared, header-driven rate limiter"""
+    try:
+        for attempt in range(max_attempts):
+            reddit_rate_limiter.acquire()
+            reddit_budget_allocator.record()
+            response = get_http_session().get(
+                url, headers=headers, params=params, timeout=30, stream=stream
+            )
+            reddit_rate_limiter.update_from_headers(response.headers)
 
+            if response.status_code == 401:
+                logger.warning("Access token rejected, forcing a refresh")
+                reddit_token_manager.invalidate(
+                    headers.get("Authorization", "").replace("bearer ", "", 1)
+                )
+                raise Exception("Unauthorized")
+            if response.status_code == 429:
+                retry_after = reddit_rate_limiter.penalize(response.headers)
+                response.close()
+                logger.warning(
+                    f"Rate limit exceeded (attempt {attempt + 1}). "
+                    f"Pausing all workers for {retry_after:.0f} seconds."
+                )
+                continue
+            return response
 
-@sleep_and_retry
-@limits(calls=REQUESTS_PER_MINUTE, period=ONE_MINUTE)
-def limited_request(url, headers, params=None):
-    """Make rate-limited requests"""
-    try:
-        response = requests.get(url, headers=headers, params=params, timeout=30)
-        if response.status_code == 429:
-            logger.warning("Rate limit exceeded. Sleeping for 60 seconds.")
-            time.sleep(60)
-            raise Exception("Rate limit exceeded")
-        return response
+        raise Exception("Rate limit exceeded")
     except requests.exceptions.Timeout:
         logger.error("Request timed out")
         raise
@@ -78,32 +100,41 @@ def limited_request(url, headers, params=None):
 
 
 class RedditAPI:
-    def __init__(self):
-        self.access_token = None
-        self.token_expires = 0
+    def __init__(self, token_manager=reddit_token_manager):
+        self.token_manager = token_manager
         self.max_retries = 3
         self.retry_delay = 5
 
     def get_headers(self):
         """Get authorization headers"""
-        current_time = time.time()
-        if not self.access_token or current_time >= self.token_expires:
-            self.access_token = get_access_token()
-            if not self.access_token:
-                raise Exception("Failed to obtain access token")
-            self.token_expires = current_time + 3600
+        access_token = self.token_manager.get_token()
+        if not access_token:
+            raise Exception("Failed to obtain access token")
 
         return {
-            "Authorization": f"bearer {self.access_token}",
+            "Authorization": f"bearer {access_token}",
             "User-Agent": REDDIT_USER_AGENT,
         }
 
-    def fetch_posts(self, subreddit, start_timestamp, end_timestamp):
-        """Fetch posts within time window"""
+    def fetch_posts(
+        self,
+        subreddit,
+        start_timestamp,
+        end_timestamp,
+        after=None,
+        on_page=None,
+        on_complete=None,
+    ):
+        """Yield posts within time window page by page as they are fetched.
+
+        subreddit may be a multi-subreddit path such as "a+b+c". The /new
+        listing is newest first, so paging stops at the first post older than
+        the window. Listing starts from the `after` cursor when given;
+        on_page(after) is called once every post of a page has been consumed,
+        on_complete() once the whole window was listed without an error.
+        """
         url = f"https://oauth.reddit.com/r/{subreddit}/new"
         params = {"limit": 100, "raw_json": 1}
-        posts = []
-        after = None
 
         while True:
             try:
@@ -116,14 +147,9 @@ class RedditAPI:
                 if not data or "data" not in data or "children" not in data["data"]:
                     break
 
-                for post in data["data"]["children"]:
-                    posts.append(post["data"])
-
-                if not data["data"]["children"] or not data["data"].get("after"):
-                    break
-
+                children = data["data"]["children"]
                 after = data["data"].get("after")
-                time.sleep(0.01)
+                del data
 
             except Exception as e:
                 logger.error(
@@ -131,7 +157,49 @@ class RedditAPI:
                 )
                 break
 
-        return posts
+            reached_window_start = False
+            for post in children:
+                created = post["data"].get("created_utc") or post["data"].get(
+                    "created", 0
+                )
+                if created > end_timestamp:
+                    continue
+                if created < start_timestamp:
+                    reached_window_start = True
+                    break
+                yield post["data"]
+
+            if not children or not after or reached_window_start:
+                if on_complete:
+                    on_complete()
+                break
+
+            if on_page:
+                on_page(after)
+
+            time.sleep(0.01)
+
+    def fetch_posts_by_ids(self, post_ids):
+        """Fetch up to 100 posts in a single by_id request"""
+        fullnames = ",".join(f"t3_{post_id}" for post_id in post_ids)
+        url = f"https://oauth.reddit.com/by_id/{fullnames}"
+
+        for attempt in range(self.max_retries):
+            try:
+                response = limited_request(url, self.get_headers(), {"raw_json": 1})
+                data = handle_api_response(response, logger)
+
+                if data and "data" in data and "children" in data["data"]:
+                    return [child["data"] for child in data["data"]["children"]]
+
+            except Exception as e:
+                logger.error(
+                    f"Error fetching {len(post_ids)} posts by id (attempt {attempt + 1}): {str(e)}"
+                )
+                if attempt < self.max_retries - 1:
+                    time.sleep(self.retry_delay * (attempt + 1))
+
+        return []
 
     def fetch_post_by_id(self, post_id):
         """Fetch a specific post by ID"""
@@ -158,8 +226,8 @@ class RedditAPI:
 
         return None
 
-    def fetch_comments(self, post_id):
-        """Fetch complete comment tree"""
+    def fetch_comments(self, post_id, expander=None):
+        """Yield the complete comment tree as it is parsed from the response"""
         url = f"https://oauth.reddit.com/comments/{post_id}"
         params = {
             "limit": 500,
@@ -167,57 +235,63 @@ class RedditAPI:
             "depth": 10,
             "sort": "confidence",  # Default sort method
         }
+        expander = expander or MoreChildrenExpander()
 
+        response = None
         for attempt in range(self.max_retries):
             try:
-                response = limited_request(url, self.get_headers(), params)
-                data = handle_api_response(response, logger)
-
-                if data and len(data) > 1:
-                    comments_data = data[1]["data"]["children"]
-
-                    additional_comments = self.stream_more_comments(
-                        post_id, comments_data
-                    )
-                    if additional_comments:
-                        comments_data.extend(additional_comments)
+                response = limited_request(
+                    url, self.get_headers(), params, stream=True
+                )
+                if response.status_code == 200:
+                    break
 
-                    return comments_data
+                handle_api_response(response, logger)
+                response.close()
+                response = None
 
             except Exception as e:
                 logger.error(
                     f"Error fetching comments for {post_id} (attempt {attempt + 1}): {str(e)}"
                 )
-                if attempt < self.max_retries - 1:
-                    time.sleep(self.retry_delay * (attempt + 1))
+            if attempt < self.max_retries - 1:
+                time.sleep(self.retry_delay * (attempt + 1))
 
-        return []
-
-    def stream_more_comments(self, post_id, comments, depth=0, max_depth=10):
-        """Stream process additional comments"""
-        if depth >= max_depth:
-            return []
+        if response is None:
+            return
 
-        more_comments = []
-        children_ids = set()
-
-        for comment in comments:
-            if comment["kind"] == "more":
-                children_ids.update(comment["data"].get("children", []))
+        more_stubs = []
+        try:
+            # Parse listing children incrementally instead of loading the
+            # whole (possibly multi-megabyte) response into memory
+            response.raw.decode_content = True
+            for child in ijson.items(
+                response.raw, "item.data.children.item", use_float=True
+            ):
+                if child.get("kind") == "t3":
+                    continue
+                yield from walk_comment_tree(child, more_stubs)
+                for stub in more_stubs:
+                    expander.add_stub(**stub)
+                more_stubs.clear()
+        except Exception as e:
+            logger.error(f"Error parsing comments for {post_id}: {str(e)}")
+        finally:
+            response.close()
 
-        if not children_ids:
-            return []
+        yield from self.stream_more_comments(post_id, expander)
 
-        batch_size = 100
-        children_ids_list = list(children_ids)
+    def stream_more_comments(self, post_id, expander):
+        """Yield comments hidden behind `more` stubs, breadth-first within the
+        expander's request budget"""
+        url = "https://oauth.reddit.com/api/morechildren"
 
-        for i in range(0, len(children_ids_list), batch_size):
-            batch = children_ids_list[i : i + batch_size]
+        while True:
+            batch = expander.next_batch()
             if not batch:
-                continue
+                break
 
             try:
-                url = "https://oauth.reddit.com/api/morechildren"
                 params = {
                     "link_id": f"t3_{post_id}",
                     "children": ",".join(batch),
@@ -229,45 +303,124 @@ class RedditAPI:
                 data = handle_api_response(response, logger)
 
                 if data and "json" in data and "data" in data["json"]:
-                    new_comments = data["json"]["data"]["things"]
-                    more_comments.extend(new_comments)
-
-                    additional_comments = self.stream_more_comments(
-                        post_id, new_comments, depth + 1, max_depth
-                    )
-                    more_comments.extend(additional_comments)
+                    things = data["json"]["data"]["things"]
+                    scores = {
+                        t["data"]["id"]: t["data"].get("score", 0)
+                        for t in things
+                        if t.get("kind") == "t1"
+                    }
+                    more_stubs = []
+                    for thing in things:
+                        yield from walk_comment_tree(thing, more_stubs, scores)
+                    for stub in more_stubs:
+                        expander.add_stub(**stub)
+                    # Done once the consumer has stored what was yielded
+                    expander.fetched(batch)
+                else:
+                    expander.release(batch)
 
             except Exception as e:
                 logger.error(f"Error fetching more comments batch: {str(e)}")
+                expander.release(batch)
 
             time.sleep(0.01)
 
-        return more_comments
+        if expander.has_pending:
+            logger.info(
+                f"Comment expansion budget of {expander.budget} requests used "
+                f"for post {post_id}; remaining stubs deferred to a later job"
+            )
+
+
+def walk_comment_tree(thing, more_stubs, parent_scores=None):
+    """Yield every comment in a (nested) comment thing, collecting `more` stubs
+    with the depth and parent score used to prioritise their expansion"""
+    parent_scores = parent_scores or {}
+    stack = [(thing, None)]
+    while stack:
+        node, parent_score = stack.pop()
+        if node.get("kind") == "more":
+            data = node["data"]
+            if parent_score is None:
+                parent_id = (data.get("parent_id") or "").split("_", 1)[-1]
+                parent_score = parent_scores.get(parent_id, 0)
+            more_stubs.append(
+                {
+                    "ids": data.get("children", []),
+                    "depth": data.get("depth", 0),
+                    "parent_score": parent_score,
+                }
+            )
+            continue
+        if node.get("kind") != "t1":
+            continue
+
+        replies = node["data"].pop("replies", None)
+        yield node
+
+        if isinstance(replies, dict):
+            score = node["data"].get("score", 0)
+            stack.extend(
+                (child, score)
+                for child in reversed(replies.get("data", {}).get("children", []))
+            )
 
 
-def process_posts_batch(posts, api, posts_collection, comments_collection):
-    """Process and store posts with their comments"""
+def process_posts_batch(
+    posts, api, posts_collection, comments_collection, on_post_stored=None
+):
+    """Process and store posts with their comments, returning the count stored"""
+    history_collection = get_post_history_collection(posts_collection.database)
+    expansions_collection = posts_collection.database[COMMENT_EXPANSIONS_COLLECTION]
+    processed_count = 0
     for post_data in posts:
         try:
             post_id = post_data["id"]
-            existing_post = posts_collection.find_one({"id": post_id})
 
-            processed_post = process_post(post_data, existing_post)
+            processed_post = process_post(post_data)
             if not processed_post:
                 continue
 
-            comments = api.fetch_comments(post_id)
+            expander = load_comment_expander(expansions_collection, post_id)
+            comments = api.fetch_comments(post_id, expander)
+
+            def on_flush():
+                # Keep the morechildren frontier current so a crash mid-post
+                # resumes the expansion instead of restarting it. Only
+                # batches whose comments are written are saved as done.
+                expander.stored()
+                save_comment_expander(expansions_collection, post_id, expander)
+
             comment_stats = store_comments_batch(
-                post_id, comments, comments_collection, COMMENT_BATCH_SIZE
+                post_id,
+                comments,
+                comments_collection,
+                COMMENT_BATCH_SIZE,
+                on_flush=on_flush,
             )
+            save_comment_expander(expansions_collection, post_id, expander)
 
             processed_post["comment_stats"] = comment_stats
             processed_post["last_updated"] = time.time()
 
+            # Originals are captured once, when the post is first stored
             posts_collection.update_one(
-                {"id": post_id}, {"$set": processed_post}, upsert=True
+                {"id": post_id},
+                {
+                    "$set": processed_post,
+                    "$setOnInsert": {
+                        "original_selftext": processed_post["selftext"],
+                        "original_author": processed_post["author"],
+                        **new_document_state("reddit", processed_post["subreddit"]),
+                    },
+                },
+                upsert=True,
             )
+            record_history_point(history_collection, processed_post)
 
+            processed_count += 1
+            if on_post_stored:
+                on_post_stored(post_id)
             logger.info(
                 f"Stored post {post_id} with {comment_stats['total_comments']} comments"
             )
@@ -275,8 +428,10 @@ def process_posts_batch(posts, api, posts_collection, comments_collection):
         except Exception as e:
             logger.error(f"Error processing post {post_data.get('id')}: {str(e)}")
 
+    return processed_count
+
 
-def process_post(post_data, existing_post=None):
+def process_post(post_data):
     """Process post data"""
     try:
         current_time = time.time()
@@ -304,42 +459,6 @@ def process_post(post_data, existing_post=None):
             "stickied": post_data.get("stickied", False),
         }
 
-        if existing_post:
-            history_entry = {
-                "timestamp": current_time,
-                "score": processed_post["score"],
-                "num_comments": processed_post["num_comments"],
-                "upvote_ratio": processed_post["upvote_ratio"],
-                "removed": processed_post["removed"],
-                "deleted": processed_post["deleted"],
-            }
-
-            processed_post["history"] = existing_post.get("history", [])[
-                -9:
-            ]  # Keep last 10 entries
-            processed_post["history"].append(history_entry)
-
-            if processed_post["removed"] or processed_post["deleted"]:
-                processed_post["original_selftext"] = existing_post.get(
-                    "original_selftext", processed_post["selftext"]
-                )
-                processed_post["original_author"] = existing_post.get(
-                    "original_author", processed_post["author"]
-                )
-        else:
-            processed_post["history"] = [
-                {
-                    "timestamp": current_time,
-                    "score": processed_post["score"],
-                    "num_comments": processed_post["num_comments"],
-                    "upvote_ratio": processed_post["upvote_ratio"],
-                    "removed": processed_post["removed"],
-                    "deleted": processed_post["deleted"],
-                }
-            ]
-            processed_post["original_selftext"] = processed_post["selftext"]
-            processed_post["original_author"] = processed_post["author"]
-
         return processed_post
 
     except Exception as e:
@@ -347,9 +466,115 @@ def process_post(post_data, existing_post=None):
         return None
 
 
-def store_comments_batch(post_id, comments, comments_collection, batch_size):
-    """Store comments in batches and calculate statistics"""
-    operations = []
+# Fields that can change between refreshes of the same comment
+FINGERPRINT_FIELDS = (
+    "parent_id",
+    "author",
+    "body",
+    "score",
+    "edited",
+    "removed",
+    "deleted",
+    "depth",
+    "path",
+    "distinguished",
+    "controversiality",
+)
+
+
+def comment_fingerprint(processed_comment):
+    """Compact hash of the mutable fields of a processed comment"""
+    payload = "\x1f".join(
+        str(processed_comment.get(field)) for field in FINGERPRINT_FIELDS
+    )
+    return hashlib.blake2b(payload.encode(), digest_size=8).hexdigest()
+
+
+class CommentFingerprintCache:
+    """Bounded LRU of comment id -> fingerprint of the last stored version"""
+
+    def __init__(self, max_entries=COMMENT_FINGERPRINT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, comment_id):
+        with self._lock:
+            fingerprint = self._entries.get(comment_id)
+            if fingerprint is not None:
+                self._entries.move_to_end(comment_id)
+            return fingerprint
+
+    def put(self, comment_id, fingerprint):
+        with self._lock:
+            self._entries[comment_id] = fingerprint
+            self._entries.move_to_end(comment_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def filter_changed(self, comments, comments_collection):
+        """Return only the comments whose fingerprint differs from the stored one"""
+        missing_ids = [c["id"] for c in comments if self.get(c["id"]) is None]
+        if missing_ids:
+            # Warm the cache from Mongo in one query for ids not seen recently
+            try:
+                for doc in comments_collection.find(
+                    {"id": {"$in": missing_ids}}, {"id": 1, "fingerprint": 1, "_id": 0}
+                ):
+                    if doc.get("fingerprint"):
+                        self.put(doc["id"], doc["fingerprint"])
+            except Exception as e:
+                logger.error(f"Error loading comment fingerprints: {str(e)}")
+
+        return [c for c in comments if self.get(c["id"]) != c["fingerprint"]]
+
+
+comment_fingerprint_cache = CommentFingerprintCache()
+
+
+def resolve_comment_path(tree, processed_comment, comments_collection):
+    """Materialize path, depth and path completeness of a comment within its
+    post's tree"""
+    placed = tree.add(processed_comment["id"], processed_comment["parent_id"])
+    if placed:
+        return placed
+
+    # Parent arrived in an earlier job; continue from its stored path
+    parent_id = processed_comment["parent_id"].split("_", 1)[-1]
+    parent = None
+    try:
+        parent = comments_collection.find_one(
+            {"id": parent_id}, {"path": 1, "depth": 1, "path_complete": 1, "_id": 0}
+        )
+    except Exception as e:
+        logger.error(f"Error loading path of parent comment {parent_id}: {str(e)}")
+
+    if parent and parent.get("path"):
+        return tree.add_orphan(
+            processed_comment["id"],
+            parent_id,
+            parent["depth"] + 1,
+            parent["path"],
+            parent.get("path_complete", True),
+        )
+    # Ancestors unknown: keep Reddit's depth and mark the path partial
+    return tree.add_orphan(
+        processed_comment["id"], parent_id, processed_comment["depth"]
+    )
+
+
+def store_comments_batch(
+    post_id, comments, comments_collection, batch_size, on_flush=None
+):
+    """Store comments in batches and calculate statistics.
+
+    Each comment gets a materialized path and depth from a per-post tree, and
+    comments whose fingerprint matches the stored version are not rewritten.
+    on_flush is called whenever every comment read so far is stored, and no
+    longer after a failed write.
+    """
+    tree = CommentTree(post_id)
+    pending = []
     stats = {
         "total_comments": 0,
         "root_comments": 0,
@@ -358,16 +583,41 @@ def store_comments_batch(post_id, comments, comments_collection, batch_size):
         "removed_comments": 0,
         "total_score": 0,
         "controversial_comments": 0,
+        "unchanged_comments": 0,
         "last_updated": time.time(),
     }
+    write_failed = False
 
     def process_comment_batch(batch):
-        if batch:
-            try:
-                result = comments_collection.bulk_write(batch, ordered=False)
-                logger.debug(f"Bulk write completed: {result.bulk_api_result}")
-            except Exception as e:
-                logger.error(f"Error in comment bulk write: {str(e)}")
+        nonlocal write_failed
+        changed = comment_fingerprint_cache.filter_changed(batch, comments_collection)
+        stats["unchanged_comments"] += len(batch) - len(changed)
+        if not changed:
+            if on_flush and not write_failed:
+                on_flush()
+            return
+
+        operations = [
+            UpdateOne(
+                {"id": c["id"]},
+                {
+                    "$set": c,
+                    "$setOnInsert": new_document_state("reddit", c["subreddit"]),
+                },
+                upsert=True,
+            )
+            for c in changed
+        ]
+        try:
+            result = comments_collection.bulk_write(operations, ordered=False)
+            logger.debug(f"Bulk write completed: {result.bulk_api_result}")
+            for c in changed:
+                comment_fingerprint_cache.put(c["id"], c["fingerprint"])
+        except Exception as e:
+            write_failed = True
+            logger.error(f"Error in comment bulk write: {str(e)}")
+        if on_flush and not write_failed:
+            on_flush()
 
     for comment in comments:
         if comment["kind"] != "t1":
@@ -378,6 +628,13 @@ def store_comments_batch(post_id, comments, comments_collection, batch_size):
             if not processed_comment:
                 continue
 
+            path, depth, complete = resolve_comment_path(
+                tree, processed_comment, comments_collection
+            )
+            processed_comment["path"] = path
+            processed_comment["depth"] = depth
+            processed_comment["path_complete"] = complete
+
             stats["total_comments"] += 1
             stats["total_score"] += processed_comment["score"]
 
@@ -391,23 +648,19 @@ def store_comments_batch(post_id, comments, comments_collection, batch_size):
             if processed_comment.get("controversial", False):
                 stats["controversial_comments"] += 1
 
-            operations.append(
-                UpdateOne(
-                    {"id": processed_comment["id"]},
-                    {"$set": processed_comment},
-                    upsert=True,
-                )
-            )
+            processed_comment["fingerprint"] = comment_fingerprint(processed_comment)
+            pending.append(processed_comment)
 
-            if len(operations) >= batch_size:
-                process_comment_batch(operations)
-                operations = []
+            if len(pending) >= batch_size:
+                process_comment_batch(pending)
+                pending = []
 
         except Exception as e:
             logger.error(f"Error processing comment: {str(e)}")
 
-    if operations:
-        process_comment_batch(operations)
+    # Even with nothing pending, so batches read since the last flush are
+    # marked stored
+    process_comment_batch(pending)
 
     if stats["total_comments"] > 0:
         stats["average_score"] = stats["total_score"] / stats["total_comments"]
@@ -426,6 +679,7 @@ def process_single_comment(comment_data, post_id):
         processed_comment = {
             "id": comment_data["id"],
             "post_id": post_id,
+            "subreddit": comment_data.get("subreddit", ""),
             "parent_id": comment_data.get("parent_id"),
             "author": comment_data.get("author", "[deleted]"),
             "body": comment_data.get("body", "[deleted]"),
@@ -456,36 +710,153 @@ def process_single_comment(comment_data, post_id):
 
 
 def refresh_reddit_data(job_data):
-    """Process a refresh job"""
+    """Process a refresh job, charging its requests to the job's budget class"""
+    with reddit_budget_allocator.job_class(classify_reddit_job(job_data)):
+        run_refresh_job(job_data)
+
+
+def run_refresh_job(job_data):
+    """Process a refresh job, resuming from its checkpoint after a retry"""
     try:
+        setup_start = time.perf_counter()
         api = RedditAPI()
         mongo_client, posts_collection, comments_collection = init_mongodb()
+        checkpoint = JobCheckpoint.load(
+            posts_collection.database[JOB_CHECKPOINTS_COLLECTION], job_data
+        )
+        logger.debug(
+            f"Job setup took {(time.perf_counter() - setup_start) * 1000:.1f} ms"
+        )
 
         subreddit = job_data["subreddit"]
         start_timestamp = job_data["start_date"]
         end_timestamp = job_data["end_date"]
 
+        if checkpoint.resumed:
+            logger.info(
+                f"Resuming job for r/{subreddit} from checkpoint: "
+                f"{len(checkpoint.processed_ids)} posts already stored"
+            )
+
         if "post_ids" in job_data:
-            for post_id in job_data["post_ids"]:
+            pending_ids = [
+                post_id
+                for post_id in job_data["post_ids"]
+                if not checkpoint.is_processed(post_id)
+            ]
+            by_id_batch_size = 100
+            for i in range(0, len(pending_ids), by_id_batch_size):
+                batch_ids = pending_ids[i : i + by_id_batch_size]
                 try:
-                    post_data = api.fetch_post_by_id(post_id)
-                    if post_data:
-                        process_posts_batch(
-                            [post_data], api, posts_collection, comments_collection
-                        )
+                    posts = api.fetch_posts_by_ids(batch_ids)
+                    process_posts_batch(
+                        posts,
+                        api,
+                        posts_collection,
+                        comments_collection,
+                        on_post_stored=checkpoint.record_item,
+                    )
                 except Exception as e:
-                    logger.error(f"Error refreshing post {post_id}: {str(e)}")
+                    logger.error(f"Error refreshing {len(batch_ids)} posts: {str(e)}")
         else:
-            posts = api.fetch_posts(subreddit, start_timestamp, end_timestamp)
-            if posts:
-                process_posts_batch(posts, api, posts_collection, comments_collection)
-                logger.info(f"Processed {len(posts)} posts for r/{subreddit}")
+            listed = []
+            posts = api.fetch_posts(
+                subreddit,
+                start_timestamp,
+                end_timestamp,
+                after=checkpoint.after,
+                on_page=checkpoint.record_page,
+                on_complete=lambda: listed.append(True),
+            )
+            processed_count = process_posts_batch(
+                (p for p in posts if not checkpoint.is_processed(p["id"])),
+                api,
+                posts_collection,
+                comments_collection,
+                on_post_stored=checkpoint.record_item,
+            )
+            logger.info(f"Processed {processed_count} posts for r/{subreddit}")
+
+            # A failed or dropped live poll is planned again by the enqueuer
+            if listed and classify_reddit_job(job_data) == "live":
+                subreddits = subreddit.split("+")
+                SubredditCrawlScheduler(
+                    subreddits,
+                    posts_collection,
+                    posts_collection.database[SUBREDDIT_ACTIVITY_COLLECTION],
+                    logger,
+                ).mark_polled(subreddits, end_timestamp)
+
+        checkpoint.complete()
 
     except Exception as e:
         logger.error(f"Error in refresh job: {str(e)}")
         raise
 
 
+class BudgetedConsumer(PartitionedConsumer):
+    """Consumer that fetches from the job class with the most unused budget
+    first, falling back to the other classes and the legacy queue. Within a
+    class this node's partition queue comes before the shared queue. Once
+    other classes fill all but the reserved slots only live jobs are fetched.
+    """
+
+    def __init__(self, membership, **kwargs):
+        super().__init__(membership, **kwargs)
+        # Jobs run in the pool's processes, so their classes are counted here
+        # as they are handed to the pool
+        self.running = RunningJobClasses()
+        self.pool.schedule = self._counted(self.pool.schedule)
+
+    def _counted(self, schedule):
+        def counted_schedule(function, args=(), **kwargs):
+            job_class = classify_reddit_job(args[0]) if args else None
+            future = schedule(function, args=args, **kwargs)
+            self.running.started(job_class)
+            future.add_done_callback(lambda _: self.running.finished(job_class))
+            return future
+
+        return counted_schedule
+
+    def get_queues(self):
+        if self.running.live_slot_reserved(self.concurrency):
+            return self.membership.queues([REDDIT_JOB_QUEUES["live"]])
+        class_queues = [
+            REDDIT_JOB_QUEUES[job_class]
+            for job_class in reddit_budget_allocator.class_order()
+        ]
+        return self.membership.queues(class_queues) + [REDDIT_LEGACY_QUEUE]
+
+
+def apply_node_share(membership):
+    """Give this node an equal slice of the OAuth client's rate budget.
+
+    Runs in the heartbeat thread; the share is written to the shared state
+    files, so job processes forked earlier pick it up on their next request.
+    """
+    share = 1 / max(1, len(membership.live_nodes))
+    reddit_rate_limiter.set_share(share)
+    reddit_budget_allocator.set_share(share)
+    logger.info(f"Using {share:.0%} of the Reddit rate budget on this node")
+
+
+def start_node_membership():
+    """Register this node with the Reddit partition ring.
+
+    Job processes forked later open their own client; see get_mongo_client.
+    """
+    mongo_client, posts_collection, comments_collection = init_mongodb()
+    membership = NodeMembership(
+        NodeRegistry(posts_collection.database[WORKER_NODES_COLLECTION], "reddit"),
+        REDDIT_JOB_QUEUES.values(),
+        logger,
+        on_change=apply_node_share,
+    )
+    membership.start()
+    apply_node_share(membership)
+    return membership
+
+
 def main():
     """Initialize and run the worker"""
     logger.info("Starting Reddit time-window worker...")
@@ -493,12 +864,17 @@ def main():
     consecutive_errors = 0
     max_consecutive_errors = 3
     base_sleep_time = 30
+    membership = start_node_membership()
 
     while True:
         try:
             with Client(faktory_url=FAKTORY_URL, role="consumer") as client:
-                consumer = Consumer(
-                    client=client, queues=["reddit_refresh_queue2"], concurrency=1
+                consumer = BudgetedConsumer(
+                    membership,
+                    client=client,
+                    queues=list(REDDIT_JOB_QUEUES.values()) + [REDDIT_LEGACY_QUEUE],
+                    priority="strict",
+                    concurrency=REDDIT_WORKER_CONCURRENCY,
                 )
                 consumer.register("refresh_reddit_data", refresh_reddit_data)
                 logger.info("Worker started and listening for jobs...")
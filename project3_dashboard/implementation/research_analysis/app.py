@@ -36,6 +36,17 @@ REDIS_PORT = 6379
 REDIS_DB = 0
 CACHE_EXPIRATION = 3600 * 24 * 7  # 7 days in seconds 
 
+# Summed fields of the hourly toxicity rollups
+ROLLUP_SUMS = [
+    'count',
+    'flagged',
+    'confidence_sum',
+    'confidence_sq_sum',
+    'engagement_sum',
+    'engagement_sq_sum',
+    'confidence_engagement_sum'
+]
+
 redis_client = redis.Redis(
     host=REDIS_HOST,
     port=REDIS_PORT,
@@ -317,75 +328,128 @@ def query_activity_data(platform, start_date, end_date):
         return pd.DataFrame()
 
 def query_hate_speech_data(platform, start_date, end_date):
-    cached_df = get_cached_data('hate_speech', platform, start_date, end_date)
+    """Hourly toxicity rollups (toxicity_rollups.py) of the platform's content"""
+    cached_df = get_cached_data('hate_speech_rollups', platform, start_date, end_date)
     if cached_df is not None:
         print(f"Cache hit for hate speech data: {platform}")
         return cached_df
 
     try:
         dbs = get_db_connection()
-        
-        if platform == 'reddit':
-            collection = dbs['reddit'].comments
-            time_field = 'created_utc'
-            engagement_field = 'score'
-            index_hint = {
-                'created_utc': 1,
-                'hate_speech_result.confidence': 1,
-                'score': 1
-            }
-        else:
-            collection = dbs['crawler_4chan_v2'].posts
-            time_field = 'time'
-            engagement_field = 'replies'
-            index_hint = {
-                'time': 1,
-                'hate_speech_result.confidence': 1,
-                'replies': 1
-            }
-        
+        content_type = 'comment' if platform == 'reddit' else '4chan_post'
+
         start_ts = int(datetime.strptime(start_date, '%Y-%m-%d').timestamp())
         end_ts = int(datetime.strptime(end_date, '%Y-%m-%d').timestamp())
-        
+
+        # Every community's rollups of an hour are summed into one row
         pipeline = [
             {
                 '$match': {
-                    time_field: {'$gte': start_ts, '$lt': end_ts},
-                    'hate_speech_result.confidence': {'$exists': True}
+                    'content_type': content_type,
+                    'hour_start': {'$gte': start_ts, '$lt': end_ts}
                 }
             },
             {
-                '$project': {
-                    'date': {
-                        '$dateToString': {
-                            'format': '%Y-%m-%d',
-                            'date': {
-                                '$toDate': {'$multiply': [f'${time_field}', 1000]}
-                            }
-                        }
-                    },
-                    'confidence': '$hate_speech_result.confidence',
-                    'engagement': {'$ifNull': [f'${engagement_field}', 0]}
+                '$group': {
+                    '_id': '$hour_start',
+                    'date': {'$first': '$day'},
+                    **{field: {'$sum': f'${field}'} for field in ROLLUP_SUMS}
                 }
             },
-            {'$sort': {'date': 1}}
+            {'$sort': {'_id': 1}}
         ]
-        
-        results = list(collection.aggregate(pipeline, allowDiskUse=True, hint=index_hint))
-        
+
+        results = list(dbs['reddit'].toxicity_rollups.aggregate(pipeline))
+
         if results:
-            df = pd.DataFrame(results)
+            df = pd.DataFrame(results).rename(columns={'_id': 'hour_start'})
             df['date'] = pd.to_datetime(df['date']).dt.date
-            
-            cache_data('hate_speech', platform, start_date, end_date, df)
+            df['confidence'] = df['confidence_sum'] / df['count']
+            df['engagement'] = df['engagement_sum'] / df['count']
+
+            cache_data('hate_speech_rollups', platform, start_date, end_date, df)
             return df
-            
+
         return pd.DataFrame()
-    
+
     except Exception as e:
         print(f"Error querying hate speech data for {platform}: {str(e)}")
         return pd.DataFrame()
 
+def daily_hate_speech(df):
+    """Daily count, flagged rate and average confidence and engagement"""
+    daily = df.groupby('date')[ROLLUP_SUMS].sum().reset_index()
+    daily['confidence'] = daily['confidence_sum'] / daily['count']
+    daily['engagement'] = daily['engagement_sum'] / daily['count']
+    daily['flagged_rate'] = daily['flagged'] / daily['count']
+    return daily
+
+def rollup_correlation(df):
+    """Pearson correlation of confidence and engagement from rollup sums"""
+    totals = df[ROLLUP_SUMS].sum()
+    n = totals['count']
+    covariance = totals['confidence_engagement_sum'] - totals['confidence_sum'] * totals['engagement_sum'] / n
+    confidence_var = totals['confidence_sq_sum'] - totals['confidence_sum'] ** 2 / n
+    engagement_var = totals['engagement_sq_sum'] - totals['engagement_sum'] ** 2 / n
+    if confidence_var <= 0 or engagement_var <= 0:
+        return float('nan')
+    return covariance / (confidence_var * engagement_var) ** 0.5
+
+def query_toxicity_estimates(platform, start_date, end_date):
+    """Daily flagged-rate estimates of sampled communities (toxicity_sampling.py)"""
+    try:
+        dbs = get_db_connection()
+        results = list(dbs['reddit'].toxicity_estimates.find(
+            {
+                'platform': platform,
+                'date': {
+                    '$gte': datetime.strptime(start_date, '%Y-%m-%d'),
+                    '$lt': datetime.strptime(end_date, '%Y-%m-%d')
+                }
+            },
+            {
+                '_id': 0,
+                'community': 1,
+                'content_type': 1,
+                'date': 1,
+                'rate': 1,
+                'ci_low': 1,
+                'ci_high': 1,
+                'complete': 1
+            }
+        ).sort('date', ASCENDING))
+
+        if results:
+            df = pd.DataFrame(results)
+            df['date'] = pd.to_datetime(df['date']).dt.date
+            return df
+
+        return pd.DataFrame()
+
+    except Exception as e:
+        print(f"Error querying toxicity estimates for {platform}: {str(e)}")
+        return pd.DataFrame()
+
+def create_estimate_plot(df, platform):
+    try:
+        plt.figure(figsize=(10, 6))
+        for (community, content_type), group in df.groupby(['community', 'content_type']):
+            label = f"{community} ({content_type})"
+            plt.plot(group['date'], group['rate'] * 100, marker='o', label=label)
+            plt.fill_between(group['date'], group['ci_low'] * 100, group['ci_high'] * 100, alpha=0.2)
+
+        plt.title(f'{platform.capitalize()} Estimated Hate Speech Rate (95% CI)')
+        plt.ylabel('Flagged (%)')
+        plt.xlabel('Date')
+        plt.xticks(rotation=45)
+        plt.legend()
+        plt.grid(True, alpha=0.3)
+        return save_plot_to_base64()
+
+    except Exception as e:
+        print(f"Error creating estimate plot: {str(e)}")
+        return None
+
 def create_plot_base64(df, plot_type, platform, analysis_type):
     try:
         if plot_type:  # For hate speech plots
@@ -421,7 +485,7 @@ def create_plot_base64(df, plot_type, platform, analysis_type):
             plt.ylabel('Number of Posts/Comments')
             plt.xlabel('Date')
         elif plot_type == 'trend':
-            daily_avg = df.groupby('date')[['confidence', 'engagement']].mean().reset_index()
+            daily_avg = daily_hate_speech(df)
             plt.plot(daily_avg['date'], daily_avg['confidence'], 
                     label=f'{platform.capitalize()} Confidence',
                     color='orange' if platform == '4chan' else 'blue',
@@ -429,12 +493,12 @@ def create_plot_base64(df, plot_type, platform, analysis_type):
             plt.title(f'{platform.capitalize()} Hate Speech Confidence Trend')
             plt.ylabel('Average Confidence')
             plt.xlabel('Date')
-        else:  # Scatter plot for engagement vs toxicity
+        else:  # Scatter plot for engagement vs toxicity, one point per hour
             plt.scatter(df['confidence'], df['engagement'],
                     alpha=0.5,
                     color='orange' if platform == '4chan' else 'blue',
                     label=f'{platform.capitalize()} Engagement')
-            plt.title(f"Engagement vs. Toxicity Confidence ({platform.capitalize()})")
+            plt.title(f"Hourly Engagement vs. Toxicity Confidence ({platform.capitalize()})")
             plt.xlabel('Toxicity Confidence')
             plt.ylabel('Engagement (Score)' if platform == 'reddit' else 'Engagement (Replies)')
         
@@ -478,12 +542,13 @@ def generate_insights(data, platform, analysis_type):
                     'avg_daily_posts': f"{data['count'].mean():.0f}"
                 }
             else:
-                daily_avg = data.groupby('date')[['confidence', 'engagement']].mean().reset_index()
+                daily_avg = daily_hate_speech(data)
                 insights = {
                     'avg_confidence': f"{daily_avg['confidence'].mean():.2f}",
                     'avg_engagement': f"{daily_avg['engagement'].mean():.2f}",
-                    'total_posts': f"{len(data):,}",
-                    'correlation': f"{data['confidence'].corr(data['engagement']):.2f}"
+                    'flagged_rate': f"{data['flagged'].sum() / data['count'].sum():.1%}",
+                    'total_posts': f"{data['count'].sum():,}",
+                    'correlation': f"{rollup_correlation(data):.2f}"
                 }
             
             json_str = json.dumps(insights, cls=MongoJSONEncoder)
@@ -812,6 +877,12 @@ def index():
                         plots[f'{plot_key}_trend'] = create_plot_base64(data, 'trend', p, 'hate_speech')
                         plots[f'{plot_key}_engagement'] = create_plot_base64(data, 'engagement', p, 'hate_speech')
                         insights[plot_key] = generate_insights(data, p, 'hate_speech')
+
+                    # Sampled communities are only estimated, not fully classified
+                    estimates = query_toxicity_estimates(p, start_date, end_date)
+                    if not estimates.empty:
+                        plot_key = 'chan' if p == '4chan' else p
+                        plots[f'{plot_key}_estimate'] = create_estimate_plot(estimates, p)
             except Exception as e:
                 print(f"Error processing {p}: {str(e)}")
     